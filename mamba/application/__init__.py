@@ -19,11 +19,12 @@ from .model import Model, ModelManager
 from mamba.web.routing import Router
 
 route = Router().route
+websocket = Router().websocket
 
 __all__ = [
     'Mamba', 'ApplicationError', '_app_ver',
     'Controller', 'ControllerManager', 'ControllerProvider', 'ControllerError',
     'AppStyles',
     'Model', 'ModelManager',
-    'route'
+    'route', 'websocket'
 ]
@@ -65,6 +65,14 @@ class Controller(resource.Resource, ControllerProvider):
         def helloworld(self, request, **kwargs):
             return 'Hello World'
 
+    WebSocket connections are upgraded in the same port and routing table
+    using the :py:func:`~mamba.application.websocket` decorator, the
+    decorated method returns the protocol that talks over the WebSocket::
+
+        @websocket('/chat')
+        def chat(self, request, **kwargs):
+            return ChatProtocol()
+
     seealso: :class:`~mamba.web.Router`, :class:`~mamba.web.Route`
 
     """
@@ -151,10 +159,18 @@ class Controller(resource.Resource, ControllerProvider):
         :type result: dict
         """
 
+        if result.code == http.SWITCHING:
+            # the connection has been taken over by a WebSocket
+            return
+
         self.prepare_headers(request, result.code, result.headers)
 
         try:
-            if type(result.subject) is not str:
+            if isinstance(result.subject, asyncjson.JSONStream):
+                d = result.subject.begin(request)
+                d.addCallback(self._finish, request)
+                return d
+            elif type(result.subject) is not str:
                 d = asyncjson.AsyncJSON(result.subject).begin(request)
                 d.addCallback(lambda ignored: request.finish())
                 return d
@@ -169,6 +185,13 @@ class Controller(resource.Resource, ControllerProvider):
 
         return
 
+    def _finish(self, ignored, request):
+        """Finish the request if the client didn't go away
+        """
+
+        if not getattr(request, '_disconnected', False):
+            request.finish()
+
     def prepare_headers(self, request, code, headers):
         """
         Prepare the back response headers
@@ -12,14 +12,25 @@
 """
 
 from os.path import normpath
+from itertools import islice
+from collections import OrderedDict
 
 from storm.uri import URI
+from storm.expr import (
+    SQL, And, Delete, Insert, Select, Update, compare_columns
+)
+from storm.info import get_cls_info, get_obj_info
 from storm.properties import PropertyPublisherMeta
+from twisted.internet import defer, threads
 from storm.twisted.transact import Transactor, transact
 
 from mamba import plugin
 from mamba.utils import config
 from mamba.core import interfaces, module
+from mamba.enterprise.cache import make_cache
+from mamba.enterprise.querycache import (
+    store_scheme, has_internals, STORE_INTERNALS
+)
 from mamba.enterprise.database import Database, AdapterFactory
 
 
@@ -61,6 +72,13 @@ class InvalidModelSchema(ModelError):
     """
 
 
+class StaleModelError(ModelError):
+    """
+    Fired when an optimistic locking update doesn't find the register
+    with the expected version
+    """
+
+
 class ModelProvider:
     """Mount point for plugins which refer to Models for our applications
     """
@@ -89,6 +107,7 @@ class Model(ModelProvider):
     """
 
     database = Database()
+    _caches = {}
 
     def __init__(self):
         super(Model, self).__init__()
@@ -118,73 +137,939 @@ class Model(ModelProvider):
 
         return self
 
-    @transact
     def create(self):
         """Create a new register in the database
         """
 
+        self.database.wrote(self.__storm_table__)
+        if self.get_shard_map_name() is not None:
+            return self.database.run_in_shard(self.get_shard(), self._create)
+
+        driver = self.database.driver
+        if driver is not None:
+            return self._create_async(driver)
+
+        return self.transactor.run(self._create)
+
+    def _create(self):
+        """Create the register (in the thread pool)
+        """
+
         store = self.database.store()
         store.add(self)
         store.commit()
 
-    @transact
-    def read(self, id, copy=False):
+    def _create_async(self, driver):
+        """Create the register with the async driver
+        """
+
+        cls_info = get_cls_info(self.__class__)
+        obj_info = get_obj_info(self)
+        changes = OrderedDict(
+            (column, obj_info.variables[column]) for column in cls_info.columns
+            if obj_info.variables[column].is_defined()
+        )
+
+        def created(primary_values):
+            for variable, value in zip(obj_info.primary_vars, primary_values):
+                variable.set(value, from_db=True)
+            for variable in obj_info.variables.values():
+                variable.checkpoint()
+
+        return driver.run_insert(Insert(
+            changes, cls_info.table, primary_columns=cls_info.primary_key
+        )).addCallback(created)
+
+    def read(self, id, copy=False, shard_key=None):
         """
         Read a register from the database. The give key (usually ID) should
         be a primary key.
 
+        If the model defines a `__cache__` dict (with the `ttl`, `size` and
+        `backend` options of :func:`~mamba.enterprise.cache.make_cache`) a
+        snapshot of the columns of the register is cached by primary key
+        and the next reads of it don't touch the database (the `shared`
+        backend is looked up in the database pool as it blocks). The cached
+        registers are returned as detached objects like the copies. The
+        snapshots are invalidated by :meth:`update`, :meth:`delete` and
+        :meth:`bulk_update`.
+
+        If the database has read replicas the register is read from one of
+        them (unless the table has been written in the last seconds, see
+        :class:`~mamba.enterprise.database.Database`) and it is returned as
+        a detached object too.
+
+        If the model is sharded the register is read from the shard of the
+        given `shard_key` value. When the shard key is part of the primary
+        key it is taken from the ID, otherwise if it is not given the
+        register is searched in all the shards.
+
         :param id: the ID to get from the database
         :type id: int
+        :param shard_key: the value of the shard key of the register
+        :returns: a :class:`twisted.internet.defer.Deferred`
         """
 
+        cache = self.get_cache()
+        if cache is not None and not getattr(cache, 'blocking', False):
+            # the blocking backends are looked up in the pool by _read
+            snapshot = cache.get(self._cache_key(id))
+            if snapshot is not None:
+                return defer.succeed(self._from_snapshot(snapshot, copy))
+
+        shard_map = self.get_shard_map()
+        if shard_map is not None:
+            return self._read_sharded(shard_map, id, copy, cache, shard_key)
+
+        driver = self.database.driver
+        if driver is not None:
+            return self._read_async(driver, id, copy, cache)
+
+        return self.database.run_read(
+            self.__storm_table__, self._read, id, copy, cache
+        )
+
+    def _read(self, id, copy, cache):
+        """Read the register (in the thread pool)
+        """
+
+        if cache is not None and getattr(cache, 'blocking', False):
+            snapshot = cache.get(self._cache_key(id))
+            if snapshot is not None:
+                return self._from_snapshot(snapshot, copy)
+
+        generation = self._cache_generation(cache, id)
         store = self.database.store()
-        data = store.get(self.__class__, id)
+        data = self._get(store, id)
 
         if data is not None:
-            if copy is True:
+            if cache is not None:
+                self._cache_set(cache, id, data._snapshot(), generation)
+            if self.database.in_replica:
+                # objects of the replica stores can't be updated
+                data = self._from_snapshot(data._snapshot(), copy)
+            elif copy is True:
                 data = self.copy(data)
             data.transactor = self.transactor
+            data._remember_version()
 
         return data
 
-    @transact
+    def _read_sharded(self, shard_map, id, copy, cache, shard_key):
+        """Read the register from its shard or from all the shards
+        """
+
+        if shard_key is None:
+            cls_info = get_cls_info(self.__class__)
+            column = cls_info.attributes.get(self.__shard_key__)
+            ids = id if type(id) is tuple else (id,)
+            for primary_column, value in zip(cls_info.primary_key, ids):
+                if primary_column is column:
+                    shard_key = value
+
+        if shard_key is not None:
+            return self.database.run_in_shard(
+                shard_map.shard_for(shard_key), self._read, id, copy, cache
+            )
+
+        d = self.database.run_on_shards(
+            shard_map, self._read, id, copy, cache
+        )
+        return d.addCallback(lambda results: next(
+            (result for result in results if result is not None), None
+        ))
+
+    def _read_async(self, driver, id, copy, cache):
+        """Read the register with the async driver
+        """
+
+        def lookup():
+            snapshot = None
+            if cache is not None and getattr(cache, 'blocking', False):
+                snapshot = cache.get(self._cache_key(id))
+            return snapshot, self._cache_generation(cache, id)
+
+        def query(result):
+            snapshot, generation = result
+            if snapshot is not None:
+                return self._from_snapshot(snapshot, copy)
+
+            return driver.run_query(
+                self._primary_key_query().statement, self._primary_vars(id)
+            ).addCallback(read, generation)
+
+        def read(rows, generation):
+            if not rows:
+                return None
+
+            snapshot = tuple(rows[0])
+            d = defer.succeed(None)
+            if cache is not None:
+                d = self._run_cache(
+                    self._cache_set, cache, id, snapshot, generation
+                )
+
+            return d.addCallback(
+                lambda _: self._from_snapshot(snapshot, copy)
+            )
+
+        return self._run_cache(lookup).addCallback(query)
+
+    def _get(self, store, id):
+        """
+        Like :meth:`storm.store.Store.get` but using the compiled primary
+        key query of the model instead of compiling a new Select
+        """
+
+        if not has_internals(store, STORE_INTERNALS):
+            return store.get(self.__class__, id)
+
+        store.flush()
+
+        cls_info = get_cls_info(self.__class__)
+        primary_vars = self._primary_vars(id)
+        primary_values = tuple(var.get(to_db=True) for var in primary_vars)
+        obj_info = store._alive.get((cls_info.cls, primary_values))
+        if obj_info is not None and not obj_info.get('invalidated'):
+            return store._get_object(obj_info)
+
+        result = self._primary_key_query(store).execute(store, primary_vars)
+        values = result.get_one()
+        if values is None:
+            return None
+
+        return store._load_object(cls_info, result, values)
+
+    @classmethod
+    def _primary_vars(cls, id):
+        """Return back the variables of the primary key columns for id
+        """
+
+        return [
+            column.variable_factory(value=value) for column, value in zip(
+                get_cls_info(cls).primary_key,
+                id if type(id) is tuple else (id,)
+            )
+        ]
+
+    @classmethod
+    def _compiled(cls, shape, build, store=None):
+        """
+        Return back the compiled query of this model for the given query
+        shape, `build` returns the Storm expression to compile if the
+        shape is not compiled yet.
+
+        The query is compiled for the backend of the given store (shards
+        and replicas may use another one than the primary database) or
+        for the configured database if there is no store (async driver)
+        """
+
+        if store is not None:
+            scheme = store_scheme(store)
+        else:
+            uri = getattr(cls, '__uri__', None) or config.Database().uri
+            scheme = URI(uri).scheme
+
+        return cls.database.query_cache.get((cls, shape), scheme, build)
+
+    @classmethod
+    def _primary_key_query(cls, store=None):
+        """Return back the compiled query to get a register by primary key
+        """
+
+        def build():
+            cls_info = get_cls_info(cls)
+            return Select(
+                cls_info.columns,
+                compare_columns(cls_info.primary_key, [
+                    column.variable_factory()
+                    for column in cls_info.primary_key
+                ]),
+                default_tables=cls_info.table,
+                limit=1
+            )
+
+        return cls._compiled('primary_key', build, store)
+
+    @classmethod
+    def named_query(cls, name, *params):
+        """
+        Run one of the hot queries declared in the `__queries__` dict of
+        the model, that maps names to SQL conditions with ? parameter
+        marks::
+
+            class User(Model):
+                __storm_table__ = 'user'
+                __queries__ = {
+                    'by_email': 'email = ?',
+                    'newest': 'active = ? ORDER BY created DESC LIMIT ?'
+                }
+                ...
+
+            users = yield User.named_query('newest', True, 10)
+
+        The queries are compiled to SQL just once (and prepared in the
+        server on PostgreSQL).
+
+        :param name: the name of the query
+        :type name: str
+        :returns: a :class:`twisted.internet.defer.Deferred` that fires with
+                  the list of objects
+        """
+
+        try:
+            condition = cls.__queries__[name]
+        except (AttributeError, KeyError):
+            raise ModelError('{} model does not define a {} query'.format(
+                cls.__name__, name
+            ))
+
+        def build():
+            cls_info = get_cls_info(cls)
+            return Select(
+                cls_info.columns, SQL(condition),
+                default_tables=cls_info.table
+            )
+
+        def query(store=None):
+            return cls._compiled(('named', name), build, store)
+
+        if not cls.database.started:
+            cls.database.start()
+
+        prototype = cls.__new__(cls)
+        prototype.transactor = Transactor(cls.database.pool)
+
+        if cls.get_shard_map_name() is not None:
+            return cls.fan_out(
+                cls._named_query, prototype, query, condition, params
+            )
+
+        driver = cls.database.driver
+        if driver is not None:
+            return driver.run_query(query().statement, params).addCallback(
+                lambda rows: [
+                    prototype._from_snapshot(row, False) for row in rows
+                ]
+            )
+
+        return cls.database.run_read(
+            cls.__storm_table__, cls._named_query,
+            prototype, query, condition, params
+        )
+
+    @classmethod
+    def _named_query(cls, prototype, query, condition, params):
+        """Run the named query compiled for the store (in the thread pool)
+        """
+
+        store = cls.database.store()
+        if has_internals(store, STORE_INTERNALS):
+            cls_info = get_cls_info(cls)
+            result = query(store).execute(store, params)
+            loaded = (
+                store._load_object(cls_info, result, values)
+                for values in result.get_all()
+            )
+        else:
+            loaded = store.find(cls, SQL(condition, tuple(params)))
+
+        objects = []
+        for obj in loaded:
+            if cls.database.in_replica:
+                obj = prototype._from_snapshot(obj._snapshot(), False)
+            obj.transactor = prototype.transactor
+            obj._remember_version()
+            objects.append(obj)
+
+        return objects
+
+    @classmethod
+    def get_shard_map_name(cls):
+        """
+        Return back the name of the shard map of this model or None if the
+        model is not sharded.
+
+        The sharded models define the name of the attribute used to pick
+        their shard in `__shard_key__` and the name of the shard map in the
+        `shards` option of the database config in `__shard_map__` (that is
+        the table name by default)::
+
+            class Message(Model):
+                __storm_table__ = 'message'
+                __shard_key__ = 'user_id'
+                __shard_map__ = 'users'
+                ...
+
+        The value of the shard key of a register must not change.
+        """
+
+        if getattr(cls, '__shard_key__', None) is None:
+            return None
+
+        return getattr(cls, '__shard_map__', None) or cls.__storm_table__
+
+    @classmethod
+    def get_shard_map(cls):
+        """
+        Return back the :class:`~mamba.enterprise.sharding.ShardMap` of
+        this model or None if the model is not sharded
+        """
+
+        name = cls.get_shard_map_name()
+        if name is None:
+            return None
+
+        return cls.database.shard_map(name)
+
+    def get_shard(self):
+        """Return back the shard for the shard key value of this object
+        """
+
+        return self.get_shard_map().shard_for(
+            getattr(self, self.__shard_key__)
+        )
+
+    @classmethod
+    def fan_out(cls, function, *args, **kwargs):
+        """
+        Run the given function in every shard of this sharded model in
+        parallel in the database thread pool. The function gets the store
+        of its shard from :meth:`~mamba.enterprise.database.Database.store`
+        and it must return back an iterable.
+
+        :returns: a :class:`twisted.internet.defer.Deferred` that fires with
+                  the list of the merged results of all the shards
+        """
+
+        shard_map = cls.get_shard_map()
+        if shard_map is None:
+            raise ModelError('{} model is not sharded'.format(cls.__name__))
+
+        d = cls.database.run_on_shards(shard_map, function, *args, **kwargs)
+        return d.addCallback(
+            lambda results: [item for result in results for item in result]
+        )
+
+    @classmethod
+    def get_cache(cls):
+        """
+        Return back the cache backend for this model or None if the model
+        doesn't define `__cache__`
+        """
+
+        options = getattr(cls, '__cache__', None)
+        if options is None:
+            return None
+
+        cache = Model._caches.get(cls)
+        if cache is None:
+            cache = Model._caches.setdefault(cls, make_cache(options))
+
+        return cache
+
+    @classmethod
+    def _cache_key(cls, id):
+        """Return back the cache key for the given primary key
+        """
+
+        cls_info = get_cls_info(cls)
+        # use the column variables to get the same key for 1 and 1L
+        values = tuple(
+            column.variable_factory(value=value).get()
+            for column, value in zip(
+                cls_info.primary_key, id if type(id) is tuple else (id,)
+            )
+        )
+
+        return cls_info.table.name, values
+
+    @classmethod
+    def _cache_generation(cls, cache, id):
+        """
+        Return back the invalidation generation of the cache entry of the
+        given primary key or None if the cache backend has no generations
+        """
+
+        if cache is None or not hasattr(cache, 'generation'):
+            return None
+
+        return cache.generation(cls._cache_key(id))
+
+    @classmethod
+    def _cache_set(cls, cache, id, snapshot, generation):
+        """
+        Store the snapshot of the given primary key unless the entry has
+        been invalidated since the given generation
+        """
+
+        if generation is None:
+            cache.set(cls._cache_key(id), snapshot)
+        else:
+            cache.set(cls._cache_key(id), snapshot, generation)
+
+    def _snapshot(self):
+        """Return back the database values of the columns of this object
+        """
+
+        variables = get_obj_info(self).variables
+        return tuple(
+            variables[column].get(to_db=True)
+            for column in get_cls_info(self.__class__).columns
+        )
+
+    def _from_snapshot(self, snapshot, copy):
+        """
+        Return back a detached object with the values of the given snapshot
+        """
+
+        cls = self.__class__
+        obj = self if copy is True else cls.__new__(cls)
+        variables = get_obj_info(obj).variables
+        for column, value in zip(get_cls_info(cls).columns, snapshot):
+            variable = variables[column]
+            variable.set(value, from_db=True)
+            variable.checkpoint()
+
+        obj.transactor = self.transactor
+        obj._remember_version()
+        return obj
+
+    def _run_cache(self, func, *args):
+        """
+        Run the given model cache operation and return back a Deferred,
+        the operations of the blocking cache backends (like the shared
+        one) run in the database pool to don't block the reactor
+        """
+
+        cache = self.get_cache()
+        if cache is not None and getattr(cache, 'blocking', False):
+            from twisted.internet import reactor
+            return threads.deferToThreadPool(
+                reactor, self.database.pool, func, *args
+            )
+
+        return defer.maybeDeferred(func, *args)
+
+    def _invalidate(self):
+        """Remove this object from the model cache if any
+        """
+
+        cache = self.get_cache()
+        if cache is not None:
+            cache.discard(self._cache_key(tuple(
+                variable.get() for variable in get_obj_info(self).primary_vars
+            )))
+
     def update(self):
-        """Update a register in the database
         """
+        Update a register in the database.
+
+        Only the columns that changed since the object was loaded from the
+        database (or since the last update) are written, using a single
+        ``UPDATE ... SET <changed columns> WHERE <primary key>`` statement
+        without reading the register first. Objects that don't come from
+        the database (like the read copies) write all their defined
+        columns.
+
+        If the model defines a `__version_column__` with the name of an
+        integer column it is used for optimistic locking, the column is
+        incremented with every update and if the register has been updated
+        by someone else since the object was loaded
+        :class:`~mamba.application.model.StaleModelError` is raised.
+        """
+
+        self.database.wrote(self.__storm_table__)
+        if self.get_shard_map_name() is not None:
+            return self.database.run_in_shard(self.get_shard(), self._update)
+
+        driver = self.database.driver
+        if driver is not None:
+            return defer.maybeDeferred(self._update_async, driver)
+
+        return self.transactor.run(self._update)
+
+    def _update(self):
+        """Update the register (in the thread pool)
+        """
+
+        self._check_primary_key()
 
         store = self.database.store()
-        primary_key = self.get_primary_key()
-        if primary_key is None:
+        # the store must not flush this object before we do it ourselves
+        store.block_implicit_flushes()
+        try:
+            update = self._update_expr(store)
+            if update is None:
+                return
+
+            query, params, version = update
+            self._updated(query.execute(store, params).rowcount, version)
+        finally:
+            store.unblock_implicit_flushes()
+
+        store.commit()
+        self._invalidate()
+
+    def _update_async(self, driver):
+        """Update the register with the async driver
+        """
+
+        self._check_primary_key()
+
+        update = self._update_expr()
+        if update is None:
+            return None
+
+        query, params, version = update
+        d = driver.run_operation(query.statement, params)
+        d.addCallback(self._updated, version)
+        d.addCallback(lambda _: self._run_cache(self._invalidate))
+        return d
+
+    def _check_primary_key(self):
+        """Raise InvalidModelSchema if the model has not a primary key
+        """
+
+        if self.get_primary_key() is None:
             raise InvalidModelSchema(
                 '{model} model does not define a primary key'.format(
                     model=self
                 )
             )
 
-        if type(primary_key) is tuple:
-            args = []
-            for key in primary_key:
-                args.append(getattr(self.__class__, key) == getattr(self, key))
-            copy = store.find(self.__class__, *args).one()
-        else:
-            value = getattr(self, primary_key)
-            copy = store.find(
-                self.__class__,
-                getattr(self.__class__, primary_key) == value
-            ).one()
+    def _update_expr(self, store=None):
+        """
+        Return back the compiled query and the parameters to write the
+        changed columns of this object and the version that it writes (if
+        the model is versioned) or None if there is nothing to write
+        """
 
-        for column in self._storm_columns.values():
-            setattr(copy, column.name, getattr(self, column.name))
+        cls_info = get_cls_info(self.__class__)
+        obj_info = get_obj_info(self)
+
+        version = self._version_variable(obj_info)
+        if version is not None:
+            version_column, version_variable = version
+            if 'mamba.version' in obj_info:
+                current = obj_info['mamba.version']
+            else:
+                current = version_variable.get()
+
+        changes = OrderedDict()
+        for column in cls_info.columns:
+            if id(column) in cls_info.primary_key_idx:
+                continue
+            if version is not None and column is version_column:
+                continue
+
+            variable = obj_info.variables[column]
+            if variable.is_defined() and variable.has_changed():
+                changes[column] = variable
+
+        if not changes:
+            return None
+
+        params = changes.values()
+        new_version = None
+        if version is not None:
+            new_version = (current or 0) + 1
+            params.append(version_column.variable_factory(value=new_version))
+        params.extend(obj_info.primary_vars)
+        if version is not None and current is not None:
+            params.append(version_column.variable_factory(value=current))
+
+        def build():
+            sets = OrderedDict(
+                (column, column.variable_factory()) for column in changes
+            )
+            where = [compare_columns(cls_info.primary_key, [
+                column.variable_factory() for column in cls_info.primary_key
+            ])]
+            if version is not None:
+                sets[version_column] = version_column.variable_factory()
+                where.append(version_column == (
+                    None if current is None
+                    else version_column.variable_factory()
+                ))
+
+            return Update(sets, And(*where), cls_info.table)
+
+        shape = (
+            'update', tuple(column.name for column in changes),
+            version is not None and current is None
+        )
+        return self._compiled(shape, build, store), params, new_version
 
+    def _updated(self, rowcount, new_version):
+        """
+        Check the result of the update and mark the written columns as
+        clean so the store doesn't flush them again
+        """
+
+        obj_info = get_obj_info(self)
+        if new_version is not None:
+            if rowcount == 0:
+                raise StaleModelError(
+                    '{model} register has been modified since it was '
+                    'loaded'.format(model=self.__class__.__name__)
+                )
+
+            obj_info['mamba.version'] = new_version
+            self._version_variable(obj_info)[1].set(new_version, from_db=True)
+
+        for variable in obj_info.variables.values():
+            variable.checkpoint()
+
+    def _version_variable(self, obj_info):
+        """
+        Return back the (column, variable) of the optimistic locking version
+        column or None if the model doesn't define one
+        """
+
+        name = getattr(self, '__version_column__', None)
+        if name is None:
+            return None
+
+        column = getattr(self.__class__, name)
+        return column, obj_info.variables[column]
+
+    def _remember_version(self):
+        """
+        Remember the loaded version, the store invalidates the objects on
+        commit so reloading it later would return the current one
+        """
+
+        obj_info = get_obj_info(self)
+        version = self._version_variable(obj_info)
+        if version is not None:
+            obj_info['mamba.version'] = version[1].get()
+
+    @classmethod
+    def bulk_create(cls, rows, batch_size=1000):
+        """
+        Insert many registers in the database in a single transaction.
+
+        The rows can be instances of the model or dicts of attribute names
+        and values. They are inserted in batches of `batch_size` rows using
+        multi-row INSERT statements, so importing many rows costs one
+        thread pool hop and one commit instead of one per row.
+
+        The rows are not added to the store so auto increment primary keys
+        are not loaded back into the given instances.
+
+        The rows of the sharded models are grouped by shard and every group
+        is inserted in its shard in parallel.
+
+        :param rows: the rows to insert
+        :type rows: iterable
+        :param batch_size: the number of rows to convert and send at once
+        :type batch_size: int
+        :returns: a :class:`twisted.internet.defer.Deferred` that fires with
+                  the number of inserted rows
+        """
+
+        return cls._bulk_run(cls._bulk_create, rows, batch_size)
+
+    @classmethod
+    def bulk_update(cls, rows, batch_size=1000):
+        """
+        Update many registers in the database in a single transaction.
+
+        The rows can be instances of the model or dicts of attribute names
+        and values, they must contain the primary key. The columns present
+        in every row are updated, with multi-row statements on MySQL
+        (UPDATE ... JOIN over the rows) and PostgreSQL (UPDATE ... FROM
+        VALUES) and one UPDATE per row in the same transaction on SQLite.
+        The rows whose primary key is not in the table are skipped, they
+        are never inserted.
+
+        The number of updated rows is the rowcount of the statements. MySQL
+        only counts the rows that really changed, so rows that already had
+        the given values are not counted there while PostgreSQL and SQLite
+        count every matched row.
+
+        :param rows: the rows to update
+        :type rows: iterable
+        :param batch_size: the number of rows to convert and send at once
+        :type batch_size: int
+        :returns: a :class:`twisted.internet.defer.Deferred` that fires with
+                  the number of updated rows
+        """
+
+        return cls._bulk_run(cls._bulk_update, rows, batch_size)
+
+    @classmethod
+    def _bulk_run(cls, function, rows, batch_size):
+        """Run the given bulk function in the database thread pool
+        """
+
+        if not cls.database.started:
+            cls.database.start()
+
+        cls.database.wrote(cls.__storm_table__)
+        shard_map = cls.get_shard_map()
+        if shard_map is None:
+            return Transactor(cls.database.pool).run(
+                function, rows, batch_size
+            )
+
+        groups = OrderedDict()
+        for row in rows:
+            if isinstance(row, dict):
+                key = row.get(cls.__shard_key__)
+            else:
+                key = getattr(row, cls.__shard_key__)
+            groups.setdefault(shard_map.index(key), []).append(row)
+
+        return defer.gatherResults([
+            cls.database.run_in_shard(
+                shard_map.shards[index], function, group, batch_size
+            ) for index, group in groups.iteritems()
+        ], consumeErrors=True).addCallback(sum)
+
+    @classmethod
+    def _bulk_create(cls, rows, batch_size):
+        """Insert the rows batch by batch (in the thread pool)
+        """
+
+        store = cls.database.store()
+        count = 0
+        for adapter, columns, values in cls._bulk_groups(rows, batch_size):
+            names = [column.name for column in columns]
+            for statement, params in adapter.insert_many(names, values):
+                store.execute(statement, params, noresult=True)
+            count += len(values)
+
+        return count
+
+    @classmethod
+    def _bulk_update(cls, rows, batch_size):
+        """Update the rows batch by batch (in the thread pool)
+        """
+
+        store = cls.database.store()
+        primary = get_cls_info(cls).primary_key
+        count = 0
+        keys = []
+        for adapter, columns, values in cls._bulk_groups(rows, batch_size):
+            # columns compare as SQL expressions, check them by identity
+            if not all(any(key is column for column in columns)
+                       for key in primary):
+                raise ModelError(
+                    'bulk_update of {} rows without primary key'.format(
+                        cls.__name__
+                    )
+                )
+
+            names = [column.name for column in columns]
+            for statement, params in adapter.update_many(
+                    names, [column.name for column in primary], values):
+                count += store.execute(statement, params).rowcount
+
+            positions = [
+                next(i for i, col in enumerate(columns) if col is key)
+                for key in primary
+            ]
+            keys.extend(
+                tuple(row[position].get() for position in positions)
+                for row in values
+            )
+
+        # invalidate after the commit so a concurrent read can't cache
+        # the old values again
         store.commit()
+        cache = cls.get_cache()
+        if cache is not None:
+            for key in keys:
+                cache.discard(cls._cache_key(key))
+
+        return count
+
+    @classmethod
+    def _bulk_groups(cls, rows, batch_size):
+        """
+        Split the rows in batches and group the rows of every batch by the
+        columns that they define, yields (adapter, columns, variables)
+        """
+
+        columns = get_cls_info(cls).columns
+        adapter = None
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            groups = OrderedDict()
+            for row in batch:
+                if not isinstance(row, cls):
+                    obj = cls.__new__(cls)
+                    for name, value in row.iteritems():
+                        setattr(obj, name, value)
+                    row = obj
+
+                if adapter is None:
+                    adapter = row.get_adapter()
+
+                variables = get_obj_info(row).variables
+                defined = tuple(
+                    column for column in columns
+                    if variables[column].is_defined()
+                )
+                groups.setdefault(defined, []).append(
+                    [variables[column] for column in defined]
+                )
+
+            for defined, values in groups.iteritems():
+                yield adapter, defined, values
 
-    @transact
     def delete(self):
         """Delete a register from the database
         """
 
+        self.database.wrote(self.__storm_table__)
+        if self.get_shard_map_name() is not None:
+            return self.database.run_in_shard(self.get_shard(), self._delete)
+
+        driver = self.database.driver
+        if driver is not None:
+            return self._delete_async(driver)
+
+        return self.transactor.run(self._delete)
+
+    def _delete(self):
+        """Delete the register (in the thread pool)
+        """
+
+        cls_info = get_cls_info(self.__class__)
+        # the object may be detached (cached or replica reads) so we don't
+        # use store.remove, that only works for objects of this store
         store = self.database.store()
-        store.remove(self)
+        store.execute(Delete(
+            compare_columns(
+                cls_info.primary_key, get_obj_info(self).primary_vars
+            ),
+            cls_info.table
+        ), noresult=True)
+        store.commit()
+        self._invalidate()
+
+    def _delete_async(self, driver):
+        """Delete the register with the async driver
+        """
+
+        cls_info = get_cls_info(self.__class__)
+        delete = Delete(
+            compare_columns(
+                cls_info.primary_key, get_obj_info(self).primary_vars
+            ),
+            cls_info.table
+        )
+
+        return driver.run_operation(delete).addCallback(
+            lambda _: self._run_cache(self._invalidate)
+        )
 
     @transact
     def create_table(self):
@@ -221,6 +1106,23 @@ class Model(ModelProvider):
         adapter = self.get_adapter()
         return adapter.insert_data()
 
+    def iter_dump_data(self, batch_size=None, progress=None, uri=None):
+        """
+        Generate the SQL commands used to insert the data of this model in
+        batches of `batch_size` rows, without loading the whole table
+
+        :param batch_size: the number of rows of every INSERT statement
+        :type batch_size: int
+        :param progress: callable that is called with the number of rows
+                         dumped so far
+        :param uri: the URI of the database to read the data from (like a
+                    shard), by default the configured database
+        :type uri: str
+        """
+
+        adapter = self.get_adapter()
+        return adapter.iter_insert_data(batch_size, progress, uri)
+
     def dump_references(self):
         """Dump SQL references (used by PostgreSQL)
         """
@@ -61,8 +61,32 @@ class MambaSQLAdapter:
 
         return self.original.insert_data()
 
+    def iter_insert_data(self, batch_size=None, progress=None):
+        """
+        Generate the SQL syntax to insert the data that populate a table
+        in batches
+        """
+
+        return self.original.iter_insert_data(batch_size, progress)
+
     def parse_references(self):
         """Return the SQL syntax to create foreign keys for PostgreSQL
         """
 
         return self.original.parse_references()
+
+    def insert_many(self, columns, rows):
+        """
+        Return the SQL statements and parameters to insert many rows at
+        once
+        """
+
+        return self.original.insert_many(columns, rows)
+
+    def update_many(self, columns, primary, rows):
+        """
+        Return the SQL statements and parameters to update many rows at
+        once
+        """
+
+        return self.original.update_many(columns, primary, rows)
@@ -11,43 +11,215 @@
 
 """
 
-import cPickle
+import sys
+import time
 import functools
 from collections import OrderedDict
 
+from twisted.internet import defer
+from twisted.python.failure import Failure
 
-def cache(size=16):
+
+_missing = object()
+_kwargs_mark = object()
+
+
+def _make_key(args, kwargs):
+    """Build a hashable cache key from positional and keyword arguments
+    """
+
+    if not kwargs:
+        return args
+
+    return args + (_kwargs_mark,) + tuple(sorted(kwargs.items()))
+
+
+def _sizeof(obj, seen=None, depth=8):
+    """
+    Returns an approximation of the memory used by obj and the objects
+    that it contains. Unlike pickling it, it works with any object.
+
+    Only `depth` levels of contained objects are walked. The Storm object
+    info and the transactor of the models are not followed as they refer
+    to the whole store and database thread pool, just the values of the
+    columns of the model are accounted.
+    """
+
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 0)
+    if depth == 0:
+        return size
+
+    depth -= 1
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += _sizeof(key, seen, depth) + _sizeof(value, seen, depth)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _sizeof(item, seen, depth)
+    elif hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__, 0)
+        for name, value in obj.__dict__.iteritems():
+            if name == 'transactor':
+                continue
+            if name == '__storm_object_info__':
+                value = [
+                    variable.get_lazy()
+                    for variable in value.variables.itervalues()
+                ]
+            size += _sizeof(value, seen, depth)
+
+    return size
+
+
+class LRUCache(object):
+    """
+    I am a size aware Least Recently Used cache with optional TTL.
+
+    The size of every entry is estimated just once when it is stored so
+    inserts and evictions are O(1). When the total estimated size is
+    bigger than the given size (in MB) I drop the least recently used
+    entries until it fits again.
+
+    .. admonition:: Notice
+
+        The memory size of the entries is just an approximation
+
+    :param size: the max size of the cache in MB, 0 means unlimited
+    :type size: int
+    :param ttl: the time to live of the entries in seconds, 0 means the
+                entries never expire
+    :type ttl: int
+    :param clock: callable that returns the current time in seconds
+    """
+
+    def __init__(self, size=16, ttl=0, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """
+        Get the value stored for key (and mark it as recently used) or
+        default if there is no value or it has expired
+        """
+
+        try:
+            value, size, expires = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires is not None and expires <= self.clock():
+            self.memory -= size
+            self.misses += 1
+            return default
+
+        self._entries[key] = (value, size, expires)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Store value for key evicting the least recently used entries
+        """
+
+        self.discard(key)
+
+        size = _sizeof(value)
+        expires = self.clock() + self.ttl if self.ttl else None
+        self._entries[key] = (value, size, expires)
+        self.memory += size
+
+        if self.size != 0:
+            limit = self.size * 1024 * 1024
+            while self.memory >= limit and len(self._entries) > 0:
+                self.memory -= self._entries.popitem(False)[1][1]
+                self.evictions += 1
+
+    def discard(self, key):
+        """Remove the entry for key if any
+        """
+
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.memory -= entry[1]
+
+    def clear(self):
+        """Remove all the entries
+        """
+
+        self._entries.clear()
+        self.memory = 0
+
+    def stats(self):
+        """Return back a dict with the cache counters
+        """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'memory': self.memory
+        }
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def cache(size=16, ttl=0):
     """
-    Cache the results of the function if the same positional arguments
-    are provided.
+    Cache the results of the function if the same positional and keyword
+    arguments are provided.
 
     We only store the size provided (if any) in MB, after that we should
-    perform FIFO queries until the size of the cache is lower than
-    the provided one.
+    drop the least recently used results until the size of the cache is
+    lower than the provided one. If a ttl in seconds is given the cached
+    results expire after it.
+
+    If the size is 0 then an unlimited cache is provided.
 
-    If the size is 0 then an unlimited cache is provided
+    The :class:`~mamba.core.decorators.LRUCache` used is available in the
+    `cache` attribute of the decorated function.
 
     .. admonition:: Notice
 
-        The memory size of the int_cache is just an approximation
+        The memory size of the cache is just an approximation
     """
-    int_cache = OrderedDict()
 
     def decorator(func):
+        lru = LRUCache(size, ttl)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            if args in int_cache:
-                return int_cache.get(args)
-
-            result = func(*args, **kwargs)
-            int_cache.update({args: result})
+            key = _make_key(args, kwargs)
+            try:
+                result = lru.get(key, _missing)
+            except TypeError:
+                # unhashable arguments, we can't cache this call
+                return func(*args, **kwargs)
 
-            if size != 0:
-                while len(cPickle.dumps(int_cache)) >= size * 1024 * 1024:
-                    int_cache.popitem(False)
+            if result is _missing:
+                result = func(*args, **kwargs)
+                lru.set(key, result)
 
             return result
 
+        wrapper.cache = lru
         return wrapper
 
     return decorator
@@ -63,3 +235,60 @@ def unlimited_cache(func):
         return func(*args, **kwargs)
 
     return wrapper
+
+
+def deferred_cache(size=16, ttl=0):
+    """
+    Cache the eventual results of functions that return a
+    :class:`twisted.internet.defer.Deferred` like the
+    :class:`~mamba.application.model.Model` methods decorated with
+    `@transact`.
+
+    Concurrent calls with the same arguments while the result is not
+    available yet share a single call to the decorated function. Failures
+    are never cached.
+
+    The size and ttl parameters work exactly as in
+    :meth:`~mamba.core.decorators.cache`
+    """
+
+    def decorator(func):
+        lru = LRUCache(size, ttl)
+        pending = {}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            try:
+                result = lru.get(key, _missing)
+            except TypeError:
+                return defer.maybeDeferred(func, *args, **kwargs)
+
+            if result is not _missing:
+                return defer.succeed(result)
+
+            if key in pending:
+                waiter = defer.Deferred()
+                pending[key].append(waiter)
+                return waiter
+
+            waiters = pending[key] = []
+
+            def fire(result):
+                del pending[key]
+                if isinstance(result, Failure):
+                    for waiter in waiters:
+                        waiter.errback(result)
+                else:
+                    lru.set(key, result)
+                    for waiter in waiters:
+                        waiter.callback(result)
+
+                return result
+
+            return defer.maybeDeferred(func, *args, **kwargs).addBoth(fire)
+
+        wrapper.cache = lru
+        return wrapper
+
+    return decorator
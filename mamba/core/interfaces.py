@@ -143,6 +143,24 @@ class IMambaSQL(Interface):
         """Return the SQL syntax string to insert data that populate a table
         """
 
+    def iter_insert_data(self, batch_size=None, progress=None):
+        """
+        Generate the SQL syntax to insert the data that populate a table
+        in batches
+        """
+
+    def insert_many(self, columns, rows):
+        """
+        Return the SQL statements and parameters to insert many rows at
+        once
+        """
+
+    def update_many(self, columns, primary, rows):
+        """
+        Return the SQL statements and parameters to update many rows at
+        once
+        """
+
 
 class ISession(Interface):
     """
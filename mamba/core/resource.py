@@ -11,17 +11,24 @@
 
 """
 
+import hashlib
+
 from singledispatch import singledispatch
 
-from twisted.web import static
-from twisted.python import filepath
+from twisted.web import static, http
+from twisted.python import filepath, log
 from twisted.web.resource import Resource as TwistedResource
 
 from mamba.http import headers
+from mamba.core import GNU_LINUX
 from mamba.core import templating
 from mamba.utils.config import Application
 from mamba.application import scripts, appstyles
 
+if GNU_LINUX:
+    from twisted.internet import inotify
+    from twisted.python._inotify import INotifyError
+
 
 class Resource(TwistedResource):
     """
@@ -31,19 +38,29 @@ class Resource(TwistedResource):
     :param template_paths: additional template paths for resources
     :param cache_size: the cache size for Jinja2 Templating system
     :param static: route for static data for this resouce
+
+    The names of the templates are indexed in memory the first time that
+    they are needed. In GNU/Linux the template paths are watched with
+    :class:`twisted.internet.inotify.INotify` so the index is refreshed
+    when templates are added or removed.
+
+    If the `render_cache` application option is set, the rendered output
+    of the templates is cached while the `render_keys` don't change and it
+    is served with an ETag. Only the `render_keys` are compared so it must
+    not be enabled if the templates use other mutable data.
     """
 
     def __init__(self, template_paths=None, cache_size=50, static_path=None):
         TwistedResource.__init__(self)
 
-        sep = filepath.os.sep
         self._templates = {}
+        self.template_index = None
+        self.template_names = frozenset()
+        self._rendered = {}
+        self.notifier = None
         self.cache_size = cache_size
         self.template_paths = [
-            'application/view/templates',
-            '{}/templates/jinja'.format(
-                filepath.os.path.dirname(__file__).rsplit(sep, 1)[0]
-            )
+            'application/view/templates', templating.MAMBA_TEMPLATES
         ]
 
         self.add_template_paths = singledispatch(self.add_template_paths)
@@ -102,12 +119,9 @@ class Resource(TwistedResource):
             self.putChild('assets', static_path)
 
         # template environment
-        self.environment = templating.Environment(
-            autoescape=lambda name: (
-                name.rsplit('.', 1)[1] == 'html' if name is not None else False
-            ),
-            cache_size=self.cache_size,
-            loader=templating.FileSystemLoader(self.template_paths)
+        self.environment = templating.get_environment(
+            self.template_paths, cache_size=self.cache_size,
+            autoescape=templating.autoescape_html
         )
 
     def getChild(self, path, request):
@@ -131,9 +145,11 @@ class Resource(TwistedResource):
         if path == '' or path is None or path == 'index':
             return self
 
-        for template in self.environment.list_templates():
-            if path == template.rsplit('.', 1)[0]:
-                return self
+        if self.template_index is None:
+            self.build_template_index()
+
+        if path in self.template_index:
+            return self
 
         return TwistedResource.getChild(self, path, request)
 
@@ -144,25 +160,128 @@ class Resource(TwistedResource):
         if not request.prepath[0].endswith('.html'):
             request.prepath[0] += '.html'
 
-        try:
-            template = templating.Template(
-                self.environment, template=request.prepath[0]
-            )
-            return template.render(**self.render_keys).encode('utf-8')
-        except templating.TemplateNotFound:
+        if self.template_index is None:
+            self.build_template_index()
+
+        template = request.prepath[0]
+        if template not in self.template_names:
+            if 'index.html' in self.template_names:
+                template = 'index.html'
+            else:
+                template = 'root_page.html'
+
+        body, etag = self.render_template(template)
+        if etag is not None and request.setETag(etag) == http.CACHED:
+            return ''
+
+        return body
+
+    def build_template_index(self):
+        """
+        Build the in memory index of the templates in the template paths,
+        `template_index` maps the template names without extension to the
+        template names and `template_names` is the set of template names
+        """
+
+        names = self.environment.list_templates()
+        self.template_index = {
+            name.rsplit('.', 1)[0]: name for name in names
+        }
+        self.template_names = frozenset(names)
+        self._rendered.clear()
+        self._watch_templates()
+
+    def render_template(self, name):
+        """
+        Render the given template with the `render_keys` and get back a
+        tuple with the utf-8 encoded output and its ETag (None if the
+        render cache is disabled).
+
+        The output is cached while the `render_keys` don't change and the
+        template is up to date.
+
+        :param name: the name of the template to render
+        :type name: str
+        """
+
+        cached = self._rendered.get(name)
+        if cached is not None:
+            keys, template, body, etag = cached
+            if keys == self.render_keys and (
+                    self.notifier is not None or template.is_up_to_date):
+                return body, etag
+
+        template = self.environment.get_template(name)
+        body = template.render(**self.render_keys).encode('utf-8')
+        if not getattr(self.config, 'render_cache', False):
+            return body, None
+
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        self._rendered[name] = (
+            _snapshot(self.render_keys), template, body, etag
+        )
+        return body, etag
+
+    def precompile_templates(self):
+        """
+        Load every template in the template paths so they are compiled
+        before the first request and not while serving it. See
+        :func:`~mamba.core.templating.warm`
+
+        .. admonition:: Notice
+
+            The compiled templates are kept in the environment cache so
+            the `cache_size` should be big enough to hold all of them
+
+        :returns: the number of compiled templates
+        """
+
+        if self.template_index is None:
+            self.build_template_index()
+
+        return templating.warm(self.environment, self.template_names)
+
+    def _watch_templates(self):
+        """
+        Watch the template paths so the template index is refreshed when
+        they change, it does nothing if we are not in GNU/Linux or we are
+        watching them already
+        """
+
+        if not GNU_LINUX or self.notifier is not None:
+            return
+
+        paths = [
+            filepath.FilePath(path) for path in self.template_paths
+            if filepath.os.path.isdir(path)
+        ]
+        if not paths:
+            return
+
+        self.notifier = inotify.INotify()
+        self.notifier.startReading()
+        for path in paths:
             try:
-                template = templating.Template(
-                    self.environment, template='index.html'
+                self.notifier.watch(
+                    path,
+                    mask=(
+                        inotify.IN_CREATE | inotify.IN_DELETE |
+                        inotify.IN_MODIFY | inotify.IN_MOVED_FROM |
+                        inotify.IN_MOVED_TO
+                    ),
+                    autoAdd=True,
+                    recursive=True,
+                    callbacks=[self._notify_templates]
                 )
-                return template.render(**self.render_keys).encode('utf-8')
-            except templating.TemplateNotFound:
-                pass
+            except INotifyError:
+                log.msg('Can not watch templates in {}'.format(path.path))
 
-        template = templating.Template(
-            self.environment,
-            template='root_page.html'
-        )
-        return template.render(**self.render_keys).encode('utf-8')
+    def _notify_templates(self, ignore, file_path, mask):
+        """Invalidate the template index and the rendered templates
+        """
+
+        self.template_index = None
+        self._rendered.clear()
 
     def insert_stylesheets(self):
         """Insert stylesheets into the HTML
@@ -202,3 +321,18 @@ class Resource(TwistedResource):
         """
 
         self.template_paths + list(paths)
+
+
+def _snapshot(value):
+    """
+    Copy the dicts and lists of the render keys so we can find if they
+    changed later, the rest of the objects are not copied
+    """
+
+    if isinstance(value, dict):
+        return {key: _snapshot(item) for key, item in value.iteritems()}
+
+    if isinstance(value, list):
+        return [_snapshot(item) for item in value]
+
+    return value
@@ -15,9 +15,22 @@ import os
 from inspect import getframeinfo, currentframe
 
 from jinja2 import Environment, PackageLoader, FileSystemLoader
-from jinja2 import TemplateNotFound
+from jinja2 import TemplateNotFound, TemplateSyntaxError
+from jinja2 import FileSystemBytecodeCache
+
+from twisted.python import log
 
 from mamba.http import headers
+from mamba.utils.config import Application
+
+
+MAMBA_TEMPLATES = '{}/templates/jinja'.format(
+    os.path.dirname(__file__).rsplit(os.sep, 1)[0]
+)
+BYTECODE_CACHE_PATH = os.path.join('application', '.cache', 'templates')
+
+_environments = {}
+_bytecode_caches = {}
 
 
 class TemplateError(Exception):
@@ -30,6 +43,139 @@ class NotConfigured(TemplateError):
     """
 
 
+class BytecodeCache(FileSystemBytecodeCache):
+    """
+    I am a :class:`jinja2.FileSystemBytecodeCache` that creates my directory
+    if it is removed and logs the errors storing the compiled templates
+    instead of breaking the render of the template
+    """
+
+    def dump_bytecode(self, bucket):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            FileSystemBytecodeCache.dump_bytecode(self, bucket)
+        except (IOError, OSError) as error:
+            log.msg('Template bytecode can not be stored: {}'.format(error))
+
+
+def autoescape_html(name):
+    """Autoescape function for Jinja2, only HTML templates are escaped
+    """
+
+    return name.rsplit('.', 1)[1] == 'html' if name is not None else False
+
+
+def bytecode_cache(autoescape=False):
+    """
+    Get back the :class:`~mamba.core.templating.BytecodeCache` that stores the
+    compiled templates under the `application/.cache/templates` directory,
+    the cache is disabled (and we return None) if we are not in a mamba
+    application directory or the `template_bytecode_cache` application
+    option is set to false
+
+    The compiled code depends on the autoescape option of the environment
+    so there is a different set of files for every autoescape option.
+
+    :param autoescape: the autoescape option of the environment
+    """
+
+    if not getattr(Application(), 'template_bytecode_cache', True):
+        return None
+
+    if not os.path.isdir('application'):
+        return None
+
+    if callable(autoescape):
+        variant = autoescape.__name__
+    else:
+        variant = 'on' if autoescape else 'off'
+
+    path = os.path.abspath(BYTECODE_CACHE_PATH)
+    key = (path, variant)
+    if key not in _bytecode_caches:
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        except OSError as error:
+            log.msg('Template bytecode cache disabled: {}'.format(error))
+            return None
+
+        _bytecode_caches[key] = BytecodeCache(
+            path, '__mamba_{}_%s.cache'.format(variant)
+        )
+
+    return _bytecode_caches[key]
+
+
+def get_environment(
+        search_paths=None, package=None, cache_size=50, autoescape=False):
+    """
+    Get back the process wide Jinja2 environment for the given search paths
+    (or package templates) so the compiled templates are shared between all
+    the objects that render them. The environments use the
+    :func:`~mamba.core.templating.bytecode_cache` if it is available.
+
+    :param search_paths: the file system paths to load the templates from
+    :type search_paths: list
+    :param package: a tuple with the package name and the templates path
+                    inside the package to load the templates from
+    :type package: tuple
+    :param cache_size: the size of the templates cache of the environment
+    :type cache_size: int
+    :param autoescape: the autoescape option of the environment
+    """
+
+    if search_paths is not None:
+        search_paths = tuple(os.path.abspath(path) for path in search_paths)
+
+    key = (search_paths, package, cache_size, autoescape)
+    env = _environments.get(key)
+    if env is None:
+        if package is not None:
+            loader = PackageLoader(*package)
+        else:
+            loader = FileSystemLoader(list(search_paths))
+
+        env = Environment(
+            autoescape=autoescape,
+            cache_size=cache_size,
+            loader=loader,
+            bytecode_cache=bytecode_cache(autoescape)
+        )
+        _environments[key] = env
+
+    return env
+
+
+def warm(env, names=None):
+    """
+    Compile the given templates (or all the templates of the environment)
+    so they are in the environment cache and in its bytecode cache (if
+    any). Templates with syntax errors are logged and skipped.
+
+    :param env: the Jinja2 environment
+    :type env: :class:`jinja2.Environment`
+    :param names: the names of the templates to compile
+    :type names: list
+    :returns: the number of compiled templates
+    """
+
+    if names is None:
+        names = env.list_templates()
+
+    compiled = 0
+    for name in sorted(names):
+        try:
+            env.get_template(name)
+            compiled += 1
+        except TemplateSyntaxError as error:
+            log.msg('Template {} can not be compiled: {}'.format(name, error))
+
+    return compiled
+
+
 class MambaTemplate(object):
     """
     This class loads templates from the Mamba package and is used internally
@@ -43,8 +189,7 @@ class MambaTemplate(object):
 
     def __init__(self, env=None, template=None):
         if env is None:
-            loader = PackageLoader('mamba', 'templates/jinja')
-            self.env = Environment(loader=loader)
+            self.env = get_environment(package=('mamba', 'templates/jinja'))
         else:
             self.env = env
 
@@ -92,12 +237,7 @@ class Template(object):
         self.template = template
         self.options = kargs
         self._header = headers.Headers()
-        self.search_paths = [
-            'application/view/templates',
-            '{}/templates/jinja'.format(
-                os.path.dirname(__file__).rsplit(os.sep, 1)[0]
-            )
-        ]
+        self.search_paths = ['application/view/templates', MAMBA_TEMPLATES]
         if controller is not None:
             self.search_paths.append(
                 'application/view/{}'.format(controller.name)
@@ -115,27 +255,28 @@ class Template(object):
             template = self.template
 
         if self.env is None:
-            self.env = Environment(
-                autoescape=lambda name: (
-                    name.rsplit('.', 1)[1] == 'html'
-                    if name is not None else False
-                ),
-                cache_size=self.cache_size,
-                loader=FileSystemLoader(self.search_paths)
+            self.env = get_environment(
+                self.search_paths, cache_size=self.cache_size,
+                autoescape=autoescape_html
             )
 
-        for arg, value in kwargs.iteritems():
-            if hasattr(self.env, arg):
-                setattr(self.env, arg, value)
+        env = self.env
+        overrides = [arg for arg in kwargs if hasattr(env, arg)]
+        if overrides:
+            # don't modify the shared environment, the overlay gets no
+            # caches as the compiled templates depend on the overrides
+            env = env.overlay(cache_size=0, bytecode_cache=None)
+            for arg in overrides:
+                setattr(env, arg, kwargs[arg])
 
         if template is not None:
             try:
-                tpl = self.env.get_template(template)
+                tpl = env.get_template(template)
             except TemplateNotFound:
                 if self.controller is None:
                     raise
                 try:
-                    tpl = self.env.get_template(template)
+                    tpl = env.get_template(template)
                 except TemplateNotFound:
                     raise TemplateNotFound('{} template not found'.format(
                         template)
@@ -151,7 +292,7 @@ class Template(object):
             for key, value in self.controller.render_keys.iteritems():
                 kwargs[key] = value
 
-            return self.env.get_template(template).render(**kwargs)
+            return env.get_template(template).render(**kwargs)
 
         raise NotConfigured(
             'Template is not configured. Missing controller parameter at '
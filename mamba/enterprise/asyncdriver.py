@@ -0,0 +1,208 @@
+# -*- test-case-name: mamba.test.test_asyncdriver -*-
+# Copyright (c) 2012 Oscar Campos <oscar.campos@member.fsf.org>
+# See LICENSE for more details
+
+"""
+.. module:: asyncdriver
+    :platform: Unix, Windows
+    :synopsis: Non blocking database driver that runs in the reactor
+
+.. moduleauthor:: Oscar Campos <oscar.campos@member.fsf.org>
+
+"""
+
+from datetime import datetime, date, time, timedelta
+
+from storm.uri import URI
+from storm.expr import Expr, State
+from storm.variables import Variable
+from storm.database import convert_param_marks
+from twisted.internet import defer
+from twisted.python import log
+
+from mamba.utils import config
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+try:
+    from txpostgres import txpostgres
+except ImportError:
+    txpostgres = None
+
+
+class AsyncDriver(object):
+    """
+    I run SQL statements on non blocking PostgreSQL connections straight
+    from the reactor, without the thread hop of the Storm transactor.
+
+    Storm expressions are compiled with the Storm PostgreSQL compiler so
+    the models can build their statements as usual. I need `txpostgres`
+    to be installed, when it is not (or the database is not PostgreSQL)
+    :meth:`from_config` returns None and the models use the thread pool.
+
+    :param uri: the Storm URI of the database
+    :type uri: str
+    :param size: the number of connections in the pool
+    :type size: int
+    :param pool: a txpostgres like connection pool, used for testing
+    """
+
+    schemes = ('postgres',)
+
+    def __init__(self, uri=None, size=None, pool=None):
+        cfg = config.Database()
+        self.uri = URI(uri if uri is not None else cfg.uri)
+        self.size = (
+            size if size is not None else getattr(cfg, 'async_pool_size', 10)
+        )
+        self.pool = pool
+        self.started = False
+        self._waiting = []
+
+    @classmethod
+    def from_config(cls):
+        """
+        Return back a driver for the configured database if the `mode`
+        option of the database config is 'async' and the database can be
+        used without blocking, None otherwise
+        """
+
+        cfg = config.Database()
+        if getattr(cfg, 'mode', 'threaded') != 'async':
+            return None
+
+        scheme = URI(cfg.uri).scheme
+        if scheme not in cls.schemes or txpostgres is None:
+            log.msg(
+                'Async database mode is not available for {}, using the '
+                'thread pool'.format(scheme)
+            )
+            return None
+
+        return cls()
+
+    def start(self):
+        """Connect the pool, returns a Deferred that fires when it's ready
+        """
+
+        if self.pool is None:
+            # the Storm PostgreSQL backend is imported lazily so the users
+            # of other databases don't load it (and psycopg2)
+            from storm.databases.postgres import make_dsn
+            self.pool = txpostgres.ConnectionPool(
+                None, make_dsn(self.uri), min=self.size
+            )
+
+        return self.pool.start().addCallbacks(self._started, self._failed)
+
+    def stop(self):
+        """Close the connections of the pool
+        """
+
+        if self.started:
+            self.started = False
+            self.pool.close()
+
+    def ready(self):
+        """
+        Return back a Deferred that fires with the pool once it's connected
+        """
+
+        if self.started:
+            return defer.succeed(self.pool)
+
+        waiter = defer.Deferred()
+        self._waiting.append(waiter)
+        if len(self._waiting) == 1:
+            self.start()
+
+        return waiter
+
+    def _started(self, _):
+        self.started = True
+        waiting, self._waiting = self._waiting, []
+        for waiter in waiting:
+            waiter.callback(self.pool)
+
+    def _failed(self, failure):
+        waiting, self._waiting = self._waiting, []
+        for waiter in waiting:
+            waiter.errback(failure)
+
+    def compile(self, statement, params=()):
+        """
+        Compile the given Storm expression (or SQL string with ? marks)
+        into a statement and parameters that the driver understands
+        """
+
+        if isinstance(statement, Expr):
+            from storm.databases.postgres import compile
+            state = State()
+            statement = compile(statement, state)
+            params = state.parameters
+
+        statement = convert_param_marks(statement, '?', '%s')
+        return statement, list(self._to_database(params))
+
+    @staticmethod
+    def _to_database(params):
+        """Convert the parameters like the Storm PostgreSQL backend does
+        """
+
+        for param in params:
+            if isinstance(param, Variable):
+                param = param.get(to_db=True)
+            if isinstance(param, (datetime, date, time, timedelta)):
+                yield str(param)
+            elif isinstance(param, str) and psycopg2 is not None:
+                yield psycopg2.Binary(param)
+            else:
+                yield param
+
+    def run_query(self, statement, params=()):
+        """
+        Run a statement that returns rows
+
+        :returns: a Deferred that fires with the list of rows
+        """
+
+        statement, params = self.compile(statement, params)
+        return self.ready().addCallback(
+            lambda pool: pool.runQuery(statement, params)
+        )
+
+    def run_operation(self, statement, params=()):
+        """
+        Run a statement that doesn't return rows in its own transaction
+
+        :returns: a Deferred that fires with the number of affected rows
+        """
+
+        statement, params = self.compile(statement, params)
+
+        def interaction(cursor):
+            d = cursor.execute(statement, params)
+            return d.addCallback(lambda cursor: cursor.rowcount)
+
+        return self.ready().addCallback(
+            lambda pool: pool.runInteraction(interaction)
+        )
+
+    def run_insert(self, insert):
+        """
+        Run the given Storm Insert expression
+
+        :returns: a Deferred that fires with the values of the primary key
+                  columns of the inserted row
+        """
+
+        from storm.databases.postgres import Returning
+        return self.run_query(Returning(insert)).addCallback(
+            lambda rows: rows[0]
+        )
+
+
+__all__ = ['AsyncDriver']
@@ -0,0 +1,429 @@
+# -*- test-case-name: mamba.test.test_cache -*-
+# Copyright (c) 2012 Oscar Campos <oscar.campos@member.fsf.org>
+# See LICENSE for more details
+
+"""
+.. module:: cache
+    :platform: Unix, Windows
+    :synopsis: Identity cache backends for Model reads
+
+.. moduleauthor:: Oscar Campos <oscar.campos@member.fsf.org>
+
+"""
+
+import os
+import time
+import marshal
+import sqlite3
+import threading
+from decimal import Decimal
+from datetime import datetime, date, time as dtime, timedelta
+
+from mamba.core.decorators import LRUCache
+
+SHARED_CACHE_PATH = os.path.join('application', '.cache', 'models.db')
+
+
+def _encode(value):
+    """
+    Return back a (type, primitive value) pair for the given database
+    value, raises TypeError if the value can't be stored
+    """
+
+    if value is None:
+        return 'value', None
+
+    # bool goes first as it is an int too
+    for kind in (bool, int, long, float, str, unicode):
+        if isinstance(value, kind):
+            return 'value', kind(value)
+
+    if isinstance(value, Decimal):
+        return 'decimal', str(value)
+
+    if isinstance(value, (datetime, dtime)) and value.tzinfo is not None:
+        raise TypeError('{!r} has a timezone'.format(value))
+
+    if isinstance(value, datetime):
+        return 'datetime', value.timetuple()[:6] + (value.microsecond,)
+
+    if isinstance(value, date):
+        return 'date', (value.year, value.month, value.day)
+
+    if isinstance(value, dtime):
+        return 'time', (
+            value.hour, value.minute, value.second, value.microsecond
+        )
+
+    if isinstance(value, timedelta):
+        return 'timedelta', (value.days, value.seconds, value.microseconds)
+
+    if isinstance(value, (buffer, bytearray)):
+        return 'buffer', str(value)
+
+    if isinstance(value, (list, tuple)):
+        return 'list', tuple(_encode(item) for item in value)
+
+    raise TypeError('{!r} can not be cached'.format(value))
+
+
+_decoders = {
+    'value': lambda value: value,
+    'decimal': Decimal,
+    'datetime': lambda value: datetime(*value),
+    'date': lambda value: date(*value),
+    'time': lambda value: dtime(*value),
+    'timedelta': lambda value: timedelta(*value),
+    'buffer': buffer,
+    'list': lambda value: [_decode(item) for item in value]
+}
+
+
+def _decode(pair):
+    """Return back the database value of the given (type, value) pair
+    """
+
+    kind, value = pair
+    return _decoders[kind](value)
+
+
+def dump_snapshot(snapshot):
+    """
+    Return back the given snapshot (a tuple of database values) as a
+    marshal string of primitive values, unlike a pickle loading it never
+    runs any code. Raises TypeError if a value can't be stored
+    """
+
+    return marshal.dumps(tuple(_encode(value) for value in snapshot), 2)
+
+
+def load_snapshot(data):
+    """Return back the snapshot stored in the given marshal string
+    """
+
+    return tuple(_decode(pair) for pair in marshal.loads(data))
+
+
+class LocalCache(object):
+    """
+    I am an in-process cache for model snapshots.
+
+    I wrap a :class:`~mamba.core.decorators.LRUCache` with a lock because
+    the entries are invalidated from the database pool threads while they
+    are read and stored from the reactor thread.
+
+    Every invalidation bumps the generation of the key, a read records
+    the generation before it queries the database and its snapshot is
+    not stored if the key has been invalidated meanwhile.
+
+    :param size: the max size of the cache in MB, 0 means unlimited
+    :type size: int
+    :param ttl: the time to live of the entries in seconds, 0 means the
+                entries never expire (only safe if nothing else writes
+                the tables of the cached models)
+    :type ttl: int
+    """
+
+    # the lookups are cheap so they run right in the reactor thread
+    blocking = False
+    # forget the generations when there are more than `max_generations`
+    max_generations = 10000
+
+    def __init__(self, size=16, ttl=60, clock=time.time):
+        self._lru = LRUCache(size, ttl, clock)
+        self._lock = threading.Lock()
+        self._generations = {}
+        self._counter = 0
+        self._floor = 0
+
+    def get(self, key):
+        """Return back the snapshot stored for key or None
+        """
+
+        with self._lock:
+            return self._lru.get(key)
+
+    def generation(self, key):
+        """Return back the invalidation generation of key
+        """
+
+        with self._lock:
+            return self._generations.get(key, self._floor)
+
+    def set(self, key, snapshot, generation=None):
+        """
+        Store the snapshot for key, if a generation is given the snapshot
+        is stored only if key has not been invalidated since then
+        """
+
+        with self._lock:
+            if generation is not None and generation != (
+                    self._generations.get(key, self._floor)):
+                return
+
+            self._lru.set(key, snapshot)
+
+    def discard(self, key):
+        """Remove the snapshot stored for key if any
+        """
+
+        with self._lock:
+            self._lru.discard(key)
+
+            self._counter += 1
+            if len(self._generations) >= self.max_generations:
+                # the generations always grow so the pending reads of
+                # the forgotten keys are just ignored
+                self._generations.clear()
+                self._floor = self._counter
+            self._generations[key] = self._counter
+
+    def clear(self):
+        """Remove all the snapshots
+        """
+
+        with self._lock:
+            self._lru.clear()
+
+    def stats(self):
+        """Return back a dict with the cache counters
+        """
+
+        with self._lock:
+            return self._lru.stats()
+
+
+class SharedCache(object):
+    """
+    I am a cache for model snapshots shared by all the worker processes
+    running in the same host.
+
+    The snapshots are stored into a SQLite file so an invalidation made
+    in any process is seen by all of them. Every thread uses its own
+    connection to the file. The invalidation generations of the keys are
+    stored in the file too, see :class:`LocalCache`.
+
+    The snapshots are marshalled as primitive values (see
+    :func:`dump_snapshot`), the snapshots with values of other types are
+    not stored. As the file can be locked by the other processes I am
+    `blocking` and the models use me from the database pool threads.
+
+    :param path: the path of the cache file, by default it is stored
+                 under the `application/.cache` directory so every
+                 application has its own file
+    :type path: str
+    :param size: the max size of the stored snapshots in MB, 0 means
+                 unlimited
+    :type size: int
+    :param ttl: the time to live of the entries in seconds, 0 means the
+                entries never expire (only safe if nothing else writes
+                the tables of the cached models)
+    :type ttl: int
+    """
+
+    blocking = True
+    # check the size of the file every `shrink_every` stores
+    shrink_every = 100
+
+    def __init__(self, path=None, size=16, ttl=60, clock=time.time):
+        if path is None:
+            path = os.path.abspath(SHARED_CACHE_PATH)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._stores = 0
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        """Return back the connection to the cache file for this thread
+        """
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots ('
+                '    key TEXT PRIMARY KEY, value BLOB, expires REAL'
+                ')'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS generations ('
+                '    key TEXT PRIMARY KEY, generation INTEGER'
+                ')'
+            )
+            self._local.connection = connection
+
+        return connection
+
+    def get(self, key):
+        """Return back the snapshot stored for key or None
+        """
+
+        row = self.connection.execute(
+            'SELECT value, expires FROM snapshots WHERE key = ?',
+            (repr(key),)
+        ).fetchone()
+
+        if row is None or (row[1] is not None and row[1] <= self.clock()):
+            self.misses += 1
+            return None
+
+        try:
+            snapshot = load_snapshot(str(row[0]))
+        except (ValueError, EOFError, TypeError, KeyError):
+            # written by an older version of the cache
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return snapshot
+
+    def generation(self, key):
+        """Return back the invalidation generation of key
+        """
+
+        row = self.connection.execute(
+            'SELECT generation FROM generations WHERE key = ?', (repr(key),)
+        ).fetchone()
+
+        return 0 if row is None else row[0]
+
+    def set(self, key, snapshot, generation=None):
+        """
+        Store the snapshot for key, if a generation is given the snapshot
+        is stored only if key has not been invalidated since then
+        """
+
+        try:
+            data = dump_snapshot(snapshot)
+        except TypeError:
+            return
+
+        expires = self.clock() + self.ttl if self.ttl else None
+        values = (repr(key), sqlite3.Binary(data), expires)
+
+        if generation is None:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)', values
+            )
+        else:
+            # check and store in a single statement so no invalidation
+            # can sneak in between
+            self.connection.execute(
+                'INSERT OR REPLACE INTO snapshots SELECT ?, ?, ? WHERE '
+                'COALESCE((SELECT generation FROM generations '
+                'WHERE key = ?), 0) = ?', values + (repr(key), generation)
+            )
+
+        self._stores += 1
+        if self._stores % self.shrink_every == 0:
+            self.shrink()
+
+    def discard(self, key):
+        """Remove the snapshot stored for key if any
+        """
+
+        self.connection.execute(
+            'INSERT OR REPLACE INTO generations VALUES (?, COALESCE(('
+            'SELECT generation FROM generations WHERE key = ?), 0) + 1)',
+            (repr(key), repr(key))
+        )
+        self.connection.execute(
+            'DELETE FROM snapshots WHERE key = ?', (repr(key),)
+        )
+
+    def clear(self):
+        """Remove all the snapshots
+        """
+
+        self.connection.execute('DELETE FROM snapshots')
+
+    def shrink(self):
+        """
+        Remove the expired snapshots and the oldest ones until the stored
+        snapshots fit in the cache size
+        """
+
+        connection = self.connection
+        connection.execute(
+            'DELETE FROM snapshots WHERE expires <= ?', (self.clock(),)
+        )
+
+        if self.size == 0:
+            return
+
+        limit = self.size * 1024 * 1024
+        total = connection.execute(
+            'SELECT TOTAL(LENGTH(value)) FROM snapshots'
+        ).fetchone()[0]
+
+        if total > limit:
+            # the rowid of the replaced rows grows so the lower are older
+            rows = connection.execute(
+                'SELECT rowid, LENGTH(value) FROM snapshots ORDER BY rowid'
+            )
+            oldest = []
+            for rowid, size in rows:
+                if total <= limit:
+                    break
+                oldest.append((rowid,))
+                total -= size
+
+            connection.executemany(
+                'DELETE FROM snapshots WHERE rowid = ?', oldest
+            )
+
+    def stats(self):
+        """Return back a dict with the cache counters
+        """
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': self.connection.execute(
+                'SELECT COUNT(*) FROM snapshots').fetchone()[0]
+        }
+
+
+backends = {
+    'local': LocalCache,
+    'shared': SharedCache
+}
+
+
+def make_cache(options):
+    """
+    Build the cache backend for the given `__cache__` options of a model.
+
+    The `backend` option can be 'local' (the default), 'shared' or an
+    object that provides get, set and discard methods (and optionally the
+    generation method, see :class:`LocalCache`).
+
+    :param options: the cache options (ttl, size, backend and path)
+    :type options: dict
+    """
+
+    options = dict(options)
+    backend = options.pop('backend', 'local')
+    if not isinstance(backend, basestring):
+        return backend
+
+    try:
+        factory = backends[backend]
+    except KeyError:
+        raise ValueError('Unknown cache backend {}'.format(backend))
+
+    if factory is LocalCache:
+        options.pop('path', None)
+
+    return factory(**options)
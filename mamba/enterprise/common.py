@@ -11,13 +11,42 @@
 
 """
 
-from storm.expr import Undef
+import binascii
+from decimal import Decimal
+from datetime import datetime, date, time, timedelta
+
+from storm.expr import Undef, And, Or, Select
+from storm.info import get_cls_info
 from storm import variables, properties
 from storm.locals import create_database, Store
 
 from mamba.utils import config
 
 
+def keyset_after(primary, values):
+    """
+    Return back the condition that selects the rows whose primary key goes
+    after the given (database) values, it is used to page big tables by
+    their primary key instead of using OFFSET
+
+    :param primary: the primary key columns
+    :param values: the database values of the primary key of the last row
+    """
+
+    variables = []
+    for column, value in zip(primary, values):
+        variable = column.variable_factory()
+        variable.set(value, from_db=True)
+        variables.append(variable)
+
+    return Or(*[
+        And(*([
+            primary[j] == variables[j] for j in range(i)
+        ] + [primary[i] > variables[i]]))
+        for i in range(len(primary))
+    ])
+
+
 class NativeEnumVariable(variables.Variable):
     __slots__ = ("_map", "_reverse_map")
 
@@ -82,45 +111,210 @@ class CommonSQL(object):
     """I do nothing, my only purpse is serve as dummy object
     """
 
+    # max number of parameters in a single statement
+    max_bulk_params = 32766
+
+    # number of rows of every INSERT statement of the data dumps
+    dump_batch_size = 500
+
     def insert_data(self):
         """
         Return the SQL syntax needed to insert the data already present
         in the table.
         """
 
-        store = Store(create_database(config.Database().uri))
-        registers = []
-        rows = store.find(self.model.__class__)
-        fields = [
-            r._detect_attr_name(self.model.__class__) for r in
-            self.model._storm_columns.keys()
+        return ''.join(self.iter_insert_data())
+
+    def iter_insert_data(self, batch_size=None, progress=None, uri=None):
+        """
+        Generate the SQL syntax needed to insert the data already present
+        in the table, one multi-row INSERT statement every `batch_size`
+        rows.
+
+        The rows are read in pages ordered by the primary key, every page
+        starts after the last key of the previous one (keyset pagination)
+        so the table is never loaded in memory at once.
+
+        :param batch_size: the number of rows of every INSERT statement
+        :type batch_size: int
+        :param progress: callable that is called with the number of rows
+                         dumped so far after every statement
+        :param uri: the URI of the database to read the data from (like a
+                    shard), by default the configured database
+        :type uri: str
+        """
+
+        if batch_size is None:
+            batch_size = self.dump_batch_size
+
+        cls_info = get_cls_info(self.model.__class__)
+        columns = cls_info.columns
+        primary = cls_info.primary_key
+        # Column overloads ==, so we can't use columns.index here
+        keys = [
+            index for column in primary
+            for index, other in enumerate(columns) if other is column
         ]
-        for r in rows:
-            tmp_row = {}
-            for field in fields:
-                tmp_row[field] = getattr(r, field)
-            registers.append(tmp_row)
-
-        if self.__class__.__name__ == 'MySQL':
-            commas = '`'
-        else:
-            commas = "'"
-
-        query = ''
-        for register in registers:
-            query += ('INSERT INTO {}{}{} ({}) VALUES ({});\n'.format(
-                commas,
-                self.model.__storm_table__,
-                commas,
-                ', '.join(register.keys()),
-                ', '.join([(
-                    str(field) if type(field) is not unicode
-                    else "'{}'".format(field))
-                    for field in register.values()
-                ])
+        insert = 'INSERT INTO {} ({}) VALUES '.format(
+            self._dump_table_name(),
+            ', '.join(self._quote(column.name) for column in columns)
+        )
+
+        store = Store(create_database(
+            uri if uri is not None else config.Database().uri
+        ))
+        try:
+            last = None
+            count = 0
+            while True:
+                rows = store.execute(Select(
+                    columns,
+                    Undef if last is None else keyset_after(primary, last),
+                    order_by=primary,
+                    limit=batch_size
+                )).get_all()
+                if not rows:
+                    break
+
+                yield insert + ', '.join(
+                    '({})'.format(', '.join(self._literal(v) for v in row))
+                    for row in rows
+                ) + ';\n'
+
+                count += len(rows)
+                if progress is not None:
+                    progress(count)
+
+                if len(rows) < batch_size:
+                    break
+
+                last = [rows[-1][index] for index in keys]
+        finally:
+            store.close()
+
+    def _dump_table_name(self):
+        """Return back the quoted table name used in the data dumps
+        """
+
+        return "'{}'".format(self.model.__storm_table__)
+
+    def _literal(self, value):
+        """
+        Return back the given database value as an UTF-8 encoded SQL
+        literal
+        """
+
+        if value is None:
+            return 'NULL'
+
+        if isinstance(value, bool):
+            return '1' if value else '0'
+
+        if isinstance(value, float):
+            return repr(value)
+
+        if isinstance(value, (int, long, Decimal)):
+            return str(value)
+
+        if isinstance(value, (buffer, bytearray)):
+            return self._binary_literal(str(value))
+
+        if isinstance(value, (datetime, date, time, timedelta)):
+            value = unicode(value)
+        elif isinstance(value, str):
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                return self._binary_literal(value)
+
+        return "'{}'".format(self._escape(unicode(value)).encode('utf-8'))
+
+    def _binary_literal(self, value):
+        """Return back the SQL literal for the given binary string
+        """
+
+        return "X'{}'".format(binascii.hexlify(value))
+
+    def _escape(self, value):
+        """Escape the given string to be used inside an SQL literal
+        """
+
+        return value.replace("'", "''")
+
+    def insert_many(self, columns, rows):
+        """
+        Return back a list of (statement, params) tuples with the multi-row
+        INSERT statements needed to insert the given rows in the table.
+
+        :param columns: the names of the columns to insert
+        :type columns: list
+        :param rows: sequences of values (or Storm variables) in the same
+                     order than the columns
+        :type rows: list
+        """
+
+        statements = []
+        marks = '({})'.format(', '.join('?' * len(columns)))
+        for chunk in self._bulk_chunks(columns, rows):
+            statements.append((
+                'INSERT INTO {} ({}) VALUES {}'.format(
+                    self._quote(self.model.__storm_table__),
+                    ', '.join(self._quote(name) for name in columns),
+                    ', '.join([marks] * len(chunk))
+                ),
+                [value for row in chunk for value in row]
             ))
 
-        return query
+        return statements
+
+    def update_many(self, columns, primary, rows):
+        """
+        Return back a list of (statement, params) tuples with the UPDATE
+        statements needed to update the given rows, one per row. There is
+        nothing to update if all the columns are part of the primary key.
+
+        :param columns: the names of the columns to update
+        :type columns: list
+        :param primary: the names of the primary key columns, they must be
+                        present in columns
+        :type primary: list
+        :param rows: sequences of values (or Storm variables) in the same
+                     order than the columns
+        :type rows: list
+        """
+
+        keys = [columns.index(name) for name in primary]
+        others = [i for i in range(len(columns)) if i not in keys]
+        if not others:
+            return []
+
+        quote = self._quote
+        statement = 'UPDATE {} SET {} WHERE {}'.format(
+            quote(self.model.__storm_table__),
+            ', '.join('{} = ?'.format(quote(columns[i])) for i in others),
+            ' AND '.join('{} = ?'.format(quote(columns[i])) for i in keys)
+        )
+
+        return [
+            (statement, [row[i] for i in others] + [row[i] for i in keys])
+            for row in rows
+        ]
+
+    def _bulk_chunks(self, columns, rows):
+        """
+        Split the rows in chunks that don't use more than
+        :attr:`max_bulk_params` parameters
+        """
+
+        size = max(1, self.max_bulk_params // max(1, len(columns)))
+        for i in xrange(0, len(rows), size):
+            yield rows[i:i + size]
+
+    def _quote(self, name):
+        """Quote the given table or column name
+        """
+
+        return name
 
     def _parse_float(self, column):
         """
@@ -135,7 +329,7 @@ class CommonSQL(object):
         if column.__class__.__name__ == 'Float':
             column_type = 'real'
         else:
-            column_type = 'double precission'
+            column_type = 'double precision'
 
         return column_type
 
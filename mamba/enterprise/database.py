@@ -11,13 +11,23 @@
 
 """
 
+import gzip
+import time
 import datetime
+import functools
+import itertools
+import threading
+from collections import deque
 
 from storm import properties
 from storm.database import URI
 from storm.expr import Undef, Column
+from storm.exceptions import DisconnectionError, OperationalError
 from storm.zope.interfaces import IZStorm
 from storm.zope.zstorm import global_zstorm
+from storm.twisted.transact import Transactor
+from twisted.python import log
+from twisted.internet import defer
 from twisted.python.monkey import MonkeyPatcher
 from twisted.python.threadpool import ThreadPool
 from zope.component import provideUtility, getUtility
@@ -27,19 +37,488 @@ from mamba.utils import config
 from mamba.enterprise.mysql import MySQL
 from mamba.enterprise.sqlite import SQLite
 from mamba.enterprise.common import CommonSQL
+from mamba.enterprise.sharding import ShardMap
+from mamba.enterprise.querycache import QueryCache
+from mamba.enterprise.asyncdriver import AsyncDriver
 from mamba.enterprise.postgres import PostgreSQL
 
 
+class DatabasePool(ThreadPool):
+    """
+    I am the thread pool used to run the database transactions.
+
+    I measure how long every task waits in the queue before a thread
+    picks it up so the :class:`~mamba.enterprise.database.PoolAutoscaler`
+    can decide when I am too small.
+
+    :param clock: callable that returns the current time in seconds
+    """
+
+    def __init__(self, minthreads=5, maxthreads=20, name=None,
+                 clock=time.time):
+        ThreadPool.__init__(self, minthreads, maxthreads, name)
+        self.clock = clock
+        self.tasks = 0
+        self._wait_total = 0.0
+        self._wait_count = 0
+        self._lock = threading.Lock()
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        queued = self.clock()
+
+        def timed(*args, **kw):
+            waited = self.clock() - queued
+            with self._lock:
+                self.tasks += 1
+                self._wait_total += waited
+                self._wait_count += 1
+            return func(*args, **kw)
+
+        ThreadPool.callInThreadWithCallback(
+            self, onResult, timed, *args, **kw
+        )
+
+    def take_waits(self):
+        """
+        Return back the total wait time and the number of the tasks
+        started since the last call and reset both counters
+        """
+
+        with self._lock:
+            waits = self._wait_total, self._wait_count
+            self._wait_total, self._wait_count = 0.0, 0
+
+        return waits
+
+    def stats(self):
+        """Return back a dict with the current state of the pool
+        """
+
+        team = getattr(self, '_team', None)
+        if team is None:
+            # Twisted < 15.5 ThreadPool keeps the threads in lists
+            busy, idle = len(self.working), len(self.waiters)
+            queue = self.q.qsize()
+        else:
+            stats = team.statistics()
+            busy, idle = stats.busyWorkerCount, stats.idleWorkerCount
+            queue = stats.backloggedWorkCount
+
+        return {
+            'min': self.min,
+            'max': self.max,
+            'workers': idle + busy,
+            'busy': busy,
+            'idle': idle,
+            'queue': queue,
+            'tasks': self.tasks
+        }
+
+
+class PoolAutoscaler(object):
+    """
+    I resize the database pool between the configured `min_threads` and
+    `max_threads` looking at its queue depth and the time that the tasks
+    wait before they get a thread.
+
+    When tasks are queued, or they waited more than `wait_target` seconds
+    on average, I raise the pool max by the size of the backlog (at least
+    one) and start the new threads right away. When the pool has had idle
+    threads and an empty queue for `idle_periods` checks in a row I lower
+    the max by half of the idle threads so they (and their database
+    connections) are released.
+
+    Every resize is recorded in :attr:`decisions`.
+
+    :param database: the database whose pool I have to resize
+    :type database: :class:`~mamba.enterprise.database.Database`
+    :param interval: seconds between checks
+    :type interval: float
+    :param clock: the reactor used to schedule the checks
+    """
+
+    wait_target = 0.05
+    idle_periods = 6
+    history = 50
+
+    def __init__(self, database, min_threads=None, max_threads=None,
+                 interval=5.0, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        cfg = config.Database()
+        self.database = database
+        self.min_threads = (
+            cfg.min_threads if min_threads is None else min_threads
+        )
+        self.max_threads = (
+            cfg.max_threads if max_threads is None else max_threads
+        )
+        self.interval = interval
+        self.clock = clock
+        self.decisions = deque(maxlen=self.history)
+        self._idle = 0
+        self._call = None
+
+    @property
+    def running(self):
+        """Return True if I am checking the pool
+        """
+
+        return self._call is not None
+
+    def start(self):
+        """Start checking the pool every interval seconds
+        """
+
+        if self._call is None:
+            self._call = self.clock.callLater(self.interval, self._tick)
+
+    def stop(self):
+        """Stop checking the pool
+        """
+
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+
+    def _tick(self):
+        self._call = self.clock.callLater(self.interval, self._tick)
+        try:
+            self.check()
+        except Exception:
+            log.err()
+
+    def check(self):
+        """
+        Look at the pool and resize it if needed, returns the new size
+        or None if the pool has not been resized
+        """
+
+        pool = self.database.pool
+        stats = pool.stats()
+        total, count = pool.take_waits()
+        wait = total / count if count else 0.0
+        size = pool.max
+
+        if stats['queue'] > 0 or wait > self.wait_target:
+            self._idle = 0
+            new_size = min(self.max_threads, size + max(1, stats['queue']))
+            reason = 'queue {} wait {:.3f}s'.format(stats['queue'], wait)
+        elif stats['idle'] > 0:
+            self._idle += 1
+            if self._idle < self.idle_periods:
+                return None
+
+            self._idle = 0
+            new_size = max(
+                self.min_threads, size - max(1, stats['idle'] // 2)
+            )
+            reason = '{} idle threads'.format(stats['idle'])
+        else:
+            self._idle = 0
+            return None
+
+        if new_size == size:
+            return None
+
+        self.database.adjust_poolsize(min(pool.min, new_size), new_size)
+        if new_size > size:
+            for _ in range(min(stats['queue'], new_size - size)):
+                pool.startAWorker()
+
+        self.decisions.append({
+            'time': time.time(),
+            'from': size,
+            'to': new_size,
+            'reason': reason
+        })
+        return new_size
+
+    def stats(self):
+        """Return back the pool stats and the last decisions
+        """
+
+        stats = self.database.pool.stats()
+        stats['decisions'] = list(self.decisions)
+        return stats
+
+
+class Replica(object):
+    """
+    I am a read replica of the database.
+
+    I have my own Storm store (registered in ZStorm as `name`) and my own
+    slice of threads, so slow or dead replicas don't use the threads of
+    the primary database pool.
+
+    :param database: the database that I am a replica of
+    :type database: :class:`~mamba.enterprise.database.Database`
+    :param name: the name of my ZStorm store
+    :type name: str
+    :param uri: the Storm URI of the replica
+    :type uri: str
+    :param pool: the thread pool for this replica
+    :type pool: :class:`twisted.python.threadpool.ThreadPool`
+    """
+
+    def __init__(self, database, name, uri, pool):
+        self.database = database
+        self.name = name
+        self.uri = uri
+        self.pool = pool
+        self.transactor = Transactor(pool)
+        self.healthy = True
+        self.failures = 0
+
+        getUtility(IZStorm).set_default_uri(name, uri)
+
+    def store(self):
+        """Returns the Store of this replica for the current thread
+        """
+
+        return getUtility(IZStorm).get(self.name)
+
+    def load(self):
+        """Return back the number of busy threads and queued tasks
+        """
+
+        if not isinstance(self.pool, DatabasePool):
+            return 0
+
+        stats = self.pool.stats()
+        return stats['busy'] + stats['queue']
+
+    def run(self, function, *args, **kwargs):
+        """
+        Run the given function in a transaction in my threads, the
+        :meth:`~mamba.enterprise.database.Database.store` calls made by the
+        function return back my store
+        """
+
+        return self.transactor.run(
+            self.database._routed, self, function, args, kwargs
+        )
+
+    def check(self):
+        """
+        Check that the replica answers, returns a Deferred that fires with
+        the health of the replica
+        """
+
+        return self.run(self._ping).addCallbacks(self.succeeded, self.failed)
+
+    def _ping(self):
+        self.store().execute('SELECT 1')
+
+    def succeeded(self, _=None):
+        """Mark the replica as healthy
+        """
+
+        if not self.healthy:
+            log.msg('Database replica {} is back'.format(self.name))
+
+        self.healthy = True
+        self.failures = 0
+        return True
+
+    def failed(self, failure):
+        """Mark the replica as unhealthy
+        """
+
+        if self.healthy:
+            log.msg('Database replica {} is down: {}'.format(
+                self.name, failure.getErrorMessage()
+            ))
+
+        self.healthy = False
+        self.failures += 1
+        return False
+
+
+def replica_pool(name, size):
+    """Return back a new thread pool for the replica of the given name
+    """
+
+    return DatabasePool(1, size, name)
+
+
+class ReplicaSet(object):
+    """
+    I route the read only transactions to the read replicas of the
+    database.
+
+    The replicas are picked with the given `policy`, that can be
+    'round_robin' or 'least_loaded' (the replica with less busy threads
+    and queued tasks). Every `interval` seconds I check the health of all
+    the replicas, the ones that are down are skipped until they answer
+    again. When no replica is healthy the reads go to the primary.
+
+    :param database: the database that owns the replicas
+    :type database: :class:`~mamba.enterprise.database.Database`
+    :param uris: the Storm URIs of the replicas
+    :type uris: list
+    :param policy: 'round_robin' or 'least_loaded'
+    :type policy: str
+    :param threads: the max number of threads of every replica
+    :type threads: int
+    :param interval: seconds between health checks
+    :type interval: float
+    :param clock: the reactor used to schedule the checks
+    :param pool_factory: callable that returns the thread pool of a
+                         replica given its name and its max threads
+    """
+
+    policies = ('round_robin', 'least_loaded')
+    _names = itertools.count()
+
+    def __init__(self, database, uris, policy='round_robin', threads=None,
+                 interval=10.0, clock=None, pool_factory=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown replica policy {}'.format(policy))
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        if pool_factory is None:
+            pool_factory = replica_pool
+
+        if threads is None:
+            threads = max(1, config.Database().max_threads // len(uris))
+
+        self.policy = policy
+        self.interval = interval
+        self.clock = clock
+        self.replicas = []
+        for uri in uris:
+            # ZStorm keeps the stores by name so they must be unique
+            name = 'mamba-replica-{}'.format(next(self._names))
+            self.replicas.append(
+                Replica(database, name, uri, pool_factory(name, threads))
+            )
+
+        self._next = 0
+        self._call = None
+
+    @classmethod
+    def from_config(cls, database):
+        """
+        Return back the replica set for the `replicas` option of the
+        database config or None if there are no replicas configured
+        """
+
+        cfg = config.Database()
+        uris = getattr(cfg, 'replicas', None)
+        if not uris:
+            return None
+
+        return cls(
+            database, uris,
+            getattr(cfg, 'replica_policy', 'round_robin'),
+            getattr(cfg, 'replica_threads', None),
+            getattr(cfg, 'replica_check_interval', 10.0)
+        )
+
+    @property
+    def running(self):
+        """Return True if I am checking the replicas
+        """
+
+        return self._call is not None
+
+    def start(self):
+        """Start the replica pools and the health checks
+        """
+
+        if self._call is None:
+            for replica in self.replicas:
+                replica.pool.start()
+            self._call = self.clock.callLater(self.interval, self._tick)
+
+    def stop(self):
+        """Stop the health checks and the replica pools
+        """
+
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+            for replica in self.replicas:
+                replica.pool.stop()
+
+    def _tick(self):
+        self._call = self.clock.callLater(self.interval, self._tick)
+        self.check()
+
+    def check(self):
+        """Check the health of all the replicas
+        """
+
+        for replica in self.replicas:
+            replica.check()
+
+    def choose(self):
+        """Return back the replica for the next read or None
+        """
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+
+        if self.policy == 'least_loaded':
+            return min(healthy, key=lambda replica: replica.load())
+
+        self._next = (self._next + 1) % len(healthy)
+        return healthy[self._next]
+
+    def stats(self):
+        """Return back a list with the state of every replica
+        """
+
+        return [{
+            'name': replica.name,
+            'healthy': replica.healthy,
+            'failures': replica.failures,
+            'load': replica.load()
+        } for replica in self.replicas]
+
+
 class Database(object):
     """
     Storm ORM database provider for Mamba.
 
+    If `auto_adjust_pool_size` is set in the database config, a
+    :class:`~mamba.enterprise.database.PoolAutoscaler` is started with the
+    database and it is available in :attr:`autoscaler`.
+
+    If the `mode` of the database config is 'async' and the database
+    supports it, the models run their queries with the
+    :class:`~mamba.enterprise.asyncdriver.AsyncDriver` available in
+    :attr:`driver` instead of using the thread pool.
+
+    The SQL of the hot model queries is compiled once and kept in
+    :attr:`query_cache` (see :class:`~mamba.enterprise.querycache.QueryCache`),
+    the `prepared_statements` option of the database config disables the
+    PostgreSQL server side prepared statements.
+
+    If the database config has a list of `replicas` URIs the read only
+    transactions run with :meth:`run_read` go to them through the
+    :class:`~mamba.enterprise.database.ReplicaSet` in :attr:`replicas`.
+    The reads of a table are sent to the primary for `replica_lag`
+    seconds after it has been written so they see their own writes.
+
+    The models that declare a `__shard_key__` live in the databases of
+    the shard maps configured in the `shards` option of the database
+    config, the transactions run with :meth:`run_in_shard` use the store
+    of the given shard (see :class:`~mamba.enterprise.sharding.ShardMap`).
+
     :param pool: the thrad pool for this database
     :type pool: :class:`twisted.python.threadpool.ThreadPool`
     """
 
     monkey_patched = False
-    pool = ThreadPool(
+    pool = DatabasePool(
         config.Database().min_threads,
         config.Database().max_threads,
         'DatabasePool'
@@ -51,6 +530,16 @@ class Database(object):
             self.pool = pool
 
         self.started = False
+        self.autoscaler = None
+        self.driver = None
+        self.query_cache = QueryCache(
+            getattr(config.Database(), 'prepared_statements', True)
+        )
+        self.replicas = None
+        self._shutdown_trigger = None
+        self._shard_maps = {}
+        self._writes = {}
+        self._local = threading.local()
         self.__testing = testing
 
         if not self.zstorm_configured:
@@ -71,7 +560,10 @@ class Database(object):
             self.monkey_patched = True
 
     def start(self):
-        """Starts the Database (and the threadpool)
+        """
+        Starts the Database (and the threadpool), the replicas, the async
+        driver and the pool autoscaler are stopped when the reactor shuts
+        down
         """
 
         if self.started:
@@ -82,6 +574,28 @@ class Database(object):
         # else:
         #     self._database = create_database(config.Database().uri)
 
+        if self.driver is None:
+            self.driver = AsyncDriver.from_config()
+
+        if self.replicas is None:
+            self.replicas = ReplicaSet.from_config(self)
+        if self.replicas is not None:
+            self.replicas.start()
+
+        auto_adjust = config.Database().auto_adjust_pool_size
+        if auto_adjust and isinstance(self.pool, DatabasePool):
+            self.autoscaler = PoolAutoscaler(self)
+            self.autoscaler.start()
+
+        if (self.driver is not None or self.replicas is not None
+                or self.autoscaler is not None):
+            # the replica pools threads, the async driver connections and
+            # the periodic checks must not outlive the reactor
+            from twisted.internet import reactor
+            self._shutdown_trigger = reactor.addSystemEventTrigger(
+                'before', 'shutdown', self.stop
+            )
+
         self.started = True
 
     def stop(self):
@@ -91,6 +605,25 @@ class Database(object):
         if not self.started:
             return
 
+        if self.autoscaler is not None:
+            self.autoscaler.stop()
+            self.autoscaler = None
+
+        if self.driver is not None:
+            self.driver.stop()
+
+        if self.replicas is not None:
+            self.replicas.stop()
+
+        if self._shutdown_trigger is not None:
+            from twisted.internet import reactor
+            try:
+                reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            except ValueError:
+                # we are being stopped by the trigger itself
+                pass
+            self._shutdown_trigger = None
+
         self.started = False
 
     def adjust_poolsize(self, min_threads=None, max_threads=None):
@@ -105,14 +638,194 @@ class Database(object):
 
         self.pool.adjustPoolsize(min_threads, max_threads)
 
+    def run_query(self, statement, params=()):
+        """
+        Run a raw SQL statement (with ? parameter marks) or Storm expression
+        that returns rows, with the async driver if it's enabled or in the
+        thread pool otherwise
+
+        :returns: a :class:`twisted.internet.defer.Deferred` that fires with
+                  the list of rows
+        """
+
+        if not self.started:
+            self.start()
+
+        if self.driver is not None:
+            return self.driver.run_query(statement, params)
+
+        return Transactor(self.pool).run(
+            lambda: self.store().execute(statement, params).get_all()
+        )
+
+    def run_operation(self, statement, params=()):
+        """
+        Run a raw SQL statement (with ? parameter marks) or Storm expression
+        that doesn't return rows, with the async driver if it's enabled or
+        in the thread pool otherwise
+
+        :returns: a :class:`twisted.internet.defer.Deferred` that fires with
+                  the number of affected rows
+        """
+
+        if not self.started:
+            self.start()
+
+        if self.driver is not None:
+            return self.driver.run_operation(statement, params)
+
+        return Transactor(self.pool).run(
+            lambda: self.store().execute(statement, params).rowcount
+        )
+
+    def wrote(self, table):
+        """
+        Record that the given table has been written so its next reads
+        go to the primary
+
+        :param table: the name of the table
+        :type table: str
+        """
+
+        self._writes[table] = time.time()
+
+    def replica(self, table=None):
+        """
+        Return back the replica that should run a read of the given table
+        or None if it must be read from the primary
+
+        :param table: the name of the table (None for any table)
+        :type table: str
+        """
+
+        if self.replicas is None:
+            return None
+
+        lag = getattr(config.Database(), 'replica_lag', 2.0)
+        written = self._writes.get(table) if table is not None else (
+            max(self._writes.values()) if self._writes else None
+        )
+        if written is not None and time.time() - written < lag:
+            return None
+
+        return self.replicas.choose()
+
+    @property
+    def in_replica(self):
+        """Return True if the current thread is running in a replica
+        """
+
+        route = getattr(self._local, 'route', None)
+        return isinstance(route, Replica)
+
+    def run_read(self, table, function, *args, **kwargs):
+        """
+        Run the given read only function in a transaction in one of the
+        replicas (or in the primary thread pool if no replica can be used).
+
+        If the replica connection fails the replica is marked as down and
+        the function runs again in the primary.
+
+        :param table: the name of the read table (None for any table)
+        :type table: str
+        :returns: a :class:`twisted.internet.defer.Deferred`
+        """
+
+        if not self.started:
+            self.start()
+
+        replica = self.replica(table)
+        if replica is None:
+            return Transactor(self.pool).run(function, *args, **kwargs)
+
+        def failed(failure):
+            failure.trap(DisconnectionError, OperationalError)
+            replica.failed(failure)
+            return Transactor(self.pool).run(function, *args, **kwargs)
+
+        return replica.run(function, *args, **kwargs).addErrback(failed)
+
+    def shard_map(self, name):
+        """
+        Return back the shard map with the given name
+
+        :param name: the name of the shard map in the database config
+        :type name: str
+        :rtype: :class:`~mamba.enterprise.sharding.ShardMap`
+        """
+
+        shard_map = self._shard_maps.get(name)
+        if shard_map is None:
+            shard_map = self._shard_maps.setdefault(
+                name, ShardMap.from_config(name)
+            )
+
+        return shard_map
+
+    def run_in_shard(self, shard, function, *args, **kwargs):
+        """
+        Run the given function in a transaction in the thread pool using
+        the store of the given shard
+
+        :param shard: the shard to use
+        :type shard: :class:`~mamba.enterprise.sharding.Shard`
+        :returns: a :class:`twisted.internet.defer.Deferred`
+        """
+
+        if not self.started:
+            self.start()
+
+        return Transactor(self.pool).run(
+            self._routed, shard, function, args, kwargs
+        )
+
+    def run_on_shards(self, shard_map, function, *args, **kwargs):
+        """
+        Run the given function in every shard of the given shard map in
+        parallel in the thread pool
+
+        :param shard_map: the shard map to use
+        :type shard_map: :class:`~mamba.enterprise.sharding.ShardMap`
+        :returns: a :class:`twisted.internet.defer.Deferred` that fires
+                  with the list of results of every shard
+        """
+
+        def failed(failure):
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
+
+        return defer.gatherResults([
+            self.run_in_shard(shard, function, *args, **kwargs)
+            for shard in shard_map.shards
+        ], consumeErrors=True).addErrback(failed)
+
+    def _routed(self, route, function, args, kwargs):
+        """
+        Call the function with the store of the given replica or shard as
+        the store of the current thread
+        """
+
+        self._local.route = route
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._local.route = None
+
     def store(self):
         """
         Returns a Store per-thread through :class:`storm.zope.zstorm.ZStorm`
+
+        If the current thread is running in a replica or a shard the store
+        of the replica or the shard is returned back
         """
 
         if not self.started:
             self.start()
 
+        route = getattr(self._local, 'route', None)
+        if route is not None:
+            return route.store()
+
         zstorm = getUtility(IZStorm)
         return zstorm.get('mamba')
 
@@ -126,8 +839,73 @@ class Database(object):
         :type full: bool
         """
 
+        return ''.join(self.iter_dump(model_manager, full))
+
+    def iter_dump(self, model_manager, full=False, progress=None):
+        """
+        Generate the dump of the database in chunks, the data of the tables
+        is read page by page so the dump never has to fit in memory
+
+        :param model_manager: the model manager from mamba application
+        :type model_manager: :class:`~mamba.application.model.ModelManager`
+        :param full: should be dumped full?
+        :type full: bool
+        :param progress: callable that is called with the table name and
+                         the number of rows dumped from it so far
+        """
+
+        first = True
+        for part in self._dump_parts(model_manager, full, progress):
+            if not first:
+                yield '\n'
+            first = False
+
+            if isinstance(part, basestring):
+                yield part
+            else:
+                for chunk in part:
+                    yield chunk
+
+    def dump_to(self, model_manager, path, full=False, compress=None,
+                progress=None):
+        """
+        Write the dump of the database straight to the given file
+
+        :param model_manager: the model manager from mamba application
+        :type model_manager: :class:`~mamba.application.model.ModelManager`
+        :param path: the path of the file
+        :type path: str
+        :param full: should be dumped full?
+        :type full: bool
+        :param compress: gzip the file, by default only if path ends
+                         with .gz
+        :type compress: bool
+        :param progress: see :meth:`iter_dump`
+        :returns: the number of bytes of the (uncompressed) dump
+        """
+
+        if compress is None:
+            compress = path.endswith('.gz')
+
+        size = 0
+        dump_file = gzip.open(path, 'wb') if compress else open(path, 'wb')
+        with dump_file:
+            for chunk in self.iter_dump(model_manager, full, progress):
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('utf-8')
+                dump_file.write(chunk)
+                size += len(chunk)
+
+        return size
+
+    def _dump_parts(self, model_manager, full, progress):
+        """
+        Generate the parts of the dump, the table data parts are
+        generators of chunks themselves
+        """
+
         references = []
-        sql = [
+        parts = [
             '--',
             '-- Mamba SQL dump {}'.format(version.short()),
             '--',
@@ -136,7 +914,7 @@ class Database(object):
         ]
         app = config.Application('config/application.json')
         try:
-            sql += [
+            parts += [
                 '-- Application: {}'.format(app.name.decode('utf-8')),
                 '-- Application Version: {}'.format(app.version),
                 '-- Application Description: {}'.format(
@@ -146,57 +924,124 @@ class Database(object):
         except AttributeError:
             pass
 
-        sql += [
+        parts += [
             '-- ---------------------------------------------------------',
             '-- Dumped on: {}'.format(datetime.datetime.now().isoformat()),
             '--'
         ]
 
         if self.backend == 'mysql':
-            sql += [
+            parts += [
                 '-- Disable foreign key checks for table creation',
                 '--',
                 'SET FOREIGN_KEY_CHECKS = 0;'
             ]
 
+        for part in parts:
+            yield part
+
+        # the sharded models live in the shards, their structure is in
+        # dump_shards and their data is dumped shard by shard below
+        models = [
+            model for model in model_manager.get_models().values()
+            if model.get('object').get_shard_map_name() is None
+        ]
+
         if full is False:
-            sql.append('')
-            for model in model_manager.get_models().values():
+            yield ''
+            for model in models:
                 if self.backend == 'postgres':
                     references.append(model.get('object').dump_references())
 
-                sql += [model.get('object').dump_table() + '\n']
+                yield model.get('object').dump_table() + '\n'
         else:
-            for model in model_manager.get_models().values():
+            for model in models:
                 model_object = model.get('object')
-                sql.append('--')
-                sql.append('-- Table structure for table {}'.format(
-                    model_object.__storm_table__
+                table = model_object.__storm_table__
+                yield '--'
+                yield '-- Table structure for table {}'.format(table)
+                yield '--\n'
+                yield model_object.dump_table()
+                yield '--'
+                yield '-- Dumping data for table {}'.format(table)
+                yield '--\n'
+                yield model_object.iter_dump_data(progress=(
+                    None if progress is None
+                    else functools.partial(progress, table)
                 ))
-                sql.append('--\n')
-                sql.append(model_object.dump_table())
-                sql.append('--')
-                sql.append('-- Dumping data for table {}'.format(
-                    model_object.__storm_table__
-                ))
-                sql.append('--\n')
-                sql.append(model_object.dump_data())
 
                 if self.backend == 'postgres':
                     references.append(model_object.dump_references())
 
+            shard_maps = self._sharded_models(model_manager)
+            for name in sorted(shard_maps):
+                for shard in self.shard_map(name).shards:
+                    for model_object in shard_maps[name]:
+                        table = model_object.__storm_table__
+                        yield '--'
+                        yield (
+                            '-- Dumping data for table {} of the shard {} '
+                            'of the {} shard map, restore it in that '
+                            'shard'.format(table, shard.name, name)
+                        )
+                        yield '--\n'
+                        yield model_object.iter_dump_data(
+                            progress=(
+                                None if progress is None
+                                else functools.partial(progress, table)
+                            ),
+                            uri=shard.uri
+                        )
+
         if self.backend == 'mysql':
-            sql += [
-                '--',
-                '-- Enable foreign key checks',
-                '--',
-                'SET FOREIGN_KEY_CHECKS = 1;'
-            ]
+            yield '--'
+            yield '-- Enable foreign key checks'
+            yield '--'
+            yield 'SET FOREIGN_KEY_CHECKS = 1;'
 
         for reference in references:
-            sql.append(reference)
+            yield reference
 
-        return '\n'.join(sql)
+    def dump_shards(self, model_manager):
+        """
+        Dumps the tables of the sharded models for every shard of their
+        shard maps
+
+        :param model_manager: the model manager from mamba application
+        :type model_manager: :class:`~mamba.application.model.ModelManager`
+        :returns: a list of (shard, SQL) tuples
+        """
+
+        shard_maps = self._sharded_models(model_manager)
+        dumps = []
+        for name in sorted(shard_maps):
+            tables = [
+                sharded.dump_table() + '\n' for sharded in shard_maps[name]
+            ]
+            for shard in self.shard_map(name).shards:
+                dumps.append((shard, '\n'.join([
+                    '--',
+                    '-- Shard {} of the {} shard map'.format(shard.name, name),
+                    '--',
+                    ''
+                ] + tables)))
+
+        return dumps
+
+    def _sharded_models(self, model_manager):
+        """
+        Return back a dict with the sharded model objects of the given
+        model manager by the name of their shard map
+        """
+
+        shard_maps = {}
+        for model in model_manager.get_models().values():
+            model_object = model.get('object')
+            name = model_object.get_shard_map_name()
+            if name is not None:
+                shard_maps.setdefault(name, []).append(model_object)
+
+        return shard_maps
 
     def reset(self, model_manager):
         """
@@ -291,4 +1136,7 @@ class PropertyColumnMambaPatch(Column):
             setattr(self, attr, getattr(prop, attr))
 
 
-__all__ = ['Database', 'AdapterFactory']
+__all__ = [
+    'Database', 'DatabasePool', 'PoolAutoscaler', 'Replica', 'ReplicaSet',
+    'AdapterFactory'
+]
@@ -319,6 +319,75 @@ class MySQL(CommonSQL):
 
         return query
 
+    def update_many(self, columns, primary, rows):
+        """
+        Return back the UPDATE ... JOIN statements needed to update the
+        given rows with a single statement per chunk of rows. The rows are
+        joined as a derived table of SELECTs so the rows that are not
+        present in the table are just ignored.
+
+        :param columns: the names of the columns to update
+        :type columns: list
+        :param primary: the names of the primary key columns
+        :type primary: list
+        :param rows: sequences of values (or Storm variables) in the same
+                     order than the columns
+        :type rows: list
+        """
+
+        others = [name for name in columns if name not in primary]
+        if not others:
+            return []
+
+        quote = self._quote
+        table = quote(self.model.__storm_table__)
+        first = 'SELECT {}'.format(', '.join(
+            '? AS {}'.format(quote(name)) for name in columns
+        ))
+        select = 'SELECT {}'.format(', '.join('?' * len(columns)))
+        statements = []
+        for chunk in self._bulk_chunks(columns, rows):
+            statements.append((
+                'UPDATE {table} JOIN ({rows}) AS mamba_bulk ON {on} '
+                'SET {update}'.format(
+                    table=table,
+                    rows=' UNION ALL '.join(
+                        [first] + [select] * (len(chunk) - 1)
+                    ),
+                    on=' AND '.join(
+                        '{0}.{1} = mamba_bulk.{1}'.format(table, quote(name))
+                        for name in primary
+                    ),
+                    update=', '.join(
+                        '{0}.{1} = mamba_bulk.{1}'.format(table, quote(name))
+                        for name in others
+                    )
+                ),
+                [value for row in chunk for value in row]
+            ))
+
+        return statements
+
+    def _quote(self, name):
+        """Quote the given table or column name
+        """
+
+        return '`{}`'.format(name)
+
+    def _dump_table_name(self):
+        """Return back the quoted table name used in the data dumps
+        """
+
+        return self._quote(self.model.__storm_table__)
+
+    def _escape(self, value):
+        """
+        Escape the given string to be used inside an SQL literal, MySQL
+        uses the backslash as escape character in string literals
+        """
+
+        return value.replace('\\', '\\\\').replace("'", "''")
+
     def _default(self, column):
         """
         Get the default argument for a column (if any)
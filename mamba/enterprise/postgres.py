@@ -13,9 +13,11 @@
 
 import sys
 import inspect
+import binascii
 from singledispatch import singledispatch
 
 from storm import properties
+from storm.info import get_cls_info
 from twisted.python import components
 from storm.references import Reference
 
@@ -294,6 +296,112 @@ class PostgreSQL(CommonSQL):
 
         return query
 
+    def update_many(self, columns, primary, rows):
+        """
+        Return back the UPDATE ... FROM (VALUES ...) statements needed to
+        update the given rows with a single statement per chunk of rows.
+
+        The parameters of the VALUES list are untyped so they are casted
+        to the type of their columns when they are compared and assigned.
+
+        :param columns: the names of the columns to update
+        :type columns: list
+        :param primary: the names of the primary key columns
+        :type primary: list
+        :param rows: sequences of values (or Storm variables) in the same
+                     order than the columns
+        :type rows: list
+        """
+
+        others = [name for name in columns if name not in primary]
+        if not others:
+            return []
+
+        quote = self._quote
+        table = quote(self.model.__storm_table__)
+        # the class info creates the _storm_columns of the model class
+        get_cls_info(self.model.__class__)
+        types = dict(
+            (column.name, self._cast_type(prop))
+            for prop, column in self.model._storm_columns.iteritems()
+        )
+        marks = '({})'.format(', '.join('?' * len(columns)))
+        statements = []
+        for chunk in self._bulk_chunks(columns, rows):
+            statements.append((
+                'UPDATE {table} SET {update} FROM (VALUES {values}) '
+                'AS mamba_bulk ({columns}) WHERE {where}'.format(
+                    table=table,
+                    update=', '.join(
+                        '{0} = mamba_bulk.{0}::{1}'.format(
+                            quote(name), types[name]
+                        ) for name in others
+                    ),
+                    values=', '.join([marks] * len(chunk)),
+                    columns=', '.join(quote(name) for name in columns),
+                    where=' AND '.join(
+                        '{0}.{1} = mamba_bulk.{1}::{2}'.format(
+                            table, quote(name), types[name]
+                        ) for name in primary
+                    )
+                ),
+                [value for row in chunk for value in row]
+            ))
+
+        return statements
+
+    def _cast_type(self, column):
+        """
+        Return back the PostgreSQL type used to cast values to the given
+        column, the serial types are plain integers once created
+        """
+
+        column_type = self.parse(column)
+        return {
+            'serial': 'integer',
+            'smallserial': 'smallint',
+            'bigserial': 'bigint'
+        }.get(column_type, column_type)
+
+    def _quote(self, name):
+        """Quote the given table or column name
+        """
+
+        return '"{}"'.format(name)
+
+    def _dump_table_name(self):
+        """Return back the quoted table name used in the data dumps
+        """
+
+        return self._quote(self.model.__storm_table__)
+
+    def _literal(self, value):
+        """
+        Return back the given database value as an UTF-8 encoded SQL
+        literal, PostgreSQL has real booleans and arrays
+        """
+
+        if isinstance(value, bool):
+            return 'TRUE' if value else 'FALSE'
+
+        if isinstance(value, (list, tuple)):
+            if not value:
+                # ARRAY[] has no type, the empty array literal takes the
+                # type of the column it is inserted into
+                return "'{}'"
+
+            return 'ARRAY[{}]'.format(
+                ', '.join(self._literal(item) for item in value)
+            )
+
+        return super(PostgreSQL, self)._literal(value)
+
+    def _binary_literal(self, value):
+        """Return back the SQL literal for the given binary string
+        """
+
+        return "'\\x{}'::bytea".format(binascii.hexlify(value))
+
     def _parse_int(self, column):
         """
         Parse an specific integer type for PostgreSQL, for example:
@@ -0,0 +1,225 @@
+# -*- test-case-name: mamba.test.test_querycache -*-
+# Copyright (c) 2012 Oscar Campos <oscar.campos@member.fsf.org>
+# See LICENSE for more details
+
+"""
+.. module:: querycache
+    :platform: Unix, Windows
+    :synopsis: Compiled SQL and prepared statements for Model queries
+
+.. moduleauthor:: Oscar Campos <oscar.campos@member.fsf.org>
+
+"""
+
+import hashlib
+from importlib import import_module
+
+from storm.expr import State
+from storm.expr import compile as default_compile
+
+DUPLICATE_PREPARED_STATEMENT = '42P05'
+STORE_INTERNALS = ('_alive', '_get_object', '_load_object')
+CONNECTION_INTERNALS = ('_ensure_connected', '_raw_connection')
+
+
+def get_compiler(scheme):
+    """
+    Return back the Storm compiler of the given database scheme, the
+    backend modules are imported lazily as not every Storm version ships
+    all of them (Storm 0.21 dropped MySQL), the default compiler is used
+    if the backend is not available
+    """
+
+    try:
+        backend = import_module('storm.databases.{}'.format(scheme))
+    except ImportError:
+        return default_compile
+
+    return getattr(backend, 'compile', default_compile)
+
+
+def store_scheme(store):
+    """
+    Return back the scheme (postgres, mysql or sqlite) of the backend of
+    the given Storm store
+    """
+
+    return type(store.get_database()).__module__.rsplit('.', 1)[-1]
+
+
+def has_internals(obj, names):
+    """
+    Return True if the given Storm object has all the given private
+    attributes. The compiled queries use a few Storm internals (stable
+    since Storm 0.19) to skip the work of the public API, their callers
+    fall back to the public API if a Storm release drops them
+    """
+
+    return all(hasattr(obj, name) for name in names)
+
+
+def number_param_marks(statement):
+    """
+    Replace the ? parameter marks of the statement (out of the quoted
+    strings) with the numbered $1, $2... marks used by PREPARE
+    """
+
+    tokens = statement.split("'")
+    count = 0
+    for i in range(0, len(tokens), 2):
+        parts = tokens[i].split('?')
+        for j in range(1, len(parts)):
+            count += 1
+            parts[j] = '${}{}'.format(count, parts[j])
+        tokens[i] = ''.join(parts)
+
+    return "'".join(tokens), count
+
+
+class CompiledQuery(object):
+    """
+    I am a SQL statement (with ? parameter marks) compiled just once for
+    a query shape of a model.
+
+    If `prepare` is True (PostgreSQL) I am executed as a server side
+    prepared statement, I am prepared once in every connection that uses
+    me so the server doesn't parse and plan me again.
+
+    :param statement: the compiled SQL statement
+    :type statement: str
+    :param prepare: if True use server side prepared statements
+    :type prepare: bool
+    """
+
+    def __init__(self, statement, prepare=False):
+        self.statement = statement
+        self.prepare = prepare
+        self.executions = 0
+        self.name = 'mamba_{}'.format(
+            hashlib.md5(statement.encode('utf-8')).hexdigest()[:16]
+        )
+
+    def execute(self, store, params=()):
+        """
+        Execute me in the given store, returns back the Storm result
+        """
+
+        self.executions += 1
+        connection = getattr(store, '_connection', None)
+        if not self.prepare or not has_internals(
+                connection, CONNECTION_INTERNALS):
+            return store.execute(self.statement, params)
+
+        # the prepared statements live in the connection, if Storm
+        # reconnects the store we have to prepare them again. We keep a
+        # reference to the raw connection so a new one can't be taken
+        # for the old one just because it reuses its id. Storm reconnects
+        # lazily so we make sure it is connected before looking at it
+        connection._ensure_connected()
+        connection = connection._raw_connection
+        registry = store.__dict__.get('_mamba_prepared')
+        if registry is None or registry[0] is not connection:
+            registry = store.__dict__['_mamba_prepared'] = (connection, set())
+        prepared = registry[1]
+
+        if self.name not in prepared:
+            self._prepare(store)
+            prepared.add(self.name)
+
+        if not params:
+            return store.execute('EXECUTE {}'.format(self.name))
+
+        return store.execute('EXECUTE {} ({})'.format(
+            self.name, ', '.join('?' * len(params))
+        ), params)
+
+    def _prepare(self, store):
+        """
+        Prepare me in the connection of the given store, if the statement
+        is already prepared in the connection (SQLSTATE 42P05) there is
+        nothing to do. The PREPARE runs in a savepoint so that error doesn't
+        abort the ongoing transaction
+        """
+
+        statement, _ = number_param_marks(self.statement)
+        store.execute('SAVEPOINT mamba_prepare', noresult=True)
+        try:
+            store.execute(
+                'PREPARE {} AS {}'.format(self.name, statement), noresult=True
+            )
+        except Exception as error:
+            if getattr(error, 'pgcode', None) != DUPLICATE_PREPARED_STATEMENT:
+                raise
+            store.execute('ROLLBACK TO SAVEPOINT mamba_prepare', noresult=True)
+        store.execute('RELEASE SAVEPOINT mamba_prepare', noresult=True)
+
+
+class QueryCache(object):
+    """
+    I keep the compiled queries of the models by (model, query shape) and
+    database scheme, so the stores of shards or replicas that use another
+    backend get their own dialect.
+
+    The compiled SQL is shared by all the threads, the prepared statements
+    are tracked by every thread store (every thread has its own store and
+    connection).
+
+    :param prepare: if False never use server side prepared statements
+    :type prepare: bool
+    """
+
+    def __init__(self, prepare=True):
+        self.prepare = prepare
+        self.queries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, scheme, build):
+        """
+        Return back the compiled query for key, compiling the Storm
+        expression returned by `build` for the given database scheme if
+        it is not compiled yet
+
+        :param key: the (model, query shape) key
+        :param scheme: the database scheme (postgres, mysql or sqlite)
+        :type scheme: str
+        :param build: callable that returns the Storm expression
+        """
+
+        query = self.queries.get((key, scheme))
+        if query is not None:
+            self.hits += 1
+            return query
+
+        self.misses += 1
+        statement = get_compiler(scheme)(build(), State())
+        query = CompiledQuery(
+            statement, prepare=self.prepare and scheme == 'postgres'
+        )
+        return self.queries.setdefault((key, scheme), query)
+
+    def clear(self):
+        """Forget all the compiled queries
+        """
+
+        self.queries.clear()
+
+    def stats(self):
+        """Return back a dict with the cache counters
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'queries': len(self.queries),
+            'executions': sum(
+                query.executions for query in self.queries.values()
+            )
+        }
+
+
+__all__ = [
+    'CompiledQuery', 'QueryCache', 'store_scheme', 'has_internals'
+]
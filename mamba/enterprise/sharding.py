@@ -0,0 +1,125 @@
+# -*- test-case-name: mamba.test.test_sharding -*-
+# Copyright (c) 2012 Oscar Campos <oscar.campos@member.fsf.org>
+# See LICENSE for more details
+
+"""
+.. module:: sharding
+    :platform: Unix, Windows
+    :synopsis: Horizontal sharding of models across several databases
+
+.. moduleauthor:: Oscar Campos <oscar.campos@member.fsf.org>
+
+"""
+
+import zlib
+import itertools
+
+from storm.zope.interfaces import IZStorm
+from zope.component import getUtility
+
+from mamba.utils import config
+
+
+class ShardingError(Exception):
+    """Raised when a shard map is not configured or a shard can't be found
+    """
+
+
+class Shard(object):
+    """
+    I am one of the databases of a shard map, I have my own Storm store
+    registered in ZStorm as `name`.
+
+    :param name: the name of my ZStorm store
+    :type name: str
+    :param uri: the Storm URI of the shard
+    :type uri: str
+    """
+
+    def __init__(self, name, uri):
+        self.name = name
+        self.uri = uri
+
+        getUtility(IZStorm).set_default_uri(name, uri)
+
+    def store(self):
+        """Returns the Store of this shard for the current thread
+        """
+
+        return getUtility(IZStorm).get(self.name)
+
+    def __repr__(self):
+        return '<Shard {}>'.format(self.name)
+
+
+class ShardMap(object):
+    """
+    I map the shard key values of the sharded models to the databases that
+    store their registers.
+
+    Integer keys go to the shard `key % len(shards)`, any other key is
+    hashed with CRC32 first so the same key always goes to the same shard
+    in every process.
+
+    :param name: the name of the shard map in the database config
+    :type name: str
+    :param uris: the Storm URIs of the shards
+    :type uris: list
+    """
+
+    # ZStorm keeps the stores by name so they must be unique
+    _names = itertools.count()
+
+    def __init__(self, name, uris):
+        if not uris:
+            raise ShardingError('Shard map {} has no shards'.format(name))
+
+        self.name = name
+        self.shards = [
+            Shard('mamba-shard-{}-{}'.format(name, next(self._names)), uri)
+            for uri in uris
+        ]
+
+    @classmethod
+    def from_config(cls, name):
+        """
+        Return back the shard map with the given name from the `shards`
+        option of the database config
+        """
+
+        shards = getattr(config.Database(), 'shards', None) or {}
+        try:
+            uris = shards[name]
+        except KeyError:
+            raise ShardingError(
+                'Shard map {} is not configured in the database config'.format(
+                    name
+                )
+            )
+
+        return cls(name, uris)
+
+    def index(self, key):
+        """Return back the index of the shard for the given key
+        """
+
+        if key is None:
+            raise ShardingError(
+                'Can not find the shard of a None key in {}'.format(self.name)
+            )
+
+        if not isinstance(key, (int, long)):
+            if not isinstance(key, unicode):
+                key = unicode(key)
+            key = zlib.crc32(key.encode('utf-8')) & 0xffffffff
+
+        return key % len(self.shards)
+
+    def shard_for(self, key):
+        """Return back the shard for the given key
+        """
+
+        return self.shards[self.index(key)]
+
+
+__all__ = ['ShardingError', 'Shard', 'ShardMap']
@@ -38,6 +38,9 @@ class SQLite(CommonSQL):
     :type module: :class:`~mamba.Model`
     """
 
+    # SQLite versions older than 3.32 are limited to 999 host parameters
+    max_bulk_params = 999
+
     def __init__(self, model):
         self.model = model
 
@@ -215,7 +215,11 @@ class SqlCreateOptions(usage.Options):
 class SqlDumpOptions(usage.Options):
     """Sql Dump options for mamba-admin tool
     """
-    synopsis = '<file>'
+    synopsis = '[options] <file>'
+
+    optFlags = [
+        ['compress', 'z', 'gzip compress the dump file']
+    ]
 
     def parseArgs(self, file=None):
         """Parse command arguments
@@ -224,8 +228,14 @@ class SqlDumpOptions(usage.Options):
         if file is None:
             self['file'] = None
         else:
+            if file.endswith('.gz'):
+                self['compress'] = 1
+                file = file[:-3]
+
             self['file'] = file if file.endswith('.sql') else '{}.sql'.format(
                 file)
+            if self['compress']:
+                self['file'] += '.gz'
 
     def opt_version(self):
         """Print version information and exit
@@ -381,9 +391,13 @@ class Sql(object):
 
         # generate script
         if mgr is None:
-            print(db.dump(ModelManager()))
-        else:
-            print(db.dump(mgr))
+            mgr = ModelManager()
+
+        sql = db.dump(mgr)
+        print(sql)
+        shard_dumps = db.dump_shards(mgr)
+        for shard, shard_dump in shard_dumps:
+            print(shard_dump)
 
         sys.stdout = stdout
 
@@ -414,39 +428,47 @@ class Sql(object):
                     sys.exit(0)
 
             real_database = database.Database()
-            store = real_database.store()
-            if real_database.backend == 'sqlite':
-                # the pysqlite module does not allow us to use more
-                # than one operations per query
-                for operation in capture.getvalue().split(';'):
-                    store.execute(operation)
-            else:
-                store.execute(capture.getvalue())
+            self._execute(real_database, real_database.store(), sql)
+            for shard, shard_dump in shard_dumps:
+                self._execute(real_database, shard.store(), shard_dump)
 
         sys.exit(0)
 
+    def _execute(self, real_database, store, sql):
+        """Execute the given SQL script in the given store
+        """
+
+        if real_database.backend == 'sqlite':
+            # the pysqlite module does not allow us to use more
+            # than one operations per query
+            for operation in sql.split(';'):
+                store.execute(operation)
+        else:
+            store.execute(sql)
+
     def _handle_dump_command(self, mgr=None):
         """Take care of SQL dumping
         """
 
         db = self._prepare_model_db()[1]
 
-        stdout = sys.stdout
-        capture = StringIO()
-        sys.stdout = capture
-
         if mgr is None:
-            print(db.dump(ModelManager(), True))
-        else:
-            print(db.dump(mgr, True))
-
-        sys.stdout = stdout
+            mgr = ModelManager()
 
+        # the dump is written chunk by chunk, big tables never fit in memory
         if self.options.subOptions.opts['file'] is None:
-            print(capture.getvalue())
+            for chunk in db.iter_dump(mgr, True):
+                sys.stdout.write(chunk)
+            print()
         else:
-            with open(self.options.subOptions.opts['file'], 'w') as dump_file:
-                dump_file.write(capture.getvalue())
+            def progress(table, rows):
+                sys.stderr.write('\rDumping {}... {} rows'.format(table, rows))
+
+            db.dump_to(
+                mgr, self.options.subOptions.opts['file'], True,
+                bool(self.options.subOptions.opts['compress']), progress
+            )
+            sys.stderr.write('\n')
 
         sys.exit(0)
 
@@ -15,6 +15,7 @@ from twisted.python import usage, filepath
 from storm import version as storm_version
 
 from mamba.utils import config
+from mamba.core import templating
 from mamba import version, license
 from mamba.core import GNU_LINUX, BSD, OSX, WINDOWS
 from mamba import copyright as mamba_copyright
@@ -47,6 +48,16 @@ class StartOptions(usage.Options):
     ]
 
 
+class WarmOptions(usage.Options):
+    """Warm command options for mamba-admin tool
+    """
+    synopsis = '[options]'
+
+    optFlags = [
+        ['clear', 'c', 'remove the compiled templates before warm the cache']
+    ]
+
+
 class Options(usage.Options):
     """Base options for mamba-admin tool
     """
@@ -70,7 +81,10 @@ class Options(usage.Options):
         ['start', None, StartOptions,
             'Start a mamba application (you should be in the app directory)'],
         ['stop', None, usage.Options,
-            'Stop a mamba application (you should be in the app directory)']
+            'Stop a mamba application (you should be in the app directory)'],
+        ['warm', None, WarmOptions,
+            'Compile the application templates into the templates bytecode '
+            'cache (you should be in the app directory)']
     ]
 
     optFlags = [
@@ -228,6 +242,52 @@ def handle_stop_command():
         raise
 
 
+def handle_warm_command(options):
+    """I handle the warm command
+    """
+
+    try:
+        import_services()
+    except ImportError:
+        mamba_services_not_found()
+
+    config.Application('config/application.json')
+    if templating.bytecode_cache() is None:
+        print(
+            'error: the templates bytecode cache is disabled, check the '
+            'template_bytecode_cache option in config/application.json'
+        )
+        sys.exit(-1)
+
+    if options.subOptions.opts['clear']:
+        for variant in (False, templating.autoescape_html):
+            templating.bytecode_cache(variant).clear()
+
+    # compile the templates with the same environments used to render them
+    environments = [
+        templating.get_environment(package=('mamba', 'templates/jinja')),
+        templating.get_environment(
+            [templating.MAMBA_TEMPLATES],
+            autoescape=templating.autoescape_html
+        )
+    ]
+    view = filepath.FilePath('application/view')
+    if view.exists():
+        for path in view.children():
+            if path.isdir() and path.basename() not in (
+                    'stylesheets', 'scripts'):
+                environments.append(templating.get_environment(
+                    [path.path], autoescape=templating.autoescape_html
+                ))
+
+    print('compiling templates...'.ljust(73), end='')
+    compiled = sum(templating.warm(env) for env in environments)
+    print('[{}]'.format(darkgreen('Ok')))
+    print('{} templates compiled into {}'.format(
+        compiled, templating.BYTECODE_CACHE_PATH)
+    )
+
+
 def determine_platform_reactor():
     """Determine the reactor to use for the running platform
     """
@@ -284,6 +344,9 @@ def run():
     if options.subCommand == 'stop':
         handle_stop_command()
 
+    if options.subCommand == 'warm':
+        handle_warm_command(options)
+
     if options.subCommand == 'sql':
         Sql(options.subOptions)
 
@@ -0,0 +1,64 @@
+# Copyright (c) 2012 - Oscar Campos <oscar.campos@member.fsf.org>
+# See LICENSE for more details
+
+"""
+Microbenchmarks for mamba.web.websocket, run them with:
+
+    python -m mamba.test.bench_websocket
+"""
+
+import os
+import timeit
+
+from mamba.web import websocket
+
+KEY = '\x0a\x45\x34\x1a'
+SIZES = (16, 1024, 64 * 1024, 1024 * 1024)
+
+
+def mask_octets(buf, key):
+    """The one octet at a time algorithm, used as reference
+    """
+
+    key = [ord(i) for i in key]
+    buf = list(buf)
+
+    for i in range(len(buf)):
+        buf[i] = chr(ord(buf[i]) ^ key[i % 4])
+    return ''.join(buf)
+
+
+def bench(func, payload, number):
+    """Return back the throughput of func in MB/s
+    """
+
+    elapsed = min(timeit.repeat(
+        lambda: func(payload, KEY), repeat=3, number=number
+    ))
+    return len(payload) * number / elapsed / (1024 * 1024)
+
+
+def main():
+    candidates = [
+        ('octets', mask_octets), ('strided', websocket._mask_strided)
+    ]
+    if websocket.numpy is not None:
+        candidates.append(('numpy', websocket._mask_numpy))
+
+    print('{:>10} {}'.format('size', ' '.join(
+        '{:>12}'.format(name) for name, func in candidates)))
+
+    for size in SIZES:
+        payload = os.urandom(size)
+        number = max(1, (4 * 1024 * 1024) // size)
+        results = []
+        for name, func in candidates:
+            count = 1 if name == 'octets' and size > 64 * 1024 else number
+            results.append(bench(func, payload, count))
+
+        print('{:>10} {}'.format(size, ' '.join(
+            '{:>9.1f}MB/s'.format(result) for result in results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# Copyright (c) 2012 - Oscar Campos <oscar.campos@member.fsf.org>
+# See LICENSE for more details
+
+"""
+Tests for mamba.enterprise.asyncdriver
+"""
+
+import os
+import sys
+import subprocess
+
+from storm.locals import Int, Unicode
+from storm.variables import IntVariable
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from mamba import Model
+from mamba.utils import config
+from mamba.enterprise import Database
+from mamba.enterprise.asyncdriver import AsyncDriver
+from mamba.application.model import StaleModelError
+from mamba.test.test_model import DummyThreadPool
+
+
+class FakeCursor(object):
+    """txpostgres like cursor that records the executed statements"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.rowcount = pool.rowcount
+
+    def execute(self, statement, params):
+        self.pool.statements.append((statement, params))
+        return defer.succeed(self)
+
+
+class FakePool(object):
+    """txpostgres like connection pool"""
+
+    def __init__(self, rows=(), rowcount=1):
+        self.rows = list(rows)
+        self.rowcount = rowcount
+        self.statements = []
+        self.starts = 0
+        self.closed = False
+        self.connected = defer.Deferred()
+
+    def start(self):
+        self.starts += 1
+        return self.connected
+
+    def close(self):
+        self.closed = True
+
+    def runQuery(self, statement, params):
+        self.statements.append((statement, params))
+        return defer.succeed(self.rows)
+
+    def runInteraction(self, interaction):
+        return interaction(FakeCursor(self))
+
+
+class AsyncDriverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakePool([(1,)])
+        self.driver = AsyncDriver('postgres://localhost/mamba', 5, self.pool)
+
+    def test_compile_converts_the_parameters(self):
+        statement, params = self.driver.compile(
+            'SELECT * FROM dummy WHERE id = ? AND name = ?',
+            (IntVariable(1), u'Dummy')
+        )
+
+        self.assertEqual(
+            statement, 'SELECT * FROM dummy WHERE id = %s AND name = %s')
+        self.assertEqual(params, [1, u'Dummy'])
+
+    def test_queries_wait_for_the_pool(self):
+        results = []
+        self.driver.run_query('SELECT 1').addCallback(results.append)
+        self.driver.run_query('SELECT 1').addCallback(results.append)
+
+        self.assertEqual(results, [])
+        self.assertEqual(self.pool.starts, 1)
+
+        self.pool.connected.callback(None)
+        self.assertEqual(results, [[(1,)], [(1,)]])
+        self.assertTrue(self.driver.started)
+
+    def test_run_operation_returns_the_rowcount(self):
+        self.pool.connected.callback(None)
+        self.pool.rowcount = 3
+
+        result = []
+        self.driver.run_operation('DELETE FROM dummy').addCallback(
+            result.append)
+        self.assertEqual(result, [3])
+
+    def test_stop_closes_the_pool(self):
+        self.pool.connected.callback(None)
+        self.driver.ready()
+        self.driver.stop()
+
+        self.assertTrue(self.pool.closed)
+        self.assertFalse(self.driver.started)
+
+    def test_from_config_only_in_async_mode(self):
+        cfg = config.Database()
+        self.patch(cfg, 'uri', 'postgres://localhost/mamba')
+        self.patch(cfg, 'mode', 'threaded')
+        self.assertIsNone(AsyncDriver.from_config())
+
+    def test_from_config_falls_back_for_other_databases(self):
+        cfg = config.Database()
+        self.patch(cfg, 'uri', 'sqlite:')
+        self.patch(cfg, 'mode', 'async')
+        self.assertIsNone(AsyncDriver.from_config())
+
+    def test_postgres_backend_is_not_imported_with_mamba(self):
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, mamba; '
+            'print("storm.databases.postgres" in sys.modules)'
+        ], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        self.assertEqual(output.strip(), 'False')
+
+
+class AsyncModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.pool.connected.callback(None)
+
+        self.patch(Model, 'database', Database(DummyThreadPool(), True))
+        Model.database.driver = AsyncDriver(
+            'postgres://localhost/mamba', 5, self.pool
+        )
+
+    @defer.inlineCallbacks
+    def test_create(self):
+        self.pool.rows = [(7,)]
+        dummy = AsyncDummy()
+        dummy.name = u'Dummy'
+        yield dummy.create()
+
+        self.assertEqual(self.pool.statements, [(
+            'INSERT INTO async_dummy (name) VALUES (%s) '
+            'RETURNING async_dummy.id', [u'Dummy']
+        )])
+        self.assertEqual(dummy.id, 7)
+
+    @defer.inlineCallbacks
+    def test_read(self):
+        self.pool.rows = [(1, u'Dummy', 3)]
+        dummy = yield AsyncDummy().read(1)
+
+        self.assertEqual(self.pool.statements, [(
+            'SELECT async_dummy.id, async_dummy.name, async_dummy.version '
+            'FROM async_dummy WHERE async_dummy.id = %s LIMIT 1', [1]
+        )])
+        self.assertEqual(dummy.id, 1)
+        self.assertEqual(dummy.name, u'Dummy')
+
+    @defer.inlineCallbacks
+    def test_read_missing_register(self):
+        dummy = yield AsyncDummy().read(1)
+        self.assertIsNone(dummy)
+
+    @defer.inlineCallbacks
+    def test_update_writes_the_changed_columns(self):
+        self.pool.rows = [(1, u'Dummy', 3)]
+        dummy = yield AsyncDummy().read(1)
+        dummy.name = u'Fellas'
+        yield dummy.update()
+
+        self.assertEqual(self.pool.statements[1], (
+            'UPDATE async_dummy SET name=%s, version=%s '
+            'WHERE async_dummy.id = %s AND async_dummy.version = %s',
+            [u'Fellas', 4, 1, 3]
+        ))
+        self.assertEqual(dummy.version, 4)
+
+    @defer.inlineCallbacks
+    def test_update_raises_stale_model_error(self):
+        self.pool.rows = [(1, u'Dummy', 3)]
+        dummy = yield AsyncDummy().read(1)
+        dummy.name = u'Fellas'
+
+        self.pool.rowcount = 0
+        try:
+            yield dummy.update()
+        except StaleModelError:
+            pass
+        else:
+            self.fail('StaleModelError not raised')
+
+    @defer.inlineCallbacks
+    def test_delete(self):
+        self.pool.rows = [(1, u'Dummy', 3)]
+        dummy = yield AsyncDummy().read(1)
+        yield dummy.delete()
+
+        self.assertEqual(self.pool.statements[1], (
+            'DELETE FROM async_dummy WHERE async_dummy.id = %s', [1]
+        ))
+
+    @defer.inlineCallbacks
+    def test_database_run_query(self):
+        self.pool.rows = [(1,)]
+        rows = yield Model.database.run_query('SELECT ?', (1,))
+
+        self.assertEqual(rows, [(1,)])
+        self.assertEqual(self.pool.statements, [('SELECT %s', [1])])
+
+
+class AsyncDummy(Model):
+    """Dummy Model for testing purposes"""
+
+    __storm_table__ = 'async_dummy'
+    __version_column__ = 'version'
+    id = Int(primary=True)
+    name = Unicode()
+    version = Int()
@@ -0,0 +1,171 @@
+# Copyright (c) 2012 - Oscar Campos <oscar.campos@member.fsf.org>
+# See LICENSE for more details
+
+"""
+Tests for mamba.enterprise.cache
+"""
+
+import os
+import sqlite3
+import cPickle as pickle
+from decimal import Decimal
+from datetime import datetime
+
+from twisted.trial import unittest
+
+from mamba.enterprise import cache
+
+
+class TestLocalCache(unittest.TestCase):
+
+    def test_set_get_and_discard(self):
+        local = cache.LocalCache()
+        local.set(('dummy', (1,)), (1, u'Dummy'))
+
+        self.assertEqual(local.get(('dummy', (1,))), (1, u'Dummy'))
+        local.discard(('dummy', (1,)))
+        self.assertIsNone(local.get(('dummy', (1,))))
+        self.assertEqual(local.stats()['hits'], 1)
+
+    def test_entries_expire(self):
+        now = [0]
+        local = cache.LocalCache(ttl=10, clock=lambda: now[0])
+        local.set(('dummy', (1,)), (1, u'Dummy'))
+
+        now[0] = 10
+        self.assertIsNone(local.get(('dummy', (1,))))
+
+    def test_entries_expire_by_default(self):
+        now = [0]
+        local = cache.LocalCache(clock=lambda: now[0])
+        local.set(('dummy', (1,)), (1, u'Dummy'))
+
+        now[0] = 3600
+        self.assertIsNone(local.get(('dummy', (1,))))
+
+    def test_invalidated_reads_are_not_stored(self):
+        local = cache.LocalCache()
+        generation = local.generation(('dummy', (1,)))
+        local.discard(('dummy', (1,)))
+        local.set(('dummy', (1,)), (1, u'Old'), generation)
+        self.assertIsNone(local.get(('dummy', (1,))))
+
+        generation = local.generation(('dummy', (1,)))
+        local.set(('dummy', (1,)), (1, u'New'), generation)
+        self.assertEqual(local.get(('dummy', (1,))), (1, u'New'))
+
+    def test_forgotten_generations_ignore_pending_reads(self):
+        local = cache.LocalCache()
+        local.max_generations = 2
+        generation = local.generation(('dummy', (1,)))
+        for i in range(2, 5):
+            local.discard(('dummy', (i,)))
+
+        local.set(('dummy', (1,)), (1, u'Old'), generation)
+        self.assertIsNone(local.get(('dummy', (1,))))
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def test_snapshots_are_shared(self):
+        one = cache.SharedCache(self.path)
+        two = cache.SharedCache(self.path)
+        one.set(('dummy', (1,)), (1, u'Dummy'))
+
+        self.assertEqual(two.get(('dummy', (1,))), (1, u'Dummy'))
+        two.discard(('dummy', (1,)))
+        self.assertIsNone(one.get(('dummy', (1,))))
+
+    def test_invalidated_reads_are_not_stored(self):
+        one = cache.SharedCache(self.path)
+        two = cache.SharedCache(self.path)
+        generation = one.generation(('dummy', (1,)))
+        two.discard(('dummy', (1,)))
+        one.set(('dummy', (1,)), (1, u'Old'), generation)
+        self.assertIsNone(two.get(('dummy', (1,))))
+
+        generation = one.generation(('dummy', (1,)))
+        self.assertEqual(generation, 1)
+        one.set(('dummy', (1,)), (1, u'New'), generation)
+        self.assertEqual(two.get(('dummy', (1,))), (1, u'New'))
+
+    def test_snapshots_are_marshalled(self):
+        shared = cache.SharedCache(self.path)
+        snapshot = (
+            1, u'Dummy', Decimal('1.50'), datetime(2013, 1, 2, 3, 4, 5),
+            [1, 2], None
+        )
+        shared.set(('dummy', (1,)), snapshot)
+        self.assertEqual(shared.get(('dummy', (1,))), snapshot)
+
+        data = shared.connection.execute(
+            'SELECT value FROM snapshots').fetchone()[0]
+        self.assertEqual(cache.load_snapshot(str(data)), snapshot)
+
+    def test_unsupported_snapshots_are_not_stored(self):
+        shared = cache.SharedCache(self.path)
+        shared.set(('dummy', (1,)), (1, object()))
+        self.assertIsNone(shared.get(('dummy', (1,))))
+
+    def test_pickled_snapshots_are_ignored(self):
+        shared = cache.SharedCache(self.path)
+        shared.connection.execute(
+            'INSERT INTO snapshots VALUES (?, ?, NULL)', (
+                repr(('dummy', (1,))),
+                sqlite3.Binary(pickle.dumps((1, u'Dummy'), 2))
+            )
+        )
+        self.assertIsNone(shared.get(('dummy', (1,))))
+
+    def test_entries_expire(self):
+        now = [0]
+        shared = cache.SharedCache(self.path, ttl=10, clock=lambda: now[0])
+        shared.set(('dummy', (1,)), (1, u'Dummy'))
+
+        now[0] = 10
+        self.assertIsNone(shared.get(('dummy', (1,))))
+        shared.shrink()
+        self.assertEqual(shared.stats()['entries'], 0)
+
+    def test_shrink_drops_the_oldest_entries(self):
+        shared = cache.SharedCache(self.path, size=1)
+        shared.shrink_every = 1000
+        for i in range(3):
+            shared.set(('dummy', (i,)), 'x' * 400 * 1024)
+
+        shared.shrink()
+        self.assertIsNone(shared.get(('dummy', (0,))))
+        self.assertIsNotNone(shared.get(('dummy', (2,))))
+        self.assertEqual(shared.stats()['entries'], 2)
+
+
+class TestMakeCache(unittest.TestCase):
+
+    def test_local_is_the_default_backend(self):
+        backend = cache.make_cache({'ttl': 10, 'size': 1})
+        self.assertIsInstance(backend, cache.LocalCache)
+
+    def test_shared_backend(self):
+        backend = cache.make_cache({'backend': 'shared', 'path': 'x.db'})
+        self.assertIsInstance(backend, cache.SharedCache)
+        self.assertEqual(backend.path, 'x.db')
+
+    def test_shared_backend_lives_in_the_application(self):
+        path = self.mktemp()
+        os.makedirs(path)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(path)
+
+        backend = cache.make_cache({'backend': 'shared'})
+        self.assertEqual(
+            backend.path, os.path.abspath(cache.SHARED_CACHE_PATH))
+
+    def test_custom_backend(self):
+        backend = cache.LocalCache()
+        self.assertIs(cache.make_cache({'backend': backend}), backend)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, cache.make_cache, {'backend': 'foo'})
@@ -7,7 +7,10 @@ Tests for mamba.utils.converter
 """
 
 import json
+import decimal
+import datetime
 
+from storm.locals import Int, Unicode
 from twisted.trial import unittest
 
 from mamba.utils.converter import Converter
@@ -76,3 +79,43 @@ class ConverterTest(unittest.TestCase):
         c3 = Collaborator2()
 
         self.assertEqual(Converter.serialize(c1), Converter.serialize(c3))
+
+    def test_plan_is_cached_per_class(self):
+
+        class Collaborator(object):
+            name = 'Collaborator'
+
+            def method(self):
+                pass
+
+        Converter.serialize(Collaborator())
+        self.assertEqual(
+            Converter.plans[Collaborator], ('attributes', ('name',))
+        )
+
+    def test_convert_storm_object_uses_columns(self):
+
+        class StormCollaborator(object):
+            __storm_table__ = 'collaborator'
+            id = Int(primary=True)
+            name = Unicode()
+
+            def __init__(self):
+                self.id = 1
+                self.name = u'Collaborator'
+                self.transactor = None
+
+        self.assertEqual(
+            Converter.serialize(StormCollaborator()),
+            {'id': 1, 'name': u'Collaborator'}
+        )
+
+    def test_default_converts_unknown_types(self):
+
+        self.assertEqual(
+            json.dumps(
+                [datetime.date(2013, 1, 1), decimal.Decimal('1.5')],
+                default=Converter.default
+            ),
+            '["2013-01-01", "1.5"]'
+        )
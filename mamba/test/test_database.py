@@ -6,16 +6,24 @@
 Tests for mamba.enterprise.database
 """
 
+from Queue import Queue
+
 from storm.locals import Store
 from doublex import Spy, ANY_ARG
 from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.task import Clock
+from twisted.internet.defer import inlineCallbacks, gatherResults
 from twisted.python.threadpool import ThreadPool
 
 from mamba.utils import config
 from mamba.core import GNU_LINUX
 from mamba.enterprise import Database
 from mamba.application.model import ModelManager
-from mamba.enterprise.database import AdapterFactory
+from mamba.test.test_model import DummyThreadPool
+from mamba.enterprise.database import (
+    AdapterFactory, DatabasePool, PoolAutoscaler, ReplicaSet
+)
 
 
 class DatabaseTest(unittest.TestCase):
@@ -171,6 +179,282 @@ class DatabaseTest(unittest.TestCase):
 
         os.chdir(currdir)
 
+    def test_database_dump_to_gzip_file(self):
+        config.Database('../mamba/test/dummy_app/config/database.json')
+        mgr = self.get_commons_for_dump()
+
+        import os
+        import gzip
+        path = os.path.abspath(self.mktemp() + '.sql.gz')
+        currdir = os.getcwd()
+        os.chdir('../mamba/test/dummy_app/')
+        self.addCleanup(os.chdir, currdir)
+
+        mgr.load('../mamba/test/dummy_app/application/model/dummy.py')
+        mgr.load('../mamba/test/dummy_app/application/model/stubing.py')
+        progress = []
+        size = self.database.dump_to(
+            mgr, path, True, progress=lambda *args: progress.append(args)
+        )
+
+        sql = gzip.open(path).read()
+        self.assertEqual(len(sql), size)
+        self.assertTrue("INSERT INTO 'dummy'" in sql)
+        self.assertTrue('Test row 3' in sql)
+        self.assertIn('dummy', [table for table, rows in progress])
+
+
+class StubPool(object):
+    """Pool with fixed stats for the autoscaler tests"""
+
+    def __init__(self, minthreads, maxthreads):
+        self.min = minthreads
+        self.max = maxthreads
+        self.queue = 0
+        self.idle = 0
+        self.waits = []
+        self.started_workers = 0
+
+    def stats(self):
+        return {'queue': self.queue, 'idle': self.idle, 'busy': 1}
+
+    def take_waits(self):
+        waits, self.waits = self.waits, []
+        return sum(waits), len(waits)
+
+    def adjustPoolsize(self, minthreads=None, maxthreads=None):
+        self.min = minthreads
+        self.max = maxthreads
+
+    def startAWorker(self):
+        self.started_workers += 1
+
+
+class DatabasePoolTest(unittest.TestCase):
+
+    def test_database_pool_is_the_default_pool(self):
+        self.assertIsInstance(Database.pool, DatabasePool)
+
+    def test_database_pool_measures_the_wait_times(self):
+
+        def run_now(pool, onResult, func, *args, **kw):
+            now[0] += 0.5
+            onResult(True, func(*args, **kw))
+
+        now = [0]
+        self.patch(ThreadPool, 'callInThreadWithCallback', run_now)
+        pool = DatabasePool(0, 1, clock=lambda: now[0])
+
+        results = []
+        pool.callInThreadWithCallback(
+            lambda ok, result: results.append(result), lambda: 42
+        )
+
+        self.assertEqual(results, [42])
+        self.assertEqual(pool.stats()['tasks'], 1)
+        self.assertEqual(pool.take_waits(), (0.5, 1))
+        self.assertEqual(pool.take_waits(), (0.0, 0))
+
+    def test_database_pool_stats_without_team(self):
+
+        class OldDatabasePool(DatabasePool):
+            """Pool like the ThreadPool of Twisted < 15.5"""
+
+            working = waiters = q = None
+
+        pool = OldDatabasePool(0, 4)
+        pool._team = None
+        pool.working = [object()]
+        pool.waiters = [object(), object()]
+        pool.q = Queue()
+        pool.q.put(None)
+
+        stats = pool.stats()
+        self.assertEqual(stats['workers'], 3)
+        self.assertEqual(stats['busy'], 1)
+        self.assertEqual(stats['idle'], 2)
+        self.assertEqual(stats['queue'], 1)
+
+
+class PoolAutoscalerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.database = Database(StubPool(5, 5), True)
+        self.autoscaler = PoolAutoscaler(
+            self.database, 5, 20, clock=self.clock
+        )
+
+    def test_grows_by_the_queue_depth(self):
+        self.database.pool.queue = 3
+
+        self.assertEqual(self.autoscaler.check(), 8)
+        self.assertEqual(self.database.pool.max, 8)
+        self.assertEqual(self.database.pool.started_workers, 3)
+
+    def test_grows_when_tasks_wait_too_much(self):
+        self.database.pool.waits = [0.2, 0.1]
+
+        self.assertEqual(self.autoscaler.check(), 6)
+        self.assertEqual(self.database.pool.started_workers, 0)
+
+    def test_never_grows_over_max_threads(self):
+        self.database.pool.max = 19
+        self.database.pool.queue = 10
+
+        self.assertEqual(self.autoscaler.check(), 20)
+        self.database.pool.queue = 1
+        self.assertIsNone(self.autoscaler.check())
+
+    def test_shrinks_after_idle_periods(self):
+        self.database.pool.max = 12
+        self.database.pool.idle = 4
+
+        for _ in range(self.autoscaler.idle_periods - 1):
+            self.assertIsNone(self.autoscaler.check())
+
+        self.assertEqual(self.autoscaler.check(), 10)
+        self.assertEqual(self.database.pool.min, 5)
+
+    def test_never_shrinks_under_min_threads(self):
+        self.database.pool.idle = 4
+
+        for _ in range(self.autoscaler.idle_periods):
+            self.assertIsNone(self.autoscaler.check())
+
+    def test_decisions_are_exposed(self):
+        self.database.pool.queue = 2
+        self.autoscaler.check()
+
+        decision = self.autoscaler.stats()['decisions'][0]
+        self.assertEqual(decision['from'], 5)
+        self.assertEqual(decision['to'], 7)
+        self.assertEqual(decision['reason'], 'queue 2 wait 0.000s')
+
+    def test_checks_every_interval(self):
+        self.autoscaler.start()
+        self.assertTrue(self.autoscaler.running)
+
+        self.database.pool.queue = 1
+        self.clock.advance(self.autoscaler.interval)
+        self.assertEqual(self.database.pool.max, 6)
+
+        self.autoscaler.stop()
+        self.assertFalse(self.autoscaler.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_autoscaler_is_stopped_on_shutdown(self):
+        triggers = []
+        self.patch(
+            reactor, 'addSystemEventTrigger',
+            lambda *args: triggers.append(args)
+        )
+        self.patch(reactor, 'removeSystemEventTrigger', lambda trigger: None)
+        self.patch(config.Database(), 'auto_adjust_pool_size', True)
+
+        database = Database(DatabasePool(0, 1), True)
+        self.addCleanup(database.pool.stop)
+        database.start()
+        self.assertTrue(database.autoscaler.running)
+
+        [(phase, event, stop)] = triggers
+        stop()
+        self.assertIsNone(database.autoscaler)
+        self.assertFalse(database.started)
+
+
+class ReplicaSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.database = Database(DummyThreadPool(), True)
+        self.replicas = ReplicaSet(
+            self.database, ['sqlite:', 'sqlite:', 'sqlite:'],
+            clock=self.clock, pool_factory=lambda name, size: DummyThreadPool()
+        )
+        self.database.replicas = self.replicas
+
+    def test_round_robin_skips_the_unhealthy_replicas(self):
+        one, two, three = self.replicas.replicas
+        two.healthy = False
+
+        chosen = [self.replicas.choose() for _ in range(4)]
+        self.assertEqual(chosen, [three, one, three, one])
+
+    def test_no_healthy_replicas(self):
+        for replica in self.replicas.replicas:
+            replica.healthy = False
+
+        self.assertIsNone(self.replicas.choose())
+        self.assertIsNone(self.database.replica('dummy'))
+
+    def test_least_loaded(self):
+        self.replicas.policy = 'least_loaded'
+        one, two, three = self.replicas.replicas
+        self.patch(one, 'load', lambda: 3)
+        self.patch(two, 'load', lambda: 1)
+        self.patch(three, 'load', lambda: 2)
+
+        self.assertIs(self.replicas.choose(), two)
+
+    def test_unknown_policy(self):
+        self.assertRaises(
+            ValueError, ReplicaSet, self.database, ['sqlite:'], 'random'
+        )
+
+    def test_written_tables_are_read_from_the_primary(self):
+        self.database.wrote('dummy')
+
+        self.assertIsNone(self.database.replica('dummy'))
+        self.assertIsNotNone(self.database.replica('other'))
+
+    @inlineCallbacks
+    def test_health_checks(self):
+        one = self.replicas.replicas[0]
+        one.healthy = False
+        bad = ReplicaSet(
+            self.database, ['sqlite:{}/missing/replica.db'.format(
+                self.mktemp()
+            )], pool_factory=lambda name, size: DummyThreadPool()
+        ).replicas[0]
+
+        results = yield gatherResults([one.check(), bad.check()])
+        self.assertEqual(results, [True, False])
+        self.assertTrue(one.healthy)
+        self.assertFalse(bad.healthy)
+        self.assertEqual(bad.failures, 1)
+
+    def test_checks_every_interval(self):
+        checks = []
+        self.patch(self.replicas, 'check', lambda: checks.append(True))
+
+        self.replicas.start()
+        self.assertTrue(self.replicas.running)
+        self.clock.advance(self.replicas.interval)
+        self.assertEqual(checks, [True])
+
+        self.replicas.stop()
+        self.assertFalse(self.replicas.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_replicas_are_stopped_on_shutdown(self):
+        triggers, removed = [], []
+        self.patch(
+            reactor, 'addSystemEventTrigger',
+            lambda *args: triggers.append(args) or 'trigger'
+        )
+        self.patch(reactor, 'removeSystemEventTrigger', removed.append)
+
+        self.database.start()
+        self.assertTrue(self.replicas.running)
+        [(phase, event, stop)] = triggers
+        self.assertEqual((phase, event), ('before', 'shutdown'))
+
+        stop()
+        self.assertFalse(self.replicas.running)
+        self.assertFalse(self.database.started)
+        self.assertEqual(removed, ['trigger'])
+
 
 class AdapterFactoryTest(unittest.TestCase):
 
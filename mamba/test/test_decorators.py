@@ -6,6 +6,7 @@
 Tests for mamba.core.decorators
 """
 
+from twisted.internet import defer
 from twisted.trial import unittest
 
 from mamba.core import decorators
@@ -57,3 +58,103 @@ class TestDecorators(unittest.TestCase):
         self.assertEqual(hit_count, 4)
         eat_memory(1)
         self.assertEqual(hit_count, 5)
+
+    def test_cache_uses_kwargs_in_key(self):
+
+        @decorators.cache(size=16)
+        def power(base, exp=2):
+            global hit_count
+            hit_count += 1
+
+            return base ** exp
+
+        self.assertEqual(power(2), 4)
+        self.assertEqual(power(2, exp=3), 8)
+        self.assertEqual(power(2, exp=3), 8)
+        self.assertEqual(hit_count, 2)
+
+    def test_cache_works_with_unpicklable_values(self):
+
+        @decorators.cache(size=1)
+        def unpicklable(value):
+            global hit_count
+            hit_count += 1
+
+            return lambda: value
+
+        self.assertIs(unpicklable(1), unpicklable(1))
+        self.assertEqual(hit_count, 1)
+
+    def test_cache_counters(self):
+
+        @decorators.cache(size=2)
+        def eat_memory(ignore):
+            return bytearray(1024 * 1024)
+
+        eat_memory(1)
+        eat_memory(1)
+        eat_memory(2)
+        self.assertEqual(eat_memory.cache.stats()['hits'], 1)
+        self.assertEqual(eat_memory.cache.stats()['misses'], 2)
+        self.assertEqual(eat_memory.cache.stats()['evictions'], 1)
+        self.assertEqual(eat_memory.cache.stats()['entries'], 1)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        lru = decorators.LRUCache(size=2)
+        lru.set('one', bytearray(700 * 1024))
+        lru.set('two', bytearray(700 * 1024))
+        lru.get('one')
+        lru.set('three', bytearray(700 * 1024))
+        self.assertTrue('one' in lru)
+        self.assertFalse('two' in lru)
+        self.assertTrue('three' in lru)
+
+    def test_entries_expire_after_ttl(self):
+        now = [0]
+        lru = decorators.LRUCache(size=0, ttl=10, clock=lambda: now[0])
+        lru.set('key', 'value')
+        self.assertEqual(lru.get('key'), 'value')
+        now[0] = 11
+        self.assertEqual(lru.get('key'), None)
+        self.assertEqual(len(lru), 0)
+        self.assertEqual(lru.memory, 0)
+
+
+class TestDeferredCache(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+        @decorators.deferred_cache(size=16)
+        def transact(value):
+            d = defer.Deferred()
+            self.calls.append(d)
+            return d
+
+        self.transact = transact
+
+    def test_concurrent_misses_are_collapsed(self):
+        results = []
+        self.transact(1).addCallback(results.append)
+        self.transact(1).addCallback(results.append)
+        self.assertEqual(len(self.calls), 1)
+
+        self.calls[0].callback('result')
+        self.assertEqual(results, ['result', 'result'])
+
+        self.transact(1).addCallback(results.append)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, ['result'] * 3)
+
+    def test_failures_are_not_cached(self):
+        first = self.transact(1)
+        second = self.transact(1)
+        self.calls[0].errback(ValueError('fail'))
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, ValueError)
+
+        self.transact(1)
+        self.assertEqual(len(self.calls), 2)
@@ -16,16 +16,23 @@ from storm.uri import URI
 from twisted.trial import unittest
 from twisted.python import filepath
 from storm.exceptions import DatabaseModuleError
+from storm.tracer import install_tracer, remove_tracer
 from storm.twisted.testing import FakeThreadPool
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, succeed
 from storm.locals import Int, Unicode, Reference, Enum, List
+from storm.locals import Store, create_database
 
 from mamba import Database
 from mamba.utils import config
 from mamba import Model, ModelManager
-from mamba.core import interfaces, GNU_LINUX
+from mamba.core import decorators, interfaces, GNU_LINUX
+from mamba.enterprise.cache import SharedCache
 from mamba.enterprise.common import NativeEnum
-from mamba.application.model import InvalidModelSchema
+from mamba.enterprise.database import ReplicaSet
+from mamba.web.asyncjson import ResultStream
+from mamba.application.model import (
+    ModelError, InvalidModelSchema, StaleModelError
+)
 from mamba.enterprise.mysql import MySQLMissingPrimaryKey, MySQL
 from mamba.enterprise.sqlite import SQLiteMissingPrimaryKey, SQLite
 from mamba.enterprise.postgres import PostgreSQLMissingPrimaryKey, PostgreSQL
@@ -124,6 +131,35 @@ class ModelTest(unittest.TestCase):
 
         self.assertEqual(dummy.id, 1)
 
+    @inlineCallbacks
+    def test_model_objects_in_deferred_cache(self):
+        store = self.database.store()
+        self.addCleanup(store.rollback)
+        dummy = DummyModel(u'Cached')
+        store.add(dummy)
+        store.flush()
+        calls = []
+
+        @decorators.deferred_cache(size=1)
+        def read(id):
+            calls.append(id)
+            return succeed(dummy)
+
+        # the estimated size of the model doesn't depend on its store
+        size = decorators._sizeof(dummy)
+        for i in range(100):
+            store.add(DummyModel(u'Dummy {}'.format(i)))
+        store.flush()
+        self.assertEqual(decorators._sizeof(dummy), size)
+        self.assertTrue(size < 4096)
+
+        first = yield read(dummy.id)
+        second = yield read(dummy.id)
+        self.assertIdentical(first, dummy)
+        self.assertIdentical(second, dummy)
+        self.assertEqual(calls, [dummy.id])
+        self.assertEqual(read.cache.stats()['entries'], 1)
+
     @inlineCallbacks
     def test_model_read(self):
         dummy = yield DummyModel().read(1)
@@ -193,6 +229,282 @@ class ModelTest(unittest.TestCase):
         except:
             raise
 
+    def versioned_dummy(self):
+        store = self.database.store()
+        store.execute(
+            'CREATE TABLE `dummy_versioned` ('
+            '    id INTEGER PRIMARY KEY, name TEXT, email TEXT,'
+            '    version INTEGER'
+            ')'
+        )
+        store.execute(
+            'INSERT INTO dummy_versioned VALUES (1, \'Dummy\', NULL, 0)')
+        store.commit()
+
+        def cleanup():
+            store.execute('DROP TABLE `dummy_versioned`')
+            store.commit()
+
+        self.addCleanup(cleanup)
+
+    def trace_statements(self):
+        tracer = StatementTracer()
+        install_tracer(tracer)
+        self.addCleanup(remove_tracer, tracer)
+        return tracer.statements
+
+    @inlineCallbacks
+    def test_model_update_only_writes_changed_columns(self):
+        self.versioned_dummy()
+        dummy = yield DummyModelVersioned().read(1)
+        dummy.email = u'dummy@example.com'
+
+        statements = self.trace_statements()
+        yield dummy.update()
+
+        updates = [s for s in statements if s.startswith('UPDATE')]
+        selects = [s for s in statements if s.startswith('SELECT')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(selects, [])
+        self.assertNotIn('name=', updates[0])
+        self.assertIn('email=', updates[0])
+        self.assertEqual(dummy.version, 1)
+
+    @inlineCallbacks
+    def test_model_update_without_changes_does_nothing(self):
+        self.versioned_dummy()
+        dummy = yield DummyModelVersioned().read(1)
+
+        statements = self.trace_statements()
+        yield dummy.update()
+
+        self.assertEqual(
+            [s for s in statements if s.startswith('UPDATE')], [])
+        self.assertEqual(dummy.version, 0)
+
+    @inlineCallbacks
+    def test_model_update_raises_stale_model_error(self):
+        self.versioned_dummy()
+        dummy = yield DummyModelVersioned().read(1, True)
+        other = yield DummyModelVersioned().read(1, True)
+
+        dummy.name = u'First'
+        yield dummy.update()
+
+        other.name = u'Second'
+        try:
+            yield other.update()
+        except StaleModelError:
+            pass
+        else:
+            self.fail('StaleModelError not raised')
+
+        store = self.database.store()
+        store.invalidate()
+        result = store.get(DummyModelVersioned, 1)
+        self.assertEqual(result.name, u'First')
+        self.assertEqual(result.version, 1)
+
+    @inlineCallbacks
+    def test_model_reuses_the_compiled_queries(self):
+        self.versioned_dummy()
+        dummy = yield DummyModelVersioned().read(1)
+        dummy.name = u'First'
+        yield dummy.update()
+
+        misses = self.database.query_cache.stats()['misses']
+        dummy = yield DummyModelVersioned().read(1)
+        dummy.name = u'Second'
+        yield dummy.update()
+
+        stats = self.database.query_cache.stats()
+        self.assertEqual(stats['misses'], misses)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(dummy.version, 2)
+
+    @inlineCallbacks
+    def test_model_named_query(self):
+        self.versioned_dummy()
+        result = yield DummyModelVersioned.named_query('by_name', u'Dummy')
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].id, 1)
+
+        result = yield DummyModelVersioned.named_query('by_name', u'None')
+        self.assertEqual(result, [])
+
+    @inlineCallbacks
+    def test_model_queries_without_the_storm_internals(self):
+        from mamba.application import model
+        self.patch(model, 'has_internals', lambda obj, names: False)
+        self.versioned_dummy()
+
+        dummy = yield DummyModelVersioned().read(1)
+        self.assertEqual(dummy.name, u'Dummy')
+        result = yield DummyModelVersioned.named_query('by_name', u'Dummy')
+        self.assertEqual([obj.id for obj in result], [1])
+
+    def test_model_named_query_must_be_defined(self):
+        self.assertRaises(ModelError, DummyModel.named_query, 'by_name')
+
+    def replica_dummy(self):
+        path = self.mktemp()
+        store = Store(create_database('sqlite:' + path))
+        store.execute('CREATE TABLE dummy (id INTEGER PRIMARY KEY, name TEXT)')
+        store.execute('INSERT INTO dummy VALUES (200, \'Replica\')')
+        store.commit()
+        store.close()
+
+        self.database.replicas = ReplicaSet(
+            self.database, ['sqlite:' + path],
+            pool_factory=lambda name, size: DummyThreadPool()
+        )
+
+        def cleanup():
+            self.database.replicas = None
+            self.database._writes.clear()
+
+        self.addCleanup(cleanup)
+
+    @inlineCallbacks
+    def test_model_read_from_replica(self):
+        self.replica_dummy()
+        dummy = yield DummyModel().read(200)
+
+        self.assertEqual(dummy.name, u'Replica')
+        self.assertIsNone(Store.of(dummy))
+
+    @inlineCallbacks
+    def test_model_delete_a_replica_read(self):
+        self.replica_dummy()
+        store = self.database.store()
+        store.execute('INSERT INTO dummy VALUES (200, \'Primary\')')
+        store.commit()
+        self.addCleanup(lambda: (
+            store.execute('DELETE FROM dummy WHERE id = 200'), store.commit()
+        ))
+
+        dummy = yield DummyModel().read(200)
+        self.assertEqual(dummy.name, u'Replica')
+        yield dummy.delete()
+
+        self.assertEqual(
+            store.execute('SELECT * FROM dummy WHERE id = 200').get_all(), []
+        )
+
+    @inlineCallbacks
+    def test_model_read_after_write_uses_the_primary(self):
+        self.replica_dummy()
+        dummy = yield DummyModel().read(200)
+        dummy.name = u'Changed'
+        yield dummy.update()
+
+        dummy = yield DummyModel().read(200)
+        self.assertIsNone(dummy)
+
+    def cached_dummy(self):
+        store = self.database.store()
+        store.execute('INSERT INTO dummy VALUES (100, \'Cached\')')
+        store.commit()
+
+        def cleanup():
+            store.execute('DELETE FROM dummy WHERE id = 100')
+            store.commit()
+            Model._caches.pop(DummyModelCached, None)
+
+        self.addCleanup(cleanup)
+
+    @inlineCallbacks
+    def test_model_read_is_cached(self):
+        self.cached_dummy()
+        yield DummyModelCached().read(100)
+
+        statements = self.trace_statements()
+        dummy = yield DummyModelCached().read(100)
+        self.assertEqual(statements, [])
+        self.assertEqual(dummy.id, 100)
+        self.assertEqual(dummy.name, u'Cached')
+
+    @inlineCallbacks
+    def test_model_update_invalidates_the_cache(self):
+        self.cached_dummy()
+        yield DummyModelCached().read(100)
+
+        dummy = yield DummyModelCached().read(100)
+        dummy.name = u'Changed'
+        yield dummy.update()
+        self.assertIsNone(DummyModelCached.get_cache().get(('dummy', (100,))))
+
+        dummy = yield DummyModelCached().read(100, True)
+        self.assertEqual(dummy.name, u'Changed')
+
+    @inlineCallbacks
+    def test_model_read_looks_up_the_shared_cache_in_the_pool(self):
+        self.cached_dummy()
+        shared = SharedCache(self.mktemp())
+        self.patch(Model, '_caches', {DummyModelCached: shared})
+        lookups, reads = [], []
+        get = shared.get
+        self.patch(shared, 'get', lambda key: lookups.append(key) or get(key))
+        run_read = self.database.run_read
+
+        def counted_run_read(*args):
+            # no lookup is done before the read reaches the pool
+            reads.append(len(lookups))
+            return run_read(*args)
+
+        self.patch(self.database, 'run_read', counted_run_read)
+        yield DummyModelCached().read(100)
+        statements = self.trace_statements()
+        dummy = yield DummyModelCached().read(100)
+
+        self.assertEqual(reads, [0, 1])
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual(statements, [])
+        self.assertEqual(dummy.name, u'Cached')
+
+    @inlineCallbacks
+    def test_model_read_invalidated_meanwhile_is_not_cached(self):
+        self.cached_dummy()
+        reader = DummyModelCached()
+        get = reader._get
+
+        def concurrent_update(store, id):
+            # the register is loaded before a concurrent update commits
+            # and invalidates it
+            data = get(store, id)
+            DummyModelCached.get_cache().discard(('dummy', (100,)))
+            return data
+
+        reader._get = concurrent_update
+        dummy = yield reader.read(100)
+        self.assertEqual(dummy.name, u'Cached')
+        self.assertIsNone(DummyModelCached.get_cache().get(('dummy', (100,))))
+
+        yield DummyModelCached().read(100)
+        self.assertIsNotNone(
+            DummyModelCached.get_cache().get(('dummy', (100,))))
+
+    @inlineCallbacks
+    def test_model_delete_invalidates_the_cache(self):
+        self.cached_dummy()
+        dummy = yield DummyModelCached().read(100)
+        yield dummy.delete()
+
+        dummy = yield DummyModelCached().read(100)
+        self.assertIsNone(dummy)
+
+    @inlineCallbacks
+    def test_model_delete_a_cached_read(self):
+        self.cached_dummy()
+        yield DummyModelCached().read(100)
+        dummy = yield DummyModelCached().read(100)
+        self.assertIsNone(Store.of(dummy))
+        yield dummy.delete()
+
+        self.assertIsNone(DummyModelCached.get_cache().get(('dummy', (100,))))
+        dummy = yield DummyModelCached().read(100)
+        self.assertIsNone(dummy)
+
     def test_model_delete(self):
         dummy = yield DummyModel().read(1)
         dummy.delete()
@@ -200,6 +512,213 @@ class ModelTest(unittest.TestCase):
         store = self.database.store()
         self.assertTrue(len(store.find(DummyModel)) == 0)
 
+    @inlineCallbacks
+    def test_result_stream_pages_rows_in_batches(self):
+        names = (u'One', u'Two', u'Three')
+        store = self.database.store()
+        for name in names:
+            store.add(DummyModel(name))
+        store.commit()
+
+        def cleanup():
+            store.find(DummyModel, DummyModel.name.is_in(names)).remove()
+            store.commit()
+
+        self.addCleanup(cleanup)
+
+        stream = ResultStream(
+            DummyModel,
+            lambda store: store.find(DummyModel, DummyModel.name.is_in(names)),
+            batch_size=2
+        )
+        statements = self.trace_statements()
+        first = yield stream.fetch()
+        # removing a register already streamed doesn't shift the pages
+        store.execute('DELETE FROM dummy WHERE name = \'One\'')
+        store.commit()
+        second = yield stream.fetch()
+        third = yield stream.fetch()
+
+        self.assertEqual(
+            [row['name'] for row in first + second], [u'One', u'Two', u'Three']
+        )
+        self.assertEqual(len(first), 2)
+        self.assertEqual(third, [])
+        self.assertFalse(any('OFFSET' in s for s in statements))
+
+    def cleanup_dummies(self, names):
+        store = self.database.store()
+
+        def cleanup():
+            store.find(DummyModel, DummyModel.name.is_in(names)).remove()
+            store.commit()
+
+        self.addCleanup(cleanup)
+
+    @inlineCallbacks
+    def test_model_bulk_create(self):
+        names = [u'Bulk {}'.format(i) for i in range(5)]
+        self.cleanup_dummies(names)
+
+        rows = [DummyModel(name) for name in names[:3]]
+        rows += [{'name': name} for name in names[3:]]
+        count = yield DummyModel.bulk_create(rows, batch_size=2)
+
+        store = self.database.store()
+        result = store.find(DummyModel, DummyModel.name.is_in(names))
+        self.assertEqual(count, 5)
+        self.assertEqual(
+            sorted(row.name for row in result), sorted(names))
+
+    @inlineCallbacks
+    def test_model_bulk_update(self):
+        names = [u'Bulk {}'.format(i) for i in range(3)]
+        updated = [u'Updated {}'.format(i) for i in range(3)]
+        self.cleanup_dummies(names + updated)
+
+        yield DummyModel.bulk_create({'name': name} for name in names)
+        store = self.database.store()
+        ids = [row.id for row in store.find(
+            DummyModel, DummyModel.name.is_in(names)).order_by(DummyModel.id)]
+        store.commit()
+
+        count = yield DummyModel.bulk_update(
+            [{'id': id, 'name': name} for id, name in zip(ids, updated)] +
+            [{'id': max(ids) + 100, 'name': u'Missing'}])
+        self.assertEqual(count, 3)
+
+        store = self.database.store()
+        store.invalidate()
+        result = store.find(
+            DummyModel, DummyModel.id.is_in(ids)).order_by(DummyModel.id)
+        self.assertEqual([row.name for row in result], updated)
+        self.assertIsNone(store.get(DummyModel, max(ids) + 100))
+
+    @inlineCallbacks
+    def test_model_bulk_update_requires_primary_key(self):
+        try:
+            yield DummyModel.bulk_update([{'name': u'Nobody'}])
+        except ModelError:
+            pass
+        else:
+            self.fail('ModelError not raised')
+
+    def test_sqlite_insert_many_honours_the_parameters_limit(self):
+        adapter = self.get_adapter()
+        statements = adapter.insert_many(
+            ['id', 'name'], [(i, u'Dummy') for i in range(1000)])
+
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(len(statements[0][1]), 998)
+        self.assertTrue(statements[0][0].startswith(
+            'INSERT INTO dummy (id, name) VALUES (?, ?), (?, ?)'))
+
+    def dump_database(self):
+        path = self.mktemp()
+        store = Store(create_database('sqlite:' + path))
+        store.execute('CREATE TABLE dummy (id INTEGER PRIMARY KEY, name TEXT)')
+        store.execute(
+            'CREATE TABLE dummy_two (dummy_id INTEGER, id INTEGER, '
+            'name TEXT, PRIMARY KEY(dummy_id, id))'
+        )
+        names = [u"O'Reilly", None, u'\xd1u', u'Four', u'Five']
+        for id, name in enumerate(names, 1):
+            store.execute('INSERT INTO dummy VALUES (?, ?)', (id, name))
+        for key in [(1, 1), (1, 2), (2, 1)]:
+            store.execute('INSERT INTO dummy_two VALUES (?, ?, NULL)', key)
+        store.commit()
+        store.close()
+
+        cfg = FakeConfig(uri='sqlite:' + path)
+        self.patch(config, 'Database', lambda *args: cfg)
+
+    def test_sqlite_iter_insert_data_pages_the_rows(self):
+        adapter = self.get_adapter()
+        self.dump_database()
+
+        progress = []
+        chunks = list(adapter.iter_insert_data(2, progress.append))
+
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(
+            chunks[0],
+            "INSERT INTO 'dummy' (id, name) VALUES "
+            "(1, 'O''Reilly'), (2, NULL);\n"
+        )
+        self.assertEqual(
+            chunks[1],
+            "INSERT INTO 'dummy' (id, name) VALUES "
+            "(3, '\xc3\x91u'), (4, 'Four');\n"
+        )
+        self.assertEqual(
+            adapter.insert_data(), ''.join(adapter.iter_insert_data()))
+
+    def test_postgres_iter_insert_data_quotes_the_names(self):
+        adapter = PostgreSQL(DummyModel())
+        self.dump_database()
+
+        chunks = list(adapter.iter_insert_data(2))
+        self.assertEqual(
+            chunks[0],
+            'INSERT INTO "dummy" ("id", "name") VALUES '
+            "(1, 'O''Reilly'), (2, NULL);\n"
+        )
+
+    def test_postgres_literals(self):
+        adapter = PostgreSQL(DummyModel())
+        self.assertEqual(adapter._literal(True), 'TRUE')
+        self.assertEqual(adapter._literal([1, 2]), 'ARRAY[1, 2]')
+        self.assertEqual(adapter._literal([]), "'{}'")
+
+    def test_sqlite_iter_insert_data_with_compound_key(self):
+        adapter = DummyModelCompound().get_adapter()
+        self.dump_database()
+
+        chunks = list(adapter.iter_insert_data(2))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(chunks[1].count('), ('), 0)
+
+    def test_sqlite_update_many(self):
+        adapter = self.get_adapter()
+        statements = adapter.update_many(
+            ['id', 'name'], ['id'], [(1, u'One'), (2, u'Two')])
+
+        self.assertEqual(statements, [
+            ('UPDATE dummy SET name = ? WHERE id = ?', [u'One', 1]),
+            ('UPDATE dummy SET name = ? WHERE id = ?', [u'Two', 2])
+        ])
+
+    def test_sqlite_update_many_without_columns_to_update(self):
+        adapter = self.get_adapter()
+        self.assertEqual(adapter.update_many(['id'], ['id'], [(1,)]), [])
+
+    def test_mysql_update_many(self):
+        adapter = MySQL(DummyModel())
+        statements = adapter.update_many(
+            ['id', 'name'], ['id'], [(1, u'One'), (2, u'Two')])
+
+        self.assertEqual(statements, [(
+            'UPDATE `dummy` JOIN (SELECT ? AS `id`, ? AS `name` UNION ALL '
+            'SELECT ?, ?) AS mamba_bulk ON `dummy`.`id` = mamba_bulk.`id` '
+            'SET `dummy`.`name` = mamba_bulk.`name`',
+            [1, u'One', 2, u'Two']
+        )])
+        self.assertEqual(adapter.update_many(['id'], ['id'], [(1,)]), [])
+
+    def test_postgres_update_many(self):
+        adapter = PostgreSQL(DummyModel())
+        statements = adapter.update_many(
+            ['id', 'name'], ['id'], [(1, u'One'), (2, u'Two')])
+
+        self.assertEqual(statements, [(
+            'UPDATE "dummy" SET "name" = mamba_bulk."name"::varchar(64) '
+            'FROM (VALUES (?, ?), (?, ?)) AS mamba_bulk ("id", "name") '
+            'WHERE "dummy"."id" = mamba_bulk."id"::integer',
+            [1, u'One', 2, u'Two']
+        )])
+        self.assertEqual(adapter.update_many(['id'], ['id'], [(1,)]), [])
+
     def test_model_dump_table(self):
         dummy = DummyModel()
         script = dummy.dump_table()
@@ -602,6 +1121,27 @@ class DummyModelCompound(Model):
         self.name = name
 
 
+class DummyModelCached(Model):
+    """Dummy Model with read cache for testing purposes"""
+
+    __storm_table__ = 'dummy'
+    __cache__ = {'ttl': 60}
+    id = Int(primary=True)
+    name = Unicode()
+
+
+class DummyModelVersioned(Model):
+    """Dummy Model with optimistic locking for testing purposes"""
+
+    __storm_table__ = 'dummy_versioned'
+    __version_column__ = 'version'
+    __queries__ = {'by_name': 'name = ?'}
+    id = Int(primary=True)
+    name = Unicode()
+    email = Unicode()
+    version = Int()
+
+
 class DummyModelThree(Model):
     """Dummy Model for testing purposes"""
 
@@ -644,6 +1184,24 @@ class NotPrimaryModel(Model):
     _storm_columns = {}
 
 
+class FakeConfig(object):
+    """Database config like object"""
+
+    def __init__(self, **options):
+        self.__dict__.update(options)
+
+
+class StatementTracer(object):
+    """Storm tracer that records the executed statements"""
+
+    def __init__(self):
+        self.statements = []
+
+    def connection_raw_execute(self, connection, raw_cursor, statement,
+                               params):
+        self.statements.append(statement)
+
+
 class DummyThreadPool(FakeThreadPool):
 
     def start(self):
@@ -0,0 +1,187 @@
+# Copyright (c) 2012 - Oscar Campos <oscar.campos@member.fsf.org>
+# See LICENSE for more details
+
+"""
+Tests for mamba.enterprise.querycache
+"""
+
+from storm.locals import SQL, Store
+from storm.database import create_database
+from storm.expr import Select
+from storm.expr import compile as default_compile
+from twisted.trial import unittest
+
+from mamba.enterprise.querycache import (
+    CompiledQuery, QueryCache, number_param_marks, get_compiler, store_scheme
+)
+
+
+class FakeStore(object):
+    """Storm like store that records the executed statements"""
+
+    def __init__(self):
+        self.statements = []
+        self._connection = self
+        self._raw_connection = object()
+        self.errors = {}
+
+    def _ensure_connected(self):
+        if self._raw_connection is None:
+            self._raw_connection = object()
+
+    def execute(self, statement, params=None, noresult=False):
+        self._ensure_connected()
+        self.statements.append((statement, params))
+        if statement in self.errors:
+            raise self.errors[statement]
+
+
+class DuplicatePreparedStatement(Exception):
+    """psycopg2 like error of an already prepared statement"""
+
+    pgcode = '42P05'
+
+
+class TestNumberParamMarks(unittest.TestCase):
+
+    def test_marks_are_numbered(self):
+        self.assertEqual(
+            number_param_marks('SELECT * FROM dummy WHERE a = ? AND b = ?'),
+            ('SELECT * FROM dummy WHERE a = $1 AND b = $2', 2)
+        )
+
+    def test_quoted_marks_are_ignored(self):
+        self.assertEqual(
+            number_param_marks("SELECT '?' FROM dummy WHERE a = ?"),
+            ("SELECT '?' FROM dummy WHERE a = $1", 1)
+        )
+
+
+class TestGetCompiler(unittest.TestCase):
+
+    def test_backend_compiler(self):
+        from storm.databases import sqlite
+        self.assertIs(get_compiler('sqlite'), sqlite.compile)
+
+    def test_missing_backend_falls_back_to_default(self):
+        self.assertIs(get_compiler('unknown'), default_compile)
+
+
+class TestCompiledQuery(unittest.TestCase):
+
+    def test_plain_execute(self):
+        store = FakeStore()
+        CompiledQuery('SELECT ?').execute(store, (1,))
+        self.assertEqual(store.statements, [('SELECT ?', (1,))])
+
+    def test_prepared_once_by_connection(self):
+        store = FakeStore()
+        query = CompiledQuery('SELECT ?', prepare=True)
+        query.execute(store, (1,))
+        query.execute(store, (2,))
+
+        self.assertEqual(store.statements, [
+            ('SAVEPOINT mamba_prepare', None),
+            ('PREPARE {} AS SELECT $1'.format(query.name), None),
+            ('RELEASE SAVEPOINT mamba_prepare', None),
+            ('EXECUTE {} (?)'.format(query.name), (1,)),
+            ('EXECUTE {} (?)'.format(query.name), (2,))
+        ])
+
+        store._raw_connection = object()
+        query.execute(store, (3,))
+        self.assertTrue(store.statements[6][0].startswith('PREPARE'))
+        self.assertEqual(query.executions, 3)
+
+    def test_prepared_statements_need_the_storm_internals(self):
+        store = FakeStore()
+        store._connection = object()
+        CompiledQuery('SELECT ?', prepare=True).execute(store, (1,))
+        self.assertEqual(store.statements, [('SELECT ?', (1,))])
+
+    def test_prepared_once_after_a_reconnection(self):
+        store = FakeStore()
+        # Storm drops the raw connection when it gets disconnected and
+        # only connects again in the next execute
+        store._raw_connection = None
+        query = CompiledQuery('SELECT ?', prepare=True)
+        query.execute(store, (1,))
+        query.execute(store, (2,))
+
+        self.assertEqual(
+            [s for s, _ in store.statements if s.startswith('PREPARE')],
+            ['PREPARE {} AS SELECT $1'.format(query.name)]
+        )
+
+    def test_already_prepared_statements_are_executed(self):
+        store = FakeStore()
+        query = CompiledQuery('SELECT ?', prepare=True)
+        prepare = 'PREPARE {} AS SELECT $1'.format(query.name)
+        store.errors[prepare] = DuplicatePreparedStatement()
+        query.execute(store, (1,))
+        del store.errors[prepare]
+        query.execute(store, (2,))
+
+        self.assertEqual(store.statements, [
+            ('SAVEPOINT mamba_prepare', None),
+            (prepare, None),
+            ('ROLLBACK TO SAVEPOINT mamba_prepare', None),
+            ('RELEASE SAVEPOINT mamba_prepare', None),
+            ('EXECUTE {} (?)'.format(query.name), (1,)),
+            ('EXECUTE {} (?)'.format(query.name), (2,))
+        ])
+
+    def test_prepare_errors_are_raised(self):
+        store = FakeStore()
+        query = CompiledQuery('SELECT ?', prepare=True)
+        store.errors['PREPARE {} AS SELECT $1'.format(query.name)] = (
+            ValueError())
+        self.assertRaises(ValueError, query.execute, store, (1,))
+        self.assertEqual(len(store.statements), 2)
+        self.assertNotIn(query.name, store._mamba_prepared[1])
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = QueryCache()
+        self.build = lambda: Select(SQL('1'), SQL('id = ?'))
+
+    def test_queries_are_compiled_once(self):
+        query = self.cache.get(('dummy', 'one'), 'sqlite', self.build)
+        self.assertIs(
+            self.cache.get(('dummy', 'one'), 'sqlite', self.build), query)
+        self.assertEqual(query.statement, 'SELECT 1 WHERE id = ?')
+        self.assertFalse(query.prepare)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_postgres_queries_are_prepared(self):
+        query = self.cache.get(('dummy', 'one'), 'postgres', self.build)
+        self.assertTrue(query.prepare)
+
+    def test_prepared_statements_can_be_disabled(self):
+        cache = QueryCache(prepare=False)
+        query = cache.get(('dummy', 'one'), 'postgres', self.build)
+        self.assertFalse(query.prepare)
+
+    def test_queries_are_cached_by_scheme(self):
+        sqlite = self.cache.get(('dummy', 'one'), 'sqlite', self.build)
+        postgres = self.cache.get(('dummy', 'one'), 'postgres', self.build)
+        self.assertIsNot(sqlite, postgres)
+        self.assertFalse(sqlite.prepare)
+        self.assertTrue(postgres.prepare)
+        self.assertEqual(self.cache.stats()['queries'], 2)
+
+    def test_store_scheme(self):
+        store = Store(create_database('sqlite:'))
+        self.addCleanup(store.close)
+        self.assertEqual(store_scheme(store), 'sqlite')
+
+    def test_clear(self):
+        self.cache.get(('dummy', 'one'), 'sqlite', self.build)
+        self.cache.clear()
+        self.assertEqual(self.cache.stats()['queries'], 0)
@@ -18,6 +18,10 @@ class ResponseTest(unittest.TestCase):
         result = response.Ok()
         self.assertEqual(result.code, http.OK)
 
+    def test_switching_protocols_code_is_101(self):
+        result = response.SwitchingProtocols()
+        self.assertEqual(result.code, http.SWITCHING)
+
     def test_response_bad_request_code_is_400(self):
         result = response.BadRequest()
         self.assertEqual(result.code, http.BAD_REQUEST)
@@ -44,3 +48,7 @@ class ResponseTest(unittest.TestCase):
     def test_not_implemented_code_is_501(self):
         result = response.NotImplemented('/test')
         self.assertEqual(result.code, http.NOT_IMPLEMENTED)
+
+    def test_upgrade_required_code_is_426(self):
+        result = response.UpgradeRequired()
+        self.assertEqual(result.code, 426)
@@ -0,0 +1,177 @@
+# Copyright (c) 2012 - Oscar Campos <oscar.campos@member.fsf.org>
+# See LICENSE for more details
+
+"""
+Tests for mamba.enterprise.sharding
+"""
+
+from storm.locals import Int, Unicode, Store, create_database
+from twisted.trial import unittest
+from storm.exceptions import DatabaseModuleError
+from twisted.internet.defer import inlineCallbacks
+
+from mamba import Model
+from mamba.utils import config
+from mamba.enterprise import Database
+from mamba.application.model import ModelError
+from mamba.enterprise.sharding import ShardMap, ShardingError
+from mamba.test.test_model import DummyThreadPool, FakeConfig
+
+
+class ShardMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shard_map = ShardMap('users', ['sqlite:', 'sqlite:'])
+
+    def test_integer_keys(self):
+        self.assertEqual(self.shard_map.index(4), 0)
+        self.assertEqual(self.shard_map.index(7), 1)
+        self.assertIs(self.shard_map.shard_for(7), self.shard_map.shards[1])
+
+    def test_string_keys_are_stable(self):
+        self.assertEqual(self.shard_map.index('foo'), 1)
+        self.assertEqual(self.shard_map.index(u'foo'), 1)
+        self.assertEqual(self.shard_map.index('bar'), 0)
+
+    def test_none_key(self):
+        self.assertRaises(ShardingError, self.shard_map.index, None)
+
+    def test_shards_are_unique_stores(self):
+        names = [shard.name for shard in self.shard_map.shards]
+        self.assertEqual(len(set(names)), 2)
+
+    def test_from_config(self):
+        cfg = FakeConfig(shards={'users': ['sqlite:']})
+        self.patch(config, 'Database', lambda: cfg)
+        self.assertEqual(len(ShardMap.from_config('users').shards), 1)
+        self.assertRaises(ShardingError, ShardMap.from_config, 'messages')
+
+
+class ShardedModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.paths = [self.mktemp(), self.mktemp()]
+        for path in self.paths:
+            store = Store(create_database('sqlite:' + path))
+            store.execute(
+                'CREATE TABLE sharded_dummy (id INTEGER PRIMARY KEY, '
+                'name TEXT)'
+            )
+            store.commit()
+            store.close()
+
+        try:
+            self.patch(Model, 'database', Database(DummyThreadPool(), True))
+        except DatabaseModuleError as error:
+            raise unittest.SkipTest(error)
+
+        Model.database._shard_maps['sharded_dummy'] = ShardMap(
+            'sharded_dummy', ['sqlite:' + path for path in self.paths]
+        )
+
+    def rows(self, index):
+        store = Store(create_database('sqlite:' + self.paths[index]))
+        try:
+            return store.execute(
+                'SELECT id, name FROM sharded_dummy ORDER BY id').get_all()
+        finally:
+            store.close()
+
+    @inlineCallbacks
+    def create(self, *ids):
+        for id in ids:
+            dummy = ShardedDummy()
+            dummy.id = id
+            dummy.name = u'Dummy {}'.format(id)
+            yield dummy.create()
+
+    @inlineCallbacks
+    def test_create_routes_to_the_shard(self):
+        yield self.create(1, 2, 3)
+
+        self.assertEqual(self.rows(0), [(2, u'Dummy 2')])
+        self.assertEqual(self.rows(1), [(1, u'Dummy 1'), (3, u'Dummy 3')])
+
+    @inlineCallbacks
+    def test_read_update_and_delete(self):
+        yield self.create(1, 2)
+
+        dummy = yield ShardedDummy().read(1)
+        self.assertEqual(dummy.name, u'Dummy 1')
+
+        dummy.name = u'Changed'
+        yield dummy.update()
+        self.assertEqual(self.rows(1), [(1, u'Changed')])
+
+        yield dummy.delete()
+        self.assertEqual(self.rows(1), [])
+        self.assertEqual(self.rows(0), [(2, u'Dummy 2')])
+
+    @inlineCallbacks
+    def test_fan_out_merges_the_results(self):
+        yield self.create(1, 2, 3)
+
+        dummies = yield ShardedDummy.named_query('all')
+        self.assertEqual(
+            sorted(dummy.id for dummy in dummies), [1, 2, 3])
+
+    @inlineCallbacks
+    def test_bulk_create_groups_the_rows_by_shard(self):
+        count = yield ShardedDummy.bulk_create([
+            {'id': 1, 'name': u'One'}, {'id': 2, 'name': u'Two'}
+        ])
+
+        self.assertEqual(count, 2)
+        self.assertEqual(self.rows(0), [(2, u'Two')])
+        self.assertEqual(self.rows(1), [(1, u'One')])
+
+    def test_fan_out_requires_a_sharded_model(self):
+        from mamba.test.test_model import DummyModel
+        self.assertRaises(ModelError, DummyModel.fan_out, list)
+
+    def test_dump_shards(self):
+        manager = FakeModelManager(ShardedDummy())
+        dumps = Model.database.dump_shards(manager)
+
+        self.assertEqual(len(dumps), 2)
+        for shard, sql in dumps:
+            self.assertIn(shard.name, sql)
+            self.assertIn('CREATE TABLE', sql)
+            self.assertIn('sharded_dummy', sql)
+
+    @inlineCallbacks
+    def test_full_dump_has_the_data_of_the_shards(self):
+        yield ShardedDummy.bulk_create([
+            {'id': 1, 'name': u'One'}, {'id': 2, 'name': u'Two'}
+        ])
+
+        sql = Model.database.dump(
+            FakeModelManager(ShardedDummy()), full=True)
+        for shard in Model.database.shard_map('sharded_dummy').shards:
+            self.assertIn('of the shard {}'.format(shard.name), sql)
+        self.assertIn("(1, 'One')", sql)
+        self.assertIn("(2, 'Two')", sql)
+        self.assertNotIn('CREATE TABLE', sql)
+
+
+class FakeModelManager(object):
+    """ModelManager like object that returns the given model objects"""
+
+    def __init__(self, *models):
+        self.models = models
+
+    def get_models(self):
+        return dict(
+            (index, {'object': model})
+            for index, model in enumerate(self.models)
+        )
+
+
+class ShardedDummy(Model):
+    """Dummy sharded Model for testing purposes"""
+
+    __storm_table__ = 'sharded_dummy'
+    __shard_key__ = 'id'
+    __queries__ = {'all': '1 = 1'}
+    id = Int(primary=True)
+    name = Unicode()
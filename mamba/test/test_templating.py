@@ -7,14 +7,33 @@ Tests for mamba.core.templating
 """
 
 import os
+import shutil
+import tempfile
 
 from twisted.trial import unittest
 
+from mamba.core import templating
 from mamba.core.templating import MambaTemplate, Template
 from mamba.test.dummy_app.application.controller.dummy import DummyController
 from mamba.core.templating import TemplateNotFound, NotConfigured
 
 
+def isolate_bytecode_cache(test, path=None):
+    """
+    Store the compiled templates of the given test case in path (a
+    temporary directory by default) and use fresh shared environments,
+    the shared environments keep their bytecode cache so the ones made by
+    other tests would dump the compiled templates in the dummy application
+    """
+
+    if path is None:
+        path = os.path.abspath(test.mktemp())
+
+    test.patch(templating, 'BYTECODE_CACHE_PATH', path)
+    test.patch(templating, '_bytecode_caches', {})
+    test.patch(templating, '_environments', {})
+
+
 class MambaTemplateTest(unittest.TestCase):
 
     def test_mamba_template(self):
@@ -51,6 +70,7 @@ class MambaTemplateTest(unittest.TestCase):
 class TemplateTest(unittest.TestCase):
 
     def setUp(self):
+        isolate_bytecode_cache(self)
         self.currdir = os.getcwd()
         os.chdir('../mamba/test/dummy_app')
 
@@ -142,3 +162,94 @@ class TemplateTest(unittest.TestCase):
             NotConfigured,
             self.template.render
         )
+
+
+class EnvironmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.currdir = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        self.templates = os.path.join(
+            self.path, 'application', 'view', 'templates')
+        os.makedirs(self.templates)
+        with open(os.path.join(self.templates, 'test.html'), 'w') as fd:
+            fd.write('{{ title }}')
+
+        os.chdir(self.path)
+        isolate_bytecode_cache(self, templating.BYTECODE_CACHE_PATH)
+
+    def tearDown(self):
+        os.chdir(self.currdir)
+        shutil.rmtree(self.path)
+
+    def test_environments_are_shared(self):
+
+        env = templating.get_environment([self.templates])
+        self.assertIdentical(
+            env, templating.get_environment(
+                ['application/view/templates'])
+        )
+        self.assertNotIdentical(
+            env, templating.get_environment([self.templates], cache_size=10)
+        )
+
+    def test_templates_share_environment(self):
+
+        self.assertIdentical(MambaTemplate().env, MambaTemplate().env)
+
+        first, second = Template(), Template()
+        first.render('test.html')
+        self.assertRaises(TemplateNotFound, second.render, 'fail.html')
+        self.assertIdentical(first.env, second.env)
+
+    def test_environment_overrides_are_not_kept(self):
+
+        with open(os.path.join(self.templates, 'vars.html'), 'w') as fd:
+            fd.write('{{ title }} [[ title ]]')
+
+        template = Template()
+        template.render('vars.html', title='T')
+        env = template.env
+        self.assertEqual(
+            template.render(
+                'vars.html', title='T',
+                variable_start_string='[[', variable_end_string=']]'
+            ),
+            '{{ title }} T'
+        )
+        self.assertIdentical(template.env, env)
+        self.assertEqual(env.variable_start_string, '{{')
+        self.assertEqual(
+            template.render('vars.html', title='T'), 'T [[ title ]]')
+
+    def test_bytecode_cache_is_stored_under_application(self):
+
+        env = templating.get_environment([self.templates])
+        self.assertIdentical(env.bytecode_cache, templating.bytecode_cache())
+        self.assertNotIdentical(
+            env.bytecode_cache,
+            templating.bytecode_cache(templating.autoescape_html)
+        )
+        self.assertEqual(env.get_template('test.html').render(title='T'), 'T')
+        self.assertEqual(
+            len(os.listdir(templating.BYTECODE_CACHE_PATH)), 1)
+
+    def test_bytecode_cache_disabled_outside_applications(self):
+
+        os.chdir(self.currdir)
+        self.assertIdentical(templating.bytecode_cache(), None)
+
+    def test_warm_compiles_templates(self):
+
+        with open(os.path.join(self.templates, 'broken.html'), 'w') as fd:
+            fd.write('{% if %}')
+
+        env = templating.get_environment([self.templates])
+        self.assertEqual(templating.warm(env), 1)
+
+    def test_bytecode_cache_survives_its_directory_removal(self):
+
+        env = templating.get_environment([self.templates])
+        shutil.rmtree(templating.BYTECODE_CACHE_PATH)
+        self.assertEqual(env.get_template('test.html').render(title='T'), 'T')
+        self.assertTrue(os.path.isdir(templating.BYTECODE_CACHE_PATH))
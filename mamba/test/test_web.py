@@ -7,26 +7,39 @@ Tests for mamba.web
 """
 
 import sys
+import json
+import shutil
 import tempfile
+from hashlib import md5
 from os import sep
 from cStringIO import StringIO
 
-from twisted.internet import defer
+from twisted.web import http, server
+from twisted.protocols import wire
 from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
 from twisted.python import filepath
 from twisted.web.server import Request
 from twisted.web.http_headers import Headers
 from twisted.web.test.test_web import DummyRequest
+from twisted.internet.protocol import Factory
 from twisted.internet.error import ProcessTerminated
 from doublex import Stub, ProxySpy, Spy, called, assert_that
 
-from mamba.core import GNU_LINUX
+from mamba.core import GNU_LINUX, templating
 from mamba.application import appstyles, controller, scripts
 from mamba.application import route as decoroute
+from mamba.application import websocket as decowebsocket
 from mamba.web import stylesheet, page, asyncjson, response, script
-from mamba.web.routing import Route, Router, RouteDispatcher
+from mamba.web import websocket
+from mamba.web.routing import (
+    Route, RouteMatch, Router, RouteDispatcher, RouteTrie, RouteCache
+)
 
 from mamba.test.test_less import less_file
+from mamba.test.test_templating import isolate_bytecode_cache
+from mamba.test.test_websocket import data as websocket_handshake
 from mamba.test.dummy_app.application.controller.dummy import DummyController
 
 
@@ -239,23 +252,99 @@ class AsyncJSONTest(unittest.TestCase):
         consumer = Spy(Request)
 
         ajson = ProxySpy(asyncjson.AsyncJSON({'id': 1, 'name': 'Test'}))
-        r = yield ajson.begin(consumer)
-        for p in r:
-            pass
-        assert_that(consumer.registerProducer, called().times(1))
-        assert_that(consumer.write, called())
-        assert_that(consumer.unregisterProducer, called().times(1))
+        yield ajson.begin(consumer)
+        assert_that(consumer.registerProducer, called().times(0))
+        assert_that(consumer.write, called().times(1))
         assert_that(ajson.begin, called())
         self.flushLoggedErrors()
 
+    @defer.inlineCallbacks
+    def test_asyncjson_writes_big_payloads_in_chunks(self):
+
+        written = []
+        consumer = Spy(Request)
+        consumer.write = written.append
+
+        value = [{'id': i, 'name': 'Test' * 10} for i in range(10000)]
+        yield asyncjson.AsyncJSON(value).begin(consumer)
+
+        assert_that(consumer.registerProducer, called().times(1))
+        assert_that(consumer.unregisterProducer, called().times(1))
+        self.assertTrue(len(written) > 1)
+        self.assertTrue(
+            all(len(c) >= asyncjson.AsyncJSON.chunk_size for c in written[:-1])
+        )
+        self.assertEqual(json.loads(''.join(written)), value)
+
+    @defer.inlineCallbacks
+    def test_asyncjson_encodes_objects(self):
+
+        written = []
+        consumer = Spy(Request)
+        consumer.write = written.append
+
+        yield asyncjson.AsyncJSON({1: [Person()]}).begin(consumer)
+        self.assertEqual(json.loads(''.join(written)), {
+            '1': [{'name': 'Person', 'interests': 'Testing', 'age': 30}]
+        })
+
+
+class JSONStreamTest(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_stream_rows_as_json_array_in_batches(self):
+
+        written = []
+        consumer = Spy(Request)
+        consumer.write = written.append
+
+        stream = asyncjson.JSONStream(({'id': i} for i in range(5)), 2)
+        yield stream.begin(consumer)
+
+        assert_that(consumer.registerProducer, called().times(1))
+        assert_that(consumer.unregisterProducer, called().times(1))
+        self.assertEqual(len(written), 5)
+        self.assertEqual(
+            json.loads(''.join(written)), [{'id': i} for i in range(5)])
+
+    @defer.inlineCallbacks
+    def test_stream_rows_as_ndjson(self):
+
+        written = []
+        consumer = Spy(Request)
+        consumer.write = written.append
+
+        stream = asyncjson.JSONStream([{'id': 1}, {'id': 2}])
+        stream.ndjson = True
+        yield stream.begin(consumer)
+
+        self.assertEqual(''.join(written), '{"id": 1}\n{"id": 2}\n')
+
+    @defer.inlineCallbacks
+    def test_router_sets_ndjson_content_type_on_accept(self):
+
+        StubController.test2 = routes_generator(asyncjson.JSONStream([]))
+        request = request_generator(['/test2'])
+        request.requestHeaders.setRawHeaders(
+            'accept', ['application/x-ndjson'])
+
+        result = yield StubController().render(request)
+        self.assertIsInstance(result.subject, asyncjson.JSONStream)
+        self.assertTrue(result.subject.ndjson)
+        self.assertEqual(
+            result.headers, {'content-type': 'application/x-ndjson'})
+
 
 class PageTest(unittest.TestCase):
 
     def setUp(self):
+        isolate_bytecode_cache(self)
         self.root = page.Page(self.get_commons())
 
     def tearDown(self):
         self.flushLoggedErrors()
+        if self.root.notifier is not None:
+            self.root.notifier.loseConnection()
 
     def get_commons(self):
 
@@ -368,6 +457,105 @@ class PageTest(unittest.TestCase):
             mgr.lookup('dummy')['object']
         )
 
+    def use_templates(self, **templates):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        for name, source in templates.iteritems():
+            with open(filepath.os.path.join(path, name), 'w') as fd:
+                fd.write(source)
+
+        self.root.template_paths = [path]
+        self.root.environment = templating.get_environment([path])
+        self.root.template_index = None
+        return path
+
+    def enable_render_cache(self):
+        self.addCleanup(
+            setattr, self.root.config, 'render_cache',
+            getattr(self.root.config, 'render_cache', False)
+        )
+        self.root.config.render_cache = True
+
+    def test_template_index_is_built_once(self):
+
+        self.use_templates(**{'test.html': 'test'})
+        calls = []
+        list_templates = self.root.environment.list_templates
+        self.root.environment.list_templates = lambda: (
+            calls.append(1) or list_templates()
+        )
+
+        for i in range(3):
+            self.assertIdentical(
+                self.root, self.root.getChild('test', DummyRequest(['']))
+            )
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.root.template_index, {'test': 'test.html'})
+
+    def test_notify_templates_refresh_the_index(self):
+
+        path = self.use_templates(**{'test.html': 'test'})
+        self.root.build_template_index()
+        self.assertNotIn('other', self.root.template_index)
+
+        with open(filepath.os.path.join(path, 'other.html'), 'w') as fd:
+            fd.write('other')
+
+        self.root._notify_templates(None, filepath.FilePath(path), 0)
+        self.assertIdentical(
+            self.root, self.root.getChild('other', DummyRequest(['']))
+        )
+
+    def test_render_get_falls_back_to_index(self):
+
+        self.use_templates(**{'index.html': 'index'})
+        request = DummyRequest([''])
+        request.prepath = ['missing']
+        self.assertEqual(self.root.render_GET(request), 'index')
+
+    def test_render_template_is_cached_while_render_keys_dont_change(self):
+
+        self.use_templates(**{'test.html': '{{ doctype }}'})
+        self.enable_render_cache()
+        body, etag = self.root.render_template('test.html')
+        self.assertEqual(self.root.render_template('test.html'), (body, etag))
+        self.assertEqual(etag, '"{}"'.format(md5(body).hexdigest()))
+
+        self.root.render_keys['doctype'] = 'changed'
+        self.assertEqual(
+            self.root.render_template('test.html')[0], 'changed')
+
+        self.root.render_keys['header']['styles'].append('style')
+        self.assertNotEqual(
+            self.root._rendered['test.html'][0], self.root.render_keys)
+
+    def test_render_get_returns_nothing_if_etag_matches(self):
+
+        self.use_templates(**{'test.html': 'test'})
+        self.enable_render_cache()
+        etag = self.root.render_template('test.html')[1]
+        request = DummyRequest([''])
+        request.prepath = ['test']
+        request.setETag = lambda tag: http.CACHED if tag == etag else None
+
+        self.assertEqual(self.root.render_GET(request), '')
+
+    def test_render_cache_is_disabled_by_default(self):
+
+        self.use_templates(**{'test.html': 'test'})
+
+        self.assertEqual(
+            self.root.render_template('test.html'), ('test', None))
+        self.assertEqual(self.root._rendered, {})
+
+    def test_precompile_templates(self):
+
+        self.use_templates(**{
+            'test.html': 'test', 'broken.html': '{% if %}'
+        })
+        self.assertEqual(self.root.precompile_templates(), 1)
+
 
 class RouteTest(unittest.TestCase):
 
@@ -394,7 +582,10 @@ class RouteTest(unittest.TestCase):
         with Stub() as dispatcher:
             dispatcher.url = '/test/102'
 
-        self.assertEqual(route.validate(dispatcher), route)
+        match = route.validate(dispatcher)
+        self.assertIsInstance(match, RouteMatch)
+        self.assertEqual(match.route, route)
+        self.assertEqual(match.path_args, {'uderId': 102})
 
         with Stub() as dispatcher:
             dispatcher.url = '/test'
@@ -414,6 +605,99 @@ class RouteTest(unittest.TestCase):
         self.assertEqual(r(controller, None), 'User 102 10.1 test')
 
 
+class RouteTrieTest(unittest.TestCase):
+
+    def get_trie(self, *routes):
+        trie = RouteTrie()
+        for method, url in routes:
+            route = Route(method, url, lambda ignore: url)
+            route.compile()
+            trie.insert('StubController', route)
+
+        return trie
+
+    def test_lookup_static_route(self):
+        trie = self.get_trie(('GET', '/test'), ('GET', '/test/other'))
+        route, args = trie.lookup('StubController', 'GET', '/test/other')
+        self.assertEqual(route.url, '/test/other')
+        self.assertEqual(args, {})
+
+    def test_lookup_converts_typed_arguments(self):
+        trie = self.get_trie(('GET', '/test/<int:user_id>/<float:x>/<text>'))
+        route, args = trie.lookup('StubController', 'GET', '/test/1/2.5/t')
+        self.assertEqual(args, {'user_id': 1, 'x': 2.5, 'text': 't'})
+
+    def test_lookup_prefers_static_and_int_segments(self):
+        trie = self.get_trie(
+            ('GET', '/test/<name>'), ('GET', '/test/<int:user_id>'),
+            ('GET', '/test/me')
+        )
+        route, _ = trie.lookup('StubController', 'GET', '/test/me')
+        self.assertEqual(route.url, '/test/me')
+        route, args = trie.lookup('StubController', 'GET', '/test/10')
+        self.assertEqual(args, {'user_id': 10})
+        route, args = trie.lookup('StubController', 'GET', '/test/you')
+        self.assertEqual(args, {'name': 'you'})
+
+    def test_lookup_backtracks_from_static_segments(self):
+        trie = self.get_trie(('GET', '/test/me'), ('GET', '/test/<name>/x'))
+        route, args = trie.lookup('StubController', 'GET', '/test/me/x')
+        self.assertEqual(route.url, '/test/<name>/x')
+        self.assertEqual(args, {'name': 'me'})
+
+    def test_lookup_returns_not_implemented_on_invalid_method(self):
+        trie = self.get_trie(('GET', '/test/<int:user_id>'))
+        route, _ = trie.lookup('StubController', 'POST', '/test/1')
+        self.assertEqual(route, 'NotImplemented')
+
+    def test_lookup_returns_none_on_unknown_path_or_controller(self):
+        trie = self.get_trie(('GET', '/test/<int:user_id>'))
+        self.assertEqual(
+            trie.lookup('StubController', 'GET', '/test/one')[0], None)
+        self.assertEqual(trie.lookup('Other', 'GET', '/test/1')[0], None)
+
+
+class RouteCacheTest(unittest.TestCase):
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = RouteCache(size=2)
+        cache.set('one', 1)
+        cache.set('two', 2)
+        self.assertEqual(cache.get('one'), 1)
+        cache.set('three', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse('two' in cache)
+        self.assertTrue('one' in cache)
+
+    def test_cache_disabled_with_zero_size(self):
+        cache = RouteCache(size=0)
+        cache.set('one', 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_dispatcher_caches_resolved_route_without_request(self):
+        controller = StubController()
+        request = request_generator(['/test/102'])
+        router = Router()
+        router.install_routes(controller)
+
+        match = RouteDispatcher(router, controller, request).lookup()
+        key = ('GET', 'StubController', '/test/102')
+        self.assertTrue(key in router.cache)
+        self.assertEqual(
+            router.cache.get(key), (match.route, {'user_id': 102}))
+
+        request = request_generator(['/test/102'])
+        again = RouteDispatcher(router, controller, request).lookup()
+        self.assertIs(again.route, match.route)
+        self.assertEqual(len(router.cache), 1)
+
+    def test_register_route_clears_cache(self):
+        router = Router()
+        router.cache.set('key', 'value')
+        router.install_routes(StubController())
+        self.assertEqual(len(router.cache), 0)
+
+
 class RouterTest(unittest.TestCase):
 
     def tearDown(self):
@@ -531,7 +815,7 @@ class RouterTest(unittest.TestCase):
     @defer.inlineCallbacks
     def test_dispatch_route_adds_json_parameters_on_put_or_post_request(self):
 
-        StubController.test2 = routes_generator('Test', method='PUT')
+        StubController.test2 = arguments_routes_generator(method='PUT')
         request = request_generator(['/test2'], method='PUT')
         request.content.write('{"name": "test"}')
         request.content.seek(0, 0)
@@ -543,12 +827,12 @@ class RouterTest(unittest.TestCase):
 
         result = yield controller.render(request)
         self.assertIsInstance(result, response.Ok)
-        self.assertTrue('name' in controller.test2.route.callback_args)
+        self.assertEqual(result.subject, 'name')
 
     @defer.inlineCallbacks
     def test_dispatch_route_adds_form_parameters_on_put_request(self):
 
-        StubController.test2 = routes_generator('Test', method='PUT')
+        StubController.test2 = arguments_routes_generator(method='PUT')
         request = request_generator(['/test2'], method='PUT')
         request.requestHeaders.setRawHeaders(
             'content-type', ['application/x-www-form-urlencoded']
@@ -559,7 +843,63 @@ class RouterTest(unittest.TestCase):
 
         result = yield controller.render(request)
         self.assertIsInstance(result, response.Ok)
-        self.assertTrue('name' in controller.test2.route.callback_args)
+        self.assertEqual(result.subject, 'name')
+
+    @defer.inlineCallbacks
+    def test_dispatch_route_does_not_read_body_on_get_request(self):
+
+        StubController.test2 = arguments_routes_generator()
+        request = request_generator(['/test2'])
+        request.content = Spy()
+
+        result = yield StubController().render(request)
+        self.assertEqual(result.subject, '')
+        assert_that(request.content.read, called().times(0))
+
+    @defer.inlineCallbacks
+    def test_dispatch_route_returns_413_on_too_large_body(self):
+
+        StubController.test2 = arguments_routes_generator(method='POST')
+        controller = StubController()
+        controller._router._max_body_size = 8
+        request = request_generator(['/test2'], method='POST')
+        request.content.write('{"name": "too large"}')
+        request.content.seek(0, 0)
+        request.requestHeaders.setRawHeaders(
+            'content-type', ['application/json; charset=utf-8']
+        )
+
+        result = yield controller.render(request)
+        self.assertIsInstance(result, response.RequestEntityTooLarge)
+
+    @defer.inlineCallbacks
+    def test_dispatch_route_decodes_large_body_in_thread(self):
+
+        StubController.test2 = arguments_routes_generator(method='POST')
+        controller = StubController()
+        request = request_generator(['/test2'], method='POST')
+        request.content.write('{"name": "%s"}' % ('x' * 300 * 1024))
+        request.content.seek(0, 0)
+        request.requestHeaders.setRawHeaders(
+            'content-type', ['application/json']
+        )
+
+        result = yield controller.render(request)
+        self.assertEqual(result.subject, 'name')
+
+    @defer.inlineCallbacks
+    def test_dispatch_route_does_not_leak_arguments_between_requests(self):
+
+        StubController.test2 = arguments_routes_generator()
+        controller = StubController()
+        request = request_generator(['/test2'])
+        request.args = {'name': ['test']}
+
+        result = yield controller.render(request)
+        self.assertEqual(result.subject, 'name')
+
+        result = yield controller.render(request_generator(['/test2']))
+        self.assertEqual(result.subject, '')
 
     def test_install_routes_register_route(self):
 
@@ -595,6 +935,135 @@ class RouterTest(unittest.TestCase):
         self.assertTrue(len(router.routes['GET']) == 2)
 
 
+class WebSocketRouteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.controller = WebSocketController()
+        self.controller._router._websockets = websocket.WebSocketFactory(
+            Factory(), heartbeat=websocket.Heartbeat(reactor=self.clock)
+        )
+        self.site = server.Site(self.controller)
+        self.channel = self.site.buildProtocol(None)
+        self.channel.callLater = self.clock.callLater
+        self.tr = proto_helpers.StringTransport()
+        self.tr.protocol = self.channel
+        self.channel.makeConnection(self.tr)
+
+    def tearDown(self):
+        self.flushLoggedErrors()
+
+    def test_upgrade_takes_over_the_connection(self):
+
+        self.channel.dataReceived(websocket_handshake)
+        self.assertTrue(self.tr.value().startswith('HTTP/1.1 101'))
+        self.assertIn(
+            'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n',
+            self.tr.value()
+        )
+
+        protocol = self.tr.protocol
+        self.assertIsInstance(protocol, websocket.WebSocketProtocol)
+        self.assertIsInstance(protocol.wrappedProtocol, wire.Echo)
+        self.assertEqual(protocol.location, '/chat')
+        self.assertEqual(protocol.host, 'server.example.com')
+        self.assertIdentical(self.tr.producer, protocol)
+        self.assertIn(protocol, self.controller._router.websockets.protocols)
+
+        self.tr.clear()
+        protocol.dataReceived('\x81\x80\x00\x00\x00\x00')
+        protocol.dataReceived('\x81\x85\x00\x00\x00\x00LEMON')
+        self.assertEqual(self.tr.value(), '\x81\x00\x81\x05LEMON')
+
+    def test_frames_sent_with_the_handshake_are_not_lost(self):
+
+        self.channel.dataReceived(
+            websocket_handshake + '\x81\x85\x00\x00\x00\x00LEMON')
+        self.assertTrue(self.tr.value().endswith('\r\n\r\n\x81\x05LEMON'))
+
+    def test_non_websocket_requests_get_426(self):
+
+        self.channel.dataReceived(
+            'GET /chat HTTP/1.1\r\nHost: server.example.com\r\n\r\n')
+        self.assertTrue(self.tr.value().startswith('HTTP/1.1 426'))
+        self.assertIn('Sec-Websocket-Version: 13, 8, 7', self.tr.value())
+        self.assertIdentical(self.tr.protocol, self.channel)
+
+    def test_unsupported_versions_get_426(self):
+
+        self.channel.dataReceived(websocket_handshake.replace(
+            'Sec-WebSocket-Version: 13', 'Sec-WebSocket-Version: 6'))
+        self.assertTrue(self.tr.value().startswith('HTTP/1.1 426'))
+
+    def test_missing_key_is_a_bad_request(self):
+
+        self.channel.dataReceived(websocket_handshake.replace(
+            'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n', ''))
+        self.assertTrue(self.tr.value().startswith('HTTP/1.1 400'))
+
+    def test_http_routes_share_the_port(self):
+
+        self.channel.dataReceived(
+            'GET /hello HTTP/1.1\r\nHost: server.example.com\r\n\r\n')
+        self.assertTrue(self.tr.value().startswith('HTTP/1.1 200'))
+        self.assertIn('\r\nHello\r\n', self.tr.value())
+
+    def test_routes_that_return_no_protocol_get_500(self):
+
+        self.channel.dataReceived(
+            websocket_handshake.replace('GET /chat', 'GET /nothing'))
+        self.assertTrue(self.tr.value().startswith('HTTP/1.1 500'))
+        self.assertIdentical(self.tr.protocol, self.channel)
+
+    def test_failed_negotiations_close_the_connection_with_400(self):
+
+        def negotiate(protocol):
+            raise websocket.InvalidProtocol('Not handling non-WS request')
+
+        self.patch(websocket.WebSocketProtocol, 'negotiate', negotiate)
+        self.channel.dataReceived(websocket_handshake)
+        self.assertEqual(
+            self.tr.value(),
+            'HTTP/1.1 400 Bad Request\r\n'
+            'Connection: close\r\n'
+            'Content-Length: 0\r\n\r\n'
+        )
+        self.assertTrue(self.tr.disconnecting)
+        self.assertEqual(len(self.flushLoggedErrors(
+            websocket.InvalidProtocol)), 1)
+
+    @defer.inlineCallbacks
+    def test_dummy_requests_cant_be_upgraded(self):
+
+        request = request_generator(['/chat'])
+        for name, value in (
+                ('upgrade', 'websocket'), ('connection', 'Upgrade'),
+                ('sec-websocket-version', '13'),
+                ('sec-websocket-key', 'dGhlIHNhbXBsZSBub25jZQ==')):
+            request.requestHeaders.setRawHeaders(name, [value])
+
+        result = yield self.controller._router.dispatch(
+            self.controller, request)
+        self.assertIsInstance(result, response.NotImplemented)
+
+
+class WebSocketController(controller.Controller):
+
+    _router = Router()
+
+    @decowebsocket('/chat')
+    def chat(self, request, **kwargs):
+        return wire.Echo()
+
+    @decowebsocket('/nothing')
+    def nothing(self, request, **kwargs):
+        return None
+
+    @decoroute('/hello')
+    def hello(self, request, **kwargs):
+        return 'Hello'
+
+
 class TestRouteDispatcher(unittest.TestCase):
 
     def test_sanitize_urls_on_initialization(self):
@@ -612,7 +1081,9 @@ class TestRouteDispatcher(unittest.TestCase):
         router.install_routes(controller)
         route_dispatcher = RouteDispatcher(router, controller, request)
 
-        self.assertIsInstance(route_dispatcher.lookup(), Route)
+        match = route_dispatcher.lookup()
+        self.assertIsInstance(match, RouteMatch)
+        self.assertIsInstance(match.route, Route)
 
     def test_lookup_returns_none_on_invalid_controller_or_router(self):
 
@@ -674,6 +1145,15 @@ def routes_generator(retval, method='GET'):
     return test2
 
 
+def arguments_routes_generator(method='GET'):
+
+    @decoroute('/test2', method=method)
+    def test2(self, request, **kwargs):
+        return ','.join(sorted(kwargs))
+
+    return test2
+
+
 def request_generator(url, method='GET', content=True, headers=True):
     request = DummyRequest(url)
     request.method = method
@@ -6,8 +6,11 @@
 Tests for mamba.web.websocket
 """
 
+import os
+import struct
 import hashlib
 
+from doublex import Spy, assert_that, called
 from twisted.trial import unittest
 from twisted.internet import address, task
 from twisted.web.http import datetimeToString
@@ -40,6 +43,22 @@ hybi00_data = (
 )
 
 
+def connect(factory, handshake=data):
+    """Connect a new protocol built by the given factory to a string
+    transport and complete the handshake if any
+    """
+
+    port = factory.buildProtocol(address.IPv4Address('TCP', '127.0.0.1', 0))
+    tr = proto_helpers.StringTransportWithDisconnection()
+    tr.protocol = port
+    port.makeConnection(tr)
+    if handshake is not None:
+        port.dataReceived(handshake)
+        tr.clear()
+
+    return port, tr
+
+
 class WebSocketProtocolTest(unittest.TestCase):
     """Test cases for Mamba WebSockets
     """
@@ -182,6 +201,38 @@ class WebSocketProtocolTest(unittest.TestCase):
             'LEMOOOOOOOOOON'
         )
 
+    def test_mask_matches_octet_algorithm(self):
+
+        key = '\x0a\x45\x34\x1a'
+        for length in (1, 3, 4, 5, 125, 126, 1023, 65537):
+            payload = os.urandom(length)
+            expected = ''.join(
+                chr(ord(c) ^ ord(key[i % 4])) for i, c in enumerate(payload)
+            )
+            self.assertEqual(
+                websocket.HyBi07Frame('').mask(payload, key), expected)
+            self.assertEqual(websocket._mask_strided(payload, key), expected)
+
+    def test_mask_short_buffers(self):
+
+        key = '\xff\x00\x00\x00'
+        self.assertEqual(
+            websocket._mask_strided('\xff\x00\x00', key), '\x00\x00\x00')
+        self.assertEqual(websocket._mask_strided('', key), '')
+
+    def test_mask_numpy(self):
+
+        if websocket.numpy is None:
+            raise unittest.SkipTest('numpy is not installed')
+
+        key = '\x0a\x45\x34\x1a'
+        for length in (0, 3, 4, 1023, 65537):
+            payload = os.urandom(length)
+            self.assertEqual(
+                websocket._mask_numpy(payload, key),
+                websocket._mask_strided(payload, key)
+            )
+
     def test_unmasked_text(self):
 
         parser = websocket.HyBi07Frame('\x81\x0eLEMOOOOOOOOOON')
@@ -201,13 +252,41 @@ class WebSocketProtocolTest(unittest.TestCase):
 
     def test_unmasked_text_fragments(self):
 
-        parser = websocket.HyBi07Frame('\x81\x08LEMOOOOO\x80\x06OOOOON')
+        parser = websocket.HyBi07Frame('\x01\x08LEMOOOOO\x80\x06OOOOON')
         fr, buf = parser.parse()
-        self.assertEqual(len(fr), 2)
-        self.assertEqual(fr[0], (websocket.DATA, "LEMOOOOO"))
-        self.assertEqual(fr[1], (websocket.DATA, "OOOOON"))
+        self.assertEqual(len(fr), 1)
+        self.assertEqual(fr[0], (websocket.DATA, "LEMOOOOOOOOOON"))
         self.assertEqual(buf, '')
 
+    def test_control_frames_between_fragments(self):
+
+        parser = websocket.HyBi07Frame(
+            '\x02\x04LEMO\x89\x02hi\x00\x04OOOO\x80\x02ON')
+        fr, buf = parser.parse()
+        self.assertEqual(fr, [
+            (websocket.PING, 'hi'), (websocket.BINARY, 'LEMOOOOOON')
+        ])
+
+    def test_continuation_without_message(self):
+
+        parser = websocket.HyBi07Frame('\x81\x08LEMOOOOO\x80\x06OOOOON')
+        self.assertRaises(websocket.WebSocketError, parser.parse)
+
+    def test_new_message_inside_fragmented_message(self):
+
+        parser = websocket.HyBi07Frame('\x01\x08LEMOOOOO\x81\x06OOOOON')
+        self.assertRaises(websocket.WebSocketError, parser.parse)
+
+    def test_reserved_flags_without_extensions(self):
+
+        parser = websocket.HyBi07Frame('\xc1\x08LEMOOOOO')
+        self.assertRaises(websocket.ReservedFlagsInFrame, parser.parse)
+
+    def test_generate_binary_compressed_frame(self):
+
+        frame = websocket.HyBi07Frame('LEMON')
+        self.assertEqual(frame.generate(0x2, compressed=True), '\xc2\x05LEMON')
+
     def test_parse_ping(self):
 
         fr, buf = websocket.HyBi07Frame('\x89\x0eLEMOOOOOOOOOON').parse()
@@ -267,12 +346,491 @@ class WebSocketProtocolTest(unittest.TestCase):
         self.assertEqual(len(fr), 0)
         self.assertEqual(buf, '\x81\x0eLEMOOOO')
 
+    def test_parse_long_length(self):
+
+        payload = 'L' * 0x10000
+        fr, buf = websocket.HyBi07Frame(
+            '\x81\x7f' + struct.pack('>Q', len(payload)) + payload).parse()
+        self.assertEqual(fr, [(websocket.DATA, payload)])
+        self.assertEqual(buf, '')
+
+    def test_frames_are_passed_to_wrapped_protocol_incrementally(self):
+
+        received = []
+        self.port.wrappedProtocol.dataReceived = received.append
+        key = '\x0a\x45\x34\x1a'
+        frame = '\x81\x8e{}F\x00yUE\n{{UE\n{{UE\x0b'.format(key)
+
+        self.port.dataReceived(data + frame[:1])
+        self.assertIsInstance(self.port.parser, websocket.HyBi07Parser)
+        for octet in frame[1:] + frame:
+            self.port.dataReceived(octet)
+
+        self.assertEqual(received, ['LEMOOOOOOOOOON', 'LEMOOOOOOOOOON'])
+
+
+class HyBi07ParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = websocket.HyBi07Parser()
+
+    def test_header_is_parsed_once(self):
+
+        calls = []
+        parse_header = self.parser._parse_header
+        self.parser._parse_header = lambda: (
+            calls.append(1) or parse_header()
+        )
+
+        payload = 'L' * 1000
+        frame = '\x82\x7e' + struct.pack('>H', len(payload)) + payload
+        frames = []
+        for i in range(0, len(frame), 100):
+            frames.extend(self.parser.feed(frame[i:i + 100]))
+
+        self.assertEqual(frames, [(websocket.BINARY, payload)])
+        # one call to parse the header and one to look for the next one
+        self.assertEqual(len(calls), 2)
+
+    def test_partial_frames_are_kept(self):
+
+        self.assertEqual(self.parser.feed('\x81\x0eLEMO'), [])
+        self.assertEqual(self.parser.pending, '\x81\x0eLEMO')
+        self.assertEqual(
+            self.parser.feed('OOOOOOOOON\x89'),
+            [(websocket.DATA, 'LEMOOOOOOOOOON')]
+        )
+        self.assertEqual(self.parser.pending, '\x89')
+
+    def test_consumed_data_is_removed_from_buffer(self):
+
+        frame = '\x81\x0eLEMOOOOOOOOOON'
+        self.parser.feed(frame * 10 + frame[:4])
+        self.assertEqual(self.parser.offset, 0)
+        self.assertEqual(str(self.parser.buf), frame[:4])
+
+        self.parser.feed(frame[4:])
+        self.assertEqual(len(self.parser.buf), 0)
+
+    def test_messages_bigger_than_max_size_are_rejected_early(self):
+
+        parser = websocket.HyBi07Parser(max_message_size=10)
+        self.assertEqual(parser.feed('\x01\x06LEMOOO'), [])
+        # the second fragment is rejected before its payload arrives
+        self.assertRaises(
+            websocket.MessageTooBig, parser.feed, '\x80\x06')
+
+
+class PerMessageDeflateTest(unittest.TestCase):
+
+    def test_negotiate(self):
+
+        negotiate = websocket.PerMessageDeflate.negotiate
+        self.assertIdentical(negotiate(None), None)
+        self.assertIdentical(negotiate('x-webkit-deflate-frame'), None)
+        self.assertIdentical(
+            negotiate('permessage-deflate; server_max_window_bits=8'), None)
+
+        deflate = negotiate(
+            'permessage-deflate; server_max_window_bits=8, '
+            'permessage-deflate; client_max_window_bits; '
+            'server_no_context_takeover'
+        )
+        self.assertTrue(deflate.server_no_context_takeover)
+        self.assertEqual(
+            deflate.response, 'permessage-deflate; server_no_context_takeover')
+
+        deflate = negotiate('permessage-deflate; server_max_window_bits="10"')
+        self.assertEqual(
+            deflate.response, 'permessage-deflate; server_max_window_bits=10')
+
+    def test_compress_with_context_takeover(self):
+
+        deflate = websocket.PerMessageDeflate()
+        message = '{"temperature": 21, "humidity": 40, "status": "ok"}'
+        first = deflate.compress(message)
+        second = deflate.compress(message)
+        self.assertLess(len(second), len(first))
+
+        inflate = websocket.PerMessageDeflate()
+        self.assertEqual(inflate.decompress(first), message)
+        self.assertEqual(inflate.decompress(second), message)
+
+    def test_compress_without_context_takeover(self):
+
+        deflate = websocket.PerMessageDeflate(server_no_context_takeover=True)
+        message = 'LEMON' * 20
+        self.assertEqual(deflate.compress(message), deflate.compress(message))
+
+    def test_decompress_honours_max_size(self):
+
+        data = websocket.PerMessageDeflate().compress('L' * 1000)
+        self.assertRaises(
+            websocket.MessageTooBig,
+            websocket.PerMessageDeflate().decompress, data, 999
+        )
+        self.assertEqual(
+            websocket.PerMessageDeflate().decompress(data, 1000), 'L' * 1000)
+
+    def test_protocol_negotiates_and_uses_deflate(self):
+
+        port, tr = connect(TestableWebSocketFactory(
+            task.Clock(), test_policies.Server()), handshake=None)
+
+        received = []
+        port.wrappedProtocol.dataReceived = received.append
+        port.dataReceived(data.replace(
+            '\r\n\r\n',
+            '\r\nSec-WebSocket-Extensions: permessage-deflate\r\n\r\n'
+        ))
+        self.assertIn(
+            'Sec-WebSocket-Extensions: permessage-deflate\r\n\r\n', tr.value())
+
+        message = 'LEMON' * 20
+        compressed = websocket.PerMessageDeflate().compress(message)
+        port.dataReceived(
+            websocket.HyBi07Frame(compressed).generate(0x2, compressed=True))
+        self.assertEqual(received, [message])
+        self.assertTrue(port.binary)
+
+        tr.clear()
+        port.write_binary(message)
+        self.assertEqual(
+            tr.value(),
+            websocket.HyBi07Frame(
+                websocket.PerMessageDeflate().compress(message)
+            ).generate(0x2, compressed=True)
+        )
+
+    def test_protocol_closes_on_too_big_messages(self):
+
+        port, tr = connect(TestableWebSocketFactory(
+            task.Clock(), test_policies.Server()), handshake=None)
+        port.max_message_size = 4
+
+        port.dataReceived(data)
+        tr.clear()
+        port.dataReceived('\x81\x0eLEMOOOOOOOOOON')
+        self.assertEqual(
+            tr.value(),
+            websocket.HyBi07Frame(
+                '\x03\xf1Message bigger than 4 octets').generate(0x8)
+        )
+        self.assertFalse(tr.connected)
+
+    def test_protocol_closes_on_protocol_errors(self):
+
+        port, tr = connect(TestableWebSocketFactory(
+            task.Clock(), test_policies.Server()))
+        port.dataReceived('\x80\x05LEMON')
+        self.assertEqual(
+            tr.value(),
+            websocket.HyBi07Frame(
+                '\x03\xeaContinuation frame without a message'
+            ).generate(0x8)
+        )
+        self.assertFalse(tr.connected)
+        self.assertEqual(
+            len(self.flushLoggedErrors(websocket.WebSocketError)), 1)
+
+
+class HubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.factory = TestableWebSocketFactory(
+            task.Clock(), test_policies.Server())
+        self.hub = self.factory.hub
+        self.hub.clock = lambda: self.now
+
+    def connect(self, handshake=data):
+        return connect(self.factory, handshake)
+
+    def test_publish_encodes_once_per_protocol_family(self):
+
+        ports = [self.connect() for i in range(3)]
+        ports.append(self.connect(hybi00_data))
+        for port, tr in ports:
+            self.hub.subscribe(port, 'dashboard')
+
+        self.assertEqual(self.hub.publish('dashboard', 'LEMON'), 4)
+        for port, tr in ports[:3]:
+            self.assertEqual(tr.value(), '\x81\x05LEMON')
+        self.assertEqual(ports[3][1].value(), '\x00LEMON\xff')
+
+        self.assertEqual(self.hub.publish('other', 'LEMON'), 0)
+
+    def test_publish_binary(self):
+
+        port, tr = self.connect()
+        self.hub.subscribe(port, 'dashboard')
+        self.hub.publish('dashboard', '\x00\x01', binary=True)
+        self.assertEqual(tr.value(), '\x82\x02\x00\x01')
+
+    def test_paused_subscribers_queue_frames(self):
+
+        port, tr = self.connect()
+        subscriber = self.hub.subscribe(port, 'dashboard')
+        self.assertIdentical(port.subscriber, subscriber)
+
+        port.pauseProducing()
+        self.hub.publish('dashboard', 'LEMON')
+        self.hub.publish('dashboard', 'ORANGE')
+        self.assertEqual(tr.value(), '')
+        self.assertEqual(self.hub.stats()['queue_depth'], {
+            'total': 2, 'max': 2
+        })
+
+        port.resumeProducing()
+        self.assertEqual(tr.value(), '\x81\x05LEMON\x81\x06ORANGE')
+        self.assertEqual(len(subscriber.queue), 0)
+
+    def test_full_queue_drops_oldest_frames(self):
+
+        self.hub.max_queue = 2
+        port, tr = self.connect()
+        subscriber = self.hub.subscribe(port, 'dashboard')
+        subscriber.pauseProducing()
+        for message in ('A', 'B', 'C'):
+            self.hub.publish('dashboard', message)
+
+        subscriber.resumeProducing()
+        self.assertEqual(tr.value(), '\x81\x01B\x81\x01C')
+        self.assertEqual(self.hub.dropped, 1)
+
+    def test_full_queue_disconnects_slow_subscribers(self):
+
+        self.hub.max_queue = 1
+        self.hub.policy = websocket.DISCONNECT
+        port, tr = self.connect()
+        subscriber = self.hub.subscribe(port, 'dashboard')
+        subscriber.pauseProducing()
+        self.hub.publish('dashboard', 'A')
+        self.assertEqual(self.hub.publish('dashboard', 'B'), 0)
+
+        self.assertFalse(tr.connected)
+        self.assertEqual(self.hub.disconnected, 1)
+        self.assertNotIn(port, self.hub.subscribers)
+
+    def test_closed_connections_are_unsubscribed(self):
+
+        port, tr = self.connect()
+        self.hub.subscribe(port, 'dashboard')
+        self.hub.subscribe(port, 'alerts')
+        self.factory.unregisterProtocol(port)
+        self.assertEqual(self.hub.channels, {})
+        self.assertEqual(self.hub.subscribers, {})
+        self.assertIdentical(port.subscriber, None)
+
+    def test_fanout_latency_metrics(self):
+
+        port, tr = self.connect()
+        self.hub.subscribe(port, 'dashboard')
+        clock = iter([1.0, 1.5, 2.0, 2.1])
+        self.hub.clock = lambda: next(clock)
+        self.hub.publish('dashboard', 'A')
+        self.hub.publish('dashboard', 'B')
+
+        stats = self.hub.stats()
+        self.assertEqual(stats['published'], 2)
+        self.assertEqual(stats['delivered'], 2)
+        self.assertAlmostEqual(stats['fanout_latency']['last'], 0.1)
+        self.assertAlmostEqual(stats['fanout_latency']['max'], 0.5)
+        self.assertAlmostEqual(stats['fanout_latency']['avg'], 0.3)
+
+
+class BackpressureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = TestableWebSocketFactory(
+            task.Clock(), test_policies.Server())
+
+    def connect(self):
+        return connect(self.factory, handshake=None)
+
+    def test_protocol_is_the_transport_producer(self):
+
+        port, tr = self.connect()
+        self.assertIdentical(tr.producer, port)
+        self.assertTrue(tr.streaming)
+
+    def test_pending_frames_are_per_connection(self):
+
+        first, first_tr = self.connect()
+        second, second_tr = self.connect()
+        first.wrappedProtocol.transport.write('LEMON')
+        self.assertEqual(first.pending_frames, [(0x1, 'LEMON')])
+        self.assertEqual(second.pending_frames, [])
+
+    def test_pending_frames_are_flushed_in_one_write(self):
+
+        port, tr = self.connect()
+        writes = []
+        tr.writeSequence = writes.append
+        port.wrappedProtocol.transport.write('A')
+        port.wrappedProtocol.transport.writeSequence(['B', 'C'])
+        self.assertEqual(writes, [])
+
+        port.dataReceived(data)
+        # the handshake preamble and the frames
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(writes[1], ['\x81\x01A', '\x81\x01B', '\x81\x01C'])
+        self.assertEqual(port.pending_frames, [])
+
+    def test_paused_transport_pauses_the_wrapped_producer(self):
+
+        port, tr = self.connect()
+        port.dataReceived(data)
+        tr.clear()
+        producer = Spy()
+        port.wrappedProtocol.transport.registerProducer(producer, True)
+
+        tr.producer.pauseProducing()
+        port.wrappedProtocol.transport.write('LEMON')
+        self.assertEqual(tr.value(), '')
+        assert_that(producer.pauseProducing, called().times(1))
+
+        tr.producer.resumeProducing()
+        self.assertEqual(tr.value(), '\x81\x05LEMON')
+        assert_that(producer.resumeProducing, called().times(1))
+
+        port.wrappedProtocol.transport.unregisterProducer()
+        self.assertIdentical(port.producer, None)
+
+    def test_producers_registered_while_paused_start_paused(self):
+
+        port, tr = self.connect()
+        port.pauseProducing()
+        producer = Spy()
+        port.registerProducer(producer, True)
+        assert_that(producer.pauseProducing, called().times(1))
+        self.assertRaises(RuntimeError, port.registerProducer, Spy(), True)
+
+    def test_stop_producing_stops_the_wrapped_producer(self):
+
+        port, tr = self.connect()
+        producer = Spy()
+        port.registerProducer(producer, True)
+        port.stopProducing()
+        assert_that(producer.stopProducing, called().times(1))
+        self.assertIdentical(port.producer, None)
+
+    def test_lose_connection_unregisters_from_transport(self):
+
+        port, tr = self.connect()
+        port.loseConnection()
+        self.assertIdentical(tr.producer, None)
+        self.assertFalse(tr.connected)
+
+
+class HeartbeatTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.heartbeat = websocket.Heartbeat(
+            interval=30, timeout=10, reactor=self.clock)
+        self.factory = TestableWebSocketFactory(
+            self.clock, test_policies.Server(), heartbeat=self.heartbeat)
+
+    def connect(self, handshake=data):
+        return connect(self.factory, handshake)
+
+    def test_one_delayed_call_for_all_the_connections(self):
+
+        for i in range(10):
+            self.connect()
+
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.assertEqual(len(self.heartbeat.where), 10)
+
+    def test_idle_connections_are_pinged(self):
+
+        port, tr = self.connect()
+        self.clock.pump([1] * 29)
+        self.assertEqual(tr.value(), '')
+        self.clock.advance(1)
+        self.assertEqual(tr.value(), '\x89\x00')
+        self.assertEqual(port.ping_sent, 30)
+
+    def test_active_connections_are_not_pinged(self):
+
+        port, tr = self.connect()
+        self.clock.pump([1] * 25)
+        port.dataReceived('\x8a\x80\x00\x00\x00\x00')
+        self.clock.pump([1] * 29)
+        self.assertEqual(tr.value(), '')
+        self.clock.advance(1)
+        self.assertEqual(tr.value(), '\x89\x00')
+
+    def test_pong_latency(self):
+
+        port, tr = self.connect()
+        self.clock.pump([1] * 30)
+        self.clock.advance(1.5)
+        port.dataReceived('\x8a\x80\x00\x00\x00\x00')
+        self.assertEqual(port.latency, 1.5)
+        self.assertIdentical(port.ping_sent, None)
+
+        self.clock.pump([1] * 20)
+        self.assertTrue(tr.connected)
+
+    def test_unresponsive_connections_are_closed(self):
+
+        port, tr = self.connect()
+        self.clock.pump([1] * 39)
+        self.assertTrue(tr.connected)
+        self.clock.advance(1)
+        self.assertFalse(tr.connected)
+        self.assertEqual(
+            tr.value(), '\x89\x00\x88\x0e\x03\xe9Ping timeout')
+        self.assertEqual(self.heartbeat.reaped, 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_hybi00_connections_are_closed_when_idle(self):
+
+        port, tr = self.connect(hybi00_data)
+        self.clock.pump([1] * 39)
+        self.assertTrue(tr.connected)
+        self.clock.advance(1)
+        self.assertFalse(tr.connected)
+        self.assertEqual(tr.value(), '')
+
+    def test_closed_connections_are_discarded(self):
+
+        port, tr = self.connect()
+        self.factory.unregisterProtocol(port)
+        self.assertEqual(self.heartbeat.where, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_disabled_by_default(self):
+
+        self.assertIdentical(
+            websocket.WebSocketFactory(test_policies.Server()).heartbeat, None
+        )
+        self.factory = TestableWebSocketFactory(
+            self.clock, test_policies.Server(), heartbeat=None)
+        port, tr = self.connect()
+        self.clock.advance(3600)
+
+        self.assertTrue(tr.connected)
+        self.assertIdentical(port.heartbeat, None)
+        self.factory.unregisterProtocol(port)
+
+    def test_disabled(self):
+
+        heartbeat = websocket.Heartbeat(interval=0, reactor=self.clock)
+        self.factory.heartbeat = heartbeat
+        port, tr = self.connect()
+        self.assertIdentical(port.heartbeat, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
 
 class TestableWebSocketFactory(websocket.WebSocketFactory):
     """Just for tests purposes
     """
 
     def __init__(self, clock, *args, **kwargs):
+        kwargs.setdefault('heartbeat', websocket.Heartbeat(reactor=clock))
         websocket.WebSocketFactory.__init__(self, *args, **kwargs)
         self.clock = clock
 
@@ -71,6 +71,15 @@ class Database(BaseConfig):
             'min_threads': 5,
             'max_threads': 20,
             'auto_adjust_pool_size': false,
+            'mode': 'threaded',
+            'async_pool_size': 10,
+            'replicas': [],
+            'replica_policy': 'round_robin',
+            'replica_lag': 2.0,
+            'shards': {
+                'users': ['sqlite:users-0.db', 'sqlite:users-1.db']
+            },
+            'prepared_statements': true,
             'create_table_behaviours': {
                 'create_if_not_exists': true,
                 'drop_table': false
@@ -85,7 +94,30 @@ class Database(BaseConfig):
     Where uri is the Storm URI format for create ZStores and min, max threads
     are the minimum and maximum threads in the thread pool for operate with
     the database. If auto_adjust_pool_size is True, the size of the thread
-    pool should be adjust dynamically.
+    pool is adjusted dynamically between them looking at the queued tasks
+    (see :class:`~mamba.enterprise.database.PoolAutoscaler`).
+
+    The mode can be 'threaded' (the default) to run the queries with Storm
+    in the thread pool or 'async' to run them from the reactor using a
+    pool of async_pool_size non blocking connections (only PostgreSQL with
+    `txpostgres` installed, any other database uses the thread pool).
+
+    The replicas are a list of Storm URIs of read replicas, the model reads
+    are sent to them using the replica_policy ('round_robin' or
+    'least_loaded') except for the tables written in the last replica_lag
+    seconds (see :class:`~mamba.enterprise.database.ReplicaSet`). Every
+    replica has its own thread pool of replica_threads threads (max_threads
+    divided by the number of replicas by default) and it's checked every
+    replica_check_interval seconds.
+
+    The shards are a dict of shard maps, every shard map is a list of the
+    Storm URIs of the databases that store the registers of the models that
+    use it (see :meth:`~mamba.application.model.Model.get_shard_map_name`).
+
+    If prepared_statements is true the hot model queries run as server
+    side prepared statements on PostgreSQL (see
+    :class:`~mamba.enterprise.querycache.QueryCache`), set it to false if
+    the database is behind a transaction pooling proxy like pgbouncer.
 
     For *create_table_bevaviour* possible values are:
 
@@ -139,6 +171,13 @@ class Database(BaseConfig):
         self.min_threads = 5
         self.max_threads = 20
         self.auto_adjust_pool_size = False
+        self.mode = 'threaded'
+        self.async_pool_size = 10
+        self.replicas = []
+        self.replica_policy = 'round_robin'
+        self.replica_lag = 2.0
+        self.shards = {}
+        self.prepared_statements = True
         self.create_table_behaviours = {
             'create_if_not_exists': True,
             'drop_table': False
@@ -204,9 +243,32 @@ class Application(BaseConfig):
             "language": "en",
             "description": "This is my cool application",
             "favicon": "favicon.ico",
-            "platform_debug": false
+            "platform_debug": false,
+            "route_cache_size": 1024,
+            "max_body_size": 10485760,
+            "precompile_templates": false,
+            "render_cache": false,
+            "template_bytecode_cache": true
         }
 
+    The `route_cache_size` is the max number of resolved routes that the
+    router keeps in its LRU cache, set it to 0 to disable the cache.
+
+    The `max_body_size` is the max size in bytes of the request bodies
+    that the router parses, bigger ones get a 413 response, set it to 0
+    to disable the limit.
+
+    If `precompile_templates` is true all the templates are compiled when
+    the root page is created instead of on their first request.
+
+    If `render_cache` is true the rendered templates of the root page are
+    cached while its render keys don't change and are served with an ETag.
+
+    If `template_bytecode_cache` is true the compiled templates are stored
+    in the `application/.cache/templates` directory so they don't have to
+    be compiled again when the application is restarted, the cache can be
+    warmed with `mamba-admin warm`.
+
     :param config_file: the JSON file to load
     :type config_file: str
     """
@@ -230,6 +292,11 @@ class Application(BaseConfig):
         self.description = None
         self.favicon = 'favicon.ico'
         self.platform_debug = False
+        self.route_cache_size = 1024
+        self.max_body_size = 10 * 1024 * 1024
+        self.precompile_templates = False
+        self.render_cache = False
+        self.template_bytecode_cache = True
 
 
 class InstalledPackages(BaseConfig):
@@ -10,19 +10,28 @@
 .. moduleauthor:: Oscar Campos <oscar.campos@member.fsf.org>
 """
 
+import decimal
 import logging
-import collections
+import datetime
 
+from storm.info import get_cls_info
+from storm.exceptions import ClassInfoError
 from twisted.python import log
 
 
 class Converter(object):
     """
     Object Converter class
+
+    The fields to extract from every class are computed just once and
+    stored in :attr:`plans`. For Storm classes the fields are the Storm
+    columns, for any other class the public instance attributes or the
+    public non callable class attributes if the instance has none.
     """
 
     primitives = (int, long, float, bool, str, unicode)
     containers = (str, tuple, list, dict)
+    plans = {}
 
     def __init__(self):
         super(Converter, self).__init__()
@@ -33,33 +42,85 @@ class Converter(object):
         try:
             if type(obj) not in Converter.primitives:
                 if type(obj) is dict:
-                    tmpdict = {}
-                    for key, value in obj.iteritems():
-                        tmpdict.update({
-                            key: Converter.serialize(value)
-                        })
-
-                    return tmpdict
+                    return {
+                        key: Converter.serialize(value)
+                        for key, value in obj.iteritems()
+                    }
                 elif getattr(obj, '__class__', False):
                     if type(obj) not in Converter.containers:
-                        tmpdict = {}
-                        if getattr(obj, '__dict__', False):
-                            for key, value in obj.__dict__.iteritems():
-                                if not key.startswith('_'):
-                                    tmpdict.update({key: value})
-                        else:
-                            for item in dir(obj):
-                                if not item.startswith('_'):
-                                    tmpdict.update({item: getattr(obj, item)})
-
-                        return tmpdict
-                elif type(obj) is collections.Iterable:
-                    values = []
-                    for value in obj:
-                        values.append(Converter.serialize(value))
-
-                    return values
+                        return Converter.fields(obj)
         except AttributeError as error:
             log.msg(error, logLevel=logging.WARN)
 
         return obj
+
+    @staticmethod
+    def plan(cls):
+        """
+        Return back the (cached) extraction plan for the given class, a
+        tuple with the kind of plan ('columns' or 'attributes') and the
+        names of the fields to extract
+
+        :param cls: the class to get the plan for
+        """
+
+        plan = Converter.plans.get(cls)
+        if plan is None:
+            if hasattr(cls, '__storm_table__'):
+                try:
+                    plan = ('columns', tuple(
+                        sorted(get_cls_info(cls).attributes.keys())
+                    ))
+                except ClassInfoError:
+                    pass
+
+            if plan is None:
+                plan = ('attributes', tuple(
+                    name for name in dir(cls) if not name.startswith('_')
+                    and not callable(getattr(cls, name, None))
+                ))
+
+            Converter.plans[cls] = plan
+
+        return plan
+
+    @staticmethod
+    def fields(obj):
+        """
+        Extract the fields of the given object into a dict using the plan
+        for its class
+
+        :param obj: the object to extract the fields from
+        """
+
+        kind, names = Converter.plan(obj.__class__)
+        if kind == 'attributes':
+            attributes = getattr(obj, '__dict__', False)
+            if attributes:
+                return {
+                    key: value for key, value in attributes.iteritems()
+                    if not key.startswith('_')
+                }
+
+        return {name: getattr(obj, name) for name in names}
+
+    @staticmethod
+    def default(obj):
+        """
+        Default hook for :class:`json.JSONEncoder`, it converts the objects
+        that the JSON encoder doesn't know how to serialize
+        """
+
+        if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+            return obj.isoformat()
+
+        if isinstance(obj, decimal.Decimal):
+            return str(obj)
+
+        if hasattr(obj, '__iter__'):
+            return list(obj)
+
+        if getattr(obj, '__class__', False):
+            return Converter.fields(obj)
+
+        raise TypeError('{} is not JSON serializable'.format(repr(obj)))
@@ -7,27 +7,34 @@ Subpackage containing the modules that implement web stuff for projects
 '''
 
 from page import Page
-from routing import Router, Route, RouteDispatcher
+from routing import (
+    Router, Route, RouteMatch, RouteDispatcher, WebSocketRoute
+)
 from script import Script, ScriptManager, ScriptError
 from response import (
     Response, NotFound, NotImplemented, Ok, InternalServerError,
-    BadRequest, Conflict, AlreadyExists, Found, Unauthorized
+    BadRequest, Conflict, AlreadyExists, Found, Unauthorized,
+    RequestEntityTooLarge, SwitchingProtocols, UpgradeRequired
 )
 from stylesheet import (
     Stylesheet, StylesheetError, InvalidFile, InvalidFileExtension,
     FileDontExists
 )
 
-from websocket import WebSocketError, WebSocketProtocol, WebSocketFactory
+from websocket import (
+    WebSocketError, WebSocketProtocol, WebSocketFactory, Hub, Heartbeat
+)
 
 
 __all__ = [
     'Page',
-    'Router', 'Route', 'RouteDispatcher',
+    'Router', 'Route', 'RouteMatch', 'RouteDispatcher', 'WebSocketRoute',
     'Response', 'NotFound', 'NotImplemented', 'Ok', 'InternalServerError',
     'BadRequest', 'Conflict', 'AlreadyExists', 'Found', 'Unauthorized',
+    'RequestEntityTooLarge', 'SwitchingProtocols', 'UpgradeRequired',
     'Script', 'ScriptManager', 'ScriptError',
     'Stylesheet', 'StylesheetError', 'InvalidFile', 'InvalidFileExtension',
     'FileDontExists',
-    'WebSocketError', 'WebSocketProtocol', 'WebSocketFactory'
+    'WebSocketError', 'WebSocketProtocol', 'WebSocketFactory', 'Hub',
+    'Heartbeat'
 ]
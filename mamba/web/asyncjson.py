@@ -7,8 +7,16 @@ Asynchronous JSON response
 """
 
 from json import JSONEncoder
+from itertools import islice
 
-from twisted.internet.task import cooperate
+from twisted.python import log
+from twisted.internet import defer
+from storm.info import get_cls_info, get_obj_info
+from storm.twisted.transact import Transactor
+from twisted.internet.task import cooperate, TaskStopped
+
+from mamba.utils.converter import Converter
+from mamba.enterprise.common import keyset_after
 
 
 class AsyncJSON(object):
@@ -23,21 +31,42 @@ class AsyncJSON(object):
     block itself the web server, preventing other requests from being
     serviced. This class prevents that type of inconveniences.
 
+    The top level items of lists and dicts are encoded one by one with the
+    fast one shot encoder and buffered into chunks of :attr:`chunk_size`
+    bytes. If the whole value fits in the first chunk it is written in a
+    single write without registering any producer.
+
+    Objects that the JSON encoder doesn't know are converted using
+    :meth:`~mamba.utils.converter.Converter.default`.
+
     This class is based on Jean Paul Calderone post at:
         http://jcalderone.livejournal.com/55680.html
     """
 
+    chunk_size = 64 * 1024
+    encoder = JSONEncoder(default=Converter.default)
+
     def __init__(self, value):
         self._value = value
 
     def begin(self, consumer):
         self._consumer = consumer
-        self._iterable = JSONEncoder().iterencode(self._value)
+        self._iterable = self._chunks()
+
+        first = next(self._iterable, None)
+        last = next(self._iterable, None)
+        if last is None:
+            # small payload, just write it
+            if first is not None:
+                self._consumer.write(first)
+            return defer.succeed(None)
+
+        self._consumer.write(first)
         self._consumer.registerProducer(self, True)
-        self._task = cooperate(self._produce())
-        defer = self._task.whenDone()
-        defer.addBoth(self._unregister)
-        return defer
+        self._task = cooperate(self._produce(last))
+        d = self._task.whenDone()
+        d.addBoth(self._unregister)
+        return d
 
     def pause(self):
         self._task.pause()
@@ -48,11 +77,53 @@ class AsyncJSON(object):
     def stop(self):
         self._task.stop()
 
-    def _produce(self):
+    def _produce(self, pending):
+        self._consumer.write(pending)
+        yield None
         for chunk in self._iterable:
             self._consumer.write(chunk)
             yield None
 
+    def _chunks(self):
+        """Join the encoded pieces into chunks of chunk_size bytes
+        """
+
+        buf = []
+        size = 0
+        for piece in self._pieces(self._value):
+            buf.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+
+        if buf:
+            yield ''.join(buf)
+
+    def _pieces(self, value):
+        """Encode the top level items of value one by one
+        """
+
+        encode = self.encoder.encode
+        if isinstance(value, (list, tuple)):
+            yield '['
+            for index, item in enumerate(value):
+                if index:
+                    yield ', '
+                yield encode(item)
+            yield ']'
+        elif type(value) is dict:
+            yield '{'
+            for index, item in enumerate(value.iteritems()):
+                if index:
+                    yield ', '
+                # let the encoder take care of converting the keys
+                yield encode(dict((item,)))[1:-1]
+            yield '}'
+        else:
+            yield encode(value)
+
     def _unregister(self, passthrough):
         self._consumer.unregisterProducer()
         return passthrough
@@ -65,3 +136,152 @@ class AsyncJSON(object):
 
     def stopProducing(self):
         self.stop()
+
+
+class JSONStream(AsyncJSON):
+    """
+    Streamed JSON response.
+
+    I write the rows of an iterable to the consumer as a JSON array (or as
+    newline delimited JSON if :attr:`ndjson` is True) fetching and encoding
+    them in batches of `batch_size` rows, so the memory used depends on
+    the size of the batches and not on the number of rows.
+
+    Subclasses can override :meth:`fetch` to get the batches from other
+    sources (like a database thread pool).
+
+    :param rows: the iterable of rows to stream
+    :param batch_size: the number of rows to fetch and write at once
+    :type batch_size: int
+    """
+
+    def __init__(self, rows=(), batch_size=500):
+        super(JSONStream, self).__init__(rows)
+        self.batch_size = batch_size
+        self.ndjson = False
+        self._rows = None
+
+    def fetch(self):
+        """
+        Return a Deferred that fires with the next batch of rows, an empty
+        batch means that there are no more rows to stream
+        """
+
+        if self._rows is None:
+            self._rows = iter(self._value)
+
+        return defer.succeed(list(islice(self._rows, self.batch_size)))
+
+    def begin(self, consumer):
+        self._consumer = consumer
+        self._consumer.registerProducer(self, True)
+        self._task = cooperate(self._produce())
+        d = self._task.whenDone()
+        d.addBoth(self._unregister)
+        d.addErrback(self._failed)
+        return d
+
+    def _produce(self):
+        encode = self.encoder.encode
+        if not self.ndjson:
+            self._consumer.write('[')
+
+        first = True
+        while True:
+            batch = []
+            # the cooperator waits for the Deferred before going on
+            yield self.fetch().addCallback(batch.extend)
+            if not batch:
+                break
+
+            if self.ndjson:
+                data = '\n'.join(encode(row) for row in batch) + '\n'
+            else:
+                data = ', '.join(encode(row) for row in batch)
+                if not first:
+                    data = ', ' + data
+
+            first = False
+            self._consumer.write(data)
+            yield None
+
+        if not self.ndjson:
+            self._consumer.write(']')
+
+    def _failed(self, failure):
+        """
+        The headers are already sent so we can just log the error
+        """
+
+        if failure.check(TaskStopped) is None:
+            log.err(failure)
+
+
+class ResultStream(JSONStream):
+    """
+    I am a lazy query of a model that can be returned from controller
+    routes to stream its registers to the client as a JSON array (or as
+    newline delimited JSON if the client sends `application/x-ndjson` in
+    its Accept header).
+
+    The query is an optional callable that gets a Storm store and returns
+    a ResultSet of the model (all the registers are streamed if it is not
+    given). It is run in the database thread pool of the model once per
+    batch and the registers are converted to dicts in the pool thread so
+    no Storm object ever reaches the reactor thread::
+
+        @route('/users')
+        def users(self, request, **kwargs):
+            return ResultStream(
+                User, lambda store: store.find(User, User.active == True)
+            )
+
+    The registers are streamed in primary key order. Every batch starts
+    after the primary key of the last register of the previous one
+    (keyset pagination) so big tables are not scanned again and again and
+    no register is skipped or repeated if the table is written meanwhile.
+
+    The next batch is not fetched until the last one is written and the
+    consumer is not paused so the peak memory depends on the batch size.
+
+    :param model: the model class of the registers to stream
+    :type model: :class:`~mamba.application.model.Model`
+    :param query: callable that gets a store and returns a ResultSet
+    :param batch_size: the number of registers to fetch on every batch
+    :type batch_size: int
+    """
+
+    def __init__(self, model, query=None, batch_size=500):
+        super(ResultStream, self).__init__(query, batch_size)
+        self.model = model
+        self.transactor = Transactor(model.database.pool)
+        self._last = None
+
+    def fetch(self):
+        """Fetch the next batch of registers in the database thread pool
+        """
+
+        return self.transactor.run(self._fetch)
+
+    def _fetch(self):
+        """Run the query and convert the next batch of registers
+        """
+
+        store = self.model.database.store()
+        if self._value is None:
+            result = store.find(self.model)
+        else:
+            result = self._value(store)
+
+        primary = get_cls_info(self.model).primary_key
+        if self._last is not None:
+            result = result.find(keyset_after(primary, self._last))
+
+        objects = list(result.order_by(*primary)[:self.batch_size])
+        if objects:
+            self._last = [
+                variable.get(to_db=True)
+                for variable in get_obj_info(objects[-1]).primary_vars
+            ]
+
+        return [Converter.fields(obj) for obj in objects]
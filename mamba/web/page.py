@@ -46,6 +46,12 @@ class Page(resource.Resource):
         # register controllers
         self.register_controllers()
 
+        # compile the templates before the first request if configured
+        if getattr(self.config, 'precompile_templates', False):
+            log.msg('Precompiled {} templates'.format(
+                self.precompile_templates())
+            )
+
     def add_script(self, script):
         """Adds a script to the page
         """
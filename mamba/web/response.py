@@ -20,6 +20,8 @@ from zope.interface import implements
 from mamba.utils.output import brown
 from mamba.core.interfaces import IResponse
 
+UPGRADE_REQUIRED = 426
+
 
 class Response(object):
     """
@@ -39,9 +41,9 @@ class Response(object):
         self.subject = subject
         self.headers = headers
 
-        if code in (http.BAD_REQUEST, http.NOT_FOUND):
+        if code in (http.BAD_REQUEST, http.NOT_FOUND, UPGRADE_REQUIRED):
             log.msg(brown(self.subject), logLevel=logging.WARN)
-        elif code == http.OK:
+        elif code in (http.OK, http.SWITCHING):
             pass
         else:
             log.err(self)
@@ -69,6 +71,18 @@ class Ok(Response):
         super(Ok, self).__init__(http.OK, subject, headers)
 
 
+class SwitchingProtocols(Response):
+    """
+    Switching Protocols 101 HTTP Response, the connection has been taken
+    over by another protocol (like a WebSocket) so nothing is sent back
+    """
+
+    implements(IResponse)
+
+    def __init__(self):
+        super(SwitchingProtocols, self).__init__(http.SWITCHING, '', {})
+
+
 class Found(Response):
     """
     Ok 302 HTTP Response
@@ -189,6 +203,44 @@ class AlreadyExists(Conflict):
         )
 
 
+class RequestEntityTooLarge(Response):
+    """
+    Error 413 Request Entity Too Large
+
+    :param subject: the subject body of he response
+    :type subject: :class:`~mamba.web.Response` or dict or str
+    :param headers: the HTTP headers to return back in the response to the
+                    browser
+    :type headers: dict or a list of dicts
+    """
+
+    implements(IResponse)
+
+    def __init__(self, subject='Request Entity Too Large', headers={}):
+        super(RequestEntityTooLarge, self).__init__(
+            http.REQUEST_ENTITY_TOO_LARGE, subject, headers
+        )
+
+
+class UpgradeRequired(Response):
+    """
+    Error 426 Upgrade Required
+
+    :param subject: the subject body of he response
+    :type subject: :class:`~mamba.web.Response` or dict or str
+    :param headers: the HTTP headers to return back in the response to the
+                    browser
+    :type headers: dict or a list of dicts
+    """
+
+    implements(IResponse)
+
+    def __init__(self, subject='Upgrade Required', headers={}):
+        super(UpgradeRequired, self).__init__(
+            UPGRADE_REQUIRED, subject, headers
+        )
+
+
 class InternalServerError(Response):
     """
     Error 500 Internal Server Error
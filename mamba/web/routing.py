@@ -19,14 +19,21 @@ from singledispatch import singledispatch
 from collections import defaultdict, OrderedDict
 
 from twisted.python import log
-from twisted.internet import defer
 from twisted.web.http import parse_qs
+from twisted.internet import defer, threads
+from twisted.internet.protocol import Factory
+from twisted.internet.interfaces import IProtocol
 
-from mamba.web import response
+from mamba.web import response, websocket
+from mamba.web.asyncjson import JSONStream
 from mamba.utils import output, config
 from mamba.utils.converter import Converter
 from mamba.web.url_sanitizer import UrlSanitizer
-from mamba.core.decorators import unlimited_cache
+
+
+class RequestBodyTooLarge(Exception):
+    """Raised when a request body is bigger than the configured limit
+    """
 
 
 class UrlRegex(object):
@@ -45,6 +52,39 @@ class UrlRegex(object):
         "\"|\\?'.*?'|[^'\">\s]+))?)+\s*|\s*)\/?>"
     )
 
+    @staticmethod
+    def translate(url):
+        """
+        Translates an URL pattern like `/user/<int:user_id>` into a regular
+        expression string and an ordered dict of argument names and their
+        type converters (None for string arguments)
+
+        :param url: the URL pattern to translate
+        :type url: str
+        :returns: tuple of (regex string, OrderedDict)
+        """
+
+        url_matcher = url
+        arguments = OrderedDict()
+
+        for match in UrlRegex.url_matcher.findall(url):
+            if not match[0]:  # string
+                url_matcher = url_matcher.replace(
+                    '<{}>'.format(match[1]),
+                    UrlRegex.type_regex[match[0]].replace('type', match[1])
+                )
+            else:
+                url_matcher = url_matcher.replace(
+                    '<{}:{}>'.format(*match),
+                    UrlRegex.type_regex[match[0]].replace('type', match[1])
+                )
+
+            arguments.update({
+                match[1]: None if not match[0] else eval(match[0])
+            })
+
+        return url_matcher, arguments
+
 
 class Route(object):
     """
@@ -67,7 +107,11 @@ class Route(object):
         self.arguments = OrderedDict()
         self.method = method
         self.callback = callback
-        self.callback_args = {}
+
+        try:
+            self.accepts_kwargs = inspect.getargspec(callback)[2] is not None
+        except TypeError:
+            self.accepts_kwargs = True
 
         super(Route, self).__init__()
 
@@ -76,30 +120,15 @@ class Route(object):
         Compiles the regex matches using the complete URL
         """
 
-        url_matcher = '^{url}$'.format(url=self.url)
-
-        for match in UrlRegex.url_matcher.findall(self.url):
-            if not match[0]:  # string
-                url_matcher = url_matcher.replace(
-                    '<{}>'.format(match[1]),
-                    UrlRegex.type_regex[match[0]].replace('type', match[1])
-                )
-            else:
-                url_matcher = url_matcher.replace(
-                    '<{}:{}>'.format(*match),
-                    UrlRegex.type_regex[match[0]].replace('type', match[1])
-                )
-
-            self.arguments.update({
-                match[1]: None if not match[0] else eval(match[0])
-            })
-
-        self.match = re.compile(url_matcher)
+        url_matcher, arguments = UrlRegex.translate(self.url)
+        self.arguments.update(arguments)
+        self.match = re.compile('^{url}$'.format(url=url_matcher))
 
     def validate(self, dispatcher):
         """
         Validate a given path against stored URLs. Returns None if
-        nothing matched itself otherwise
+        nothing matched a :class:`~mamba.web.routing.RouteMatch` for
+        myself otherwise
 
         :param dispatcher: the dispatcher object that containing the
                            information to validate
@@ -108,17 +137,14 @@ class Route(object):
 
         group = self.match.search(dispatcher.url)
         if group is not None:
-            self.callback_args = group.groupdict()
+            path_args = group.groupdict()
 
-            if len(self.callback_args):
-                for key, value in self.callback_args.iteritems():
-                    if self.arguments.get(key) is not None:
-                        # convert to the correct type
-                        self.callback_args.update({
-                            key: self.arguments.get(key)(value)
-                        })
+            for key, value in path_args.iteritems():
+                if self.arguments.get(key) is not None:
+                    # convert to the correct type
+                    path_args[key] = self.arguments.get(key)(value)
 
-            return self
+            return RouteMatch(self, path_args)
 
         return None
 
@@ -127,7 +153,7 @@ class Route(object):
             map(repr, [self.method, self.url, self.callback, self.arguments]))
         )
 
-    def __call__(self, controller, request):
+    def __call__(self, controller, request, **kwargs):
         """
         Make sure we call the decorated method with the correct args
 
@@ -135,7 +161,357 @@ class Route(object):
         :type request: :class:`~twisted.web.server.Request`
         """
 
-        return self.callback(controller, request, **self.callback_args)
+        return self.callback(controller, request, **kwargs)
+
+
+class WebSocketRoute(Route):
+    """
+    I am a Route that upgrades the HTTP connection of GET requests to a
+    WebSocket. My callback returns the
+    :class:`twisted.internet.protocol.Protocol` that talks over it.
+    """
+
+    def __init__(self, url, callback):
+        """
+        :param url: the URL path
+        :type url: string
+        :param callback: the callable callback
+        :type callback: callabe object
+        """
+        super(WebSocketRoute, self).__init__('GET', url, callback)
+
+
+class RouteMatch(object):
+    """
+    I am the result of matching a request against a
+    :class:`~mamba.web.routing.Route`.
+
+    Routes are shared by every request so they never store per request
+    data, I hold the matched route, the typed path arguments and the
+    arguments that came in the request query or body instead. The path
+    arguments can be shared between matches (they come from the router
+    cache) and are never modified.
+
+    :param route: the matched route
+    :type route: :class:`~mamba.web.routing.Route`
+    :param path_args: the typed arguments captured from the URL
+    :type path_args: dict
+    :param body_args: the arguments parsed from the request query or body
+    :type body_args: dict
+    """
+
+    __slots__ = ('route', 'path_args', 'body_args')
+
+    def __init__(self, route, path_args=None, body_args=None):
+        self.route = route
+        self.path_args = path_args if path_args is not None else {}
+        self.body_args = body_args if body_args is not None else {}
+
+    @property
+    def arguments(self):
+        """
+        Return the arguments to pass to the route callback, path arguments
+        always take precedence over the request ones
+        """
+
+        arguments = dict(self.body_args)
+        arguments.update(self.path_args)
+
+        return arguments
+
+    def __repr__(self):
+        return 'RouteMatch({})'.format(', '.join(
+            map(repr, [self.route, self.path_args, self.body_args]))
+        )
+
+    def __call__(self, controller, request):
+        """
+        Call the matched route with the path and request arguments
+
+        :param request: the HTTP request
+        :type request: :class:`~twisted.web.server.Request`
+        """
+
+        return self.route(controller, request, **self.arguments)
+
+
+class RouteSegment(object):
+    """
+    I am a typed wildcard edge in the :class:`~mamba.web.routing.RouteTrie`,
+    I match a single URL segment that contains one or more `<arguments>`
+    and convert the captured values to their declared types.
+
+    :param pattern: the raw URL segment, like `<int:user_id>`
+    :type pattern: str
+    """
+
+    __slots__ = ('pattern', 'regex', 'arguments', 'priority', 'node')
+
+    # static segments are always tried first, then typed wildcards from
+    # the most to the less restrictive one
+    priorities = {int: 0, float: 1, None: 3}
+
+    def __init__(self, pattern):
+        url_matcher, self.arguments = UrlRegex.translate(pattern)
+        self.pattern = pattern
+        self.regex = re.compile('^{}$'.format(url_matcher))
+        self.node = RouteNode()
+
+        types = self.arguments.values()
+        if len(types) == 1 and UrlRegex.url_matcher.sub('', pattern) == '':
+            self.priority = self.priorities[types[0]]
+        else:
+            self.priority = 2
+
+    def match(self, segment):
+        """
+        Match the given URL segment and return back a dict with the
+        converted arguments or None if the segment doesn't match
+
+        :param segment: the URL segment to match
+        :type segment: str
+        """
+
+        group = self.regex.match(segment)
+        if group is None:
+            return None
+
+        values = group.groupdict()
+        try:
+            for key, converter in self.arguments.iteritems():
+                if converter is not None:
+                    values[key] = converter(values[key])
+        except ValueError:
+            return None
+
+        return values
+
+    def __repr__(self):
+        return 'RouteSegment({})'.format(repr(self.pattern))
+
+
+class RouteNode(object):
+    """
+    I am a node in the :class:`~mamba.web.routing.RouteTrie`. I store the
+    static children (as a dict) and the typed wildcard children (as a list
+    of :class:`~mamba.web.routing.RouteSegment`) for the next URL segment
+    and the routes that terminate on myself indexed by controller name and
+    HTTP method, so the allowed methods for a given path and controller
+    are just the keys of that index.
+    """
+
+    __slots__ = ('static', 'dynamic', 'routes')
+
+    def __init__(self):
+        self.static = {}
+        self.dynamic = []
+        self.routes = {}
+
+    def child(self, segment):
+        """
+        Return the child node for the given pattern segment, create it if
+        it doesn't exists yet
+
+        :param segment: the URL pattern segment
+        :type segment: str
+        """
+
+        if UrlRegex.url_matcher.search(segment) is None:
+            node = self.static.get(segment)
+            if node is None:
+                node = self.static[segment] = RouteNode()
+
+            return node
+
+        for edge in self.dynamic:
+            if edge.pattern == segment:
+                return edge.node
+
+        edge = RouteSegment(segment)
+        self.dynamic.append(edge)
+        self.dynamic.sort(key=lambda edge: edge.priority)
+
+        return edge.node
+
+    def allowed_methods(self, controller):
+        """
+        Return the set of HTTP methods that the given controller name
+        accepts in this node
+
+        :param controller: the controller class name
+        :type controller: str
+        """
+
+        return set(self.routes.get(controller, {}).keys())
+
+
+class RouteTrie(object):
+    """
+    I index routes by URL segment so a lookup costs O(path depth) instead
+    of running every registered route regex against the requested URL.
+
+    A lookup that finds the path but not the HTTP method returns the
+    `'NotImplemented'` marker without any extra scan.
+    """
+
+    def __init__(self):
+        self.root = RouteNode()
+
+    @staticmethod
+    def split(url):
+        """Split a sanitized URL into its segments
+        """
+
+        return url.split('/')[1:] if url else []
+
+    def insert(self, controller, route):
+        """
+        Insert a compiled route for the given controller name
+
+        :param controller: the controller class name
+        :type controller: str
+        :param route: the route to insert
+        :type route: :class:`~mamba.web.routing.Route`
+        """
+
+        node = self.root
+        for segment in self.split(route.url):
+            node = node.child(segment)
+
+        node.routes.setdefault(controller, {})[route.method] = route
+
+    def lookup(self, controller, method, url):
+        """
+        Look for a route for the given controller, HTTP method and URL
+
+        :param controller: the controller class name
+        :type controller: str
+        :param method: the HTTP method
+        :type method: str
+        :param url: the sanitized URL
+        :type url: str
+        :returns: a tuple with the :class:`~mamba.web.routing.Route` (or
+                  'NotImplemented' or None) and a dict of typed arguments
+        """
+
+        fallback = []
+        found = self._walk(
+            self.root, self.split(url), 0, controller, method, {}, fallback
+        )
+        if found is not None:
+            return found
+
+        if len(fallback) > 0:
+            return 'NotImplemented', {}
+
+        return None, {}
+
+    def _walk(self, node, segments, index, controller, method, args, fb):
+        """
+        Depth first walk that prefers static segments and backtracks into
+        typed wildcards if the static branch doesn't lead to a route
+        """
+
+        if index == len(segments):
+            routes = node.routes.get(controller)
+            if routes:
+                if method in routes:
+                    return routes[method], args
+
+                fb.append(node)
+
+            return None
+
+        segment = segments[index]
+        child = node.static.get(segment)
+        if child is not None:
+            found = self._walk(
+                child, segments, index + 1, controller, method, args, fb
+            )
+            if found is not None:
+                return found
+
+        for edge in node.dynamic:
+            values = edge.match(segment)
+            if values is not None:
+                values.update(args)
+                found = self._walk(
+                    edge.node, segments, index + 1,
+                    controller, method, values, fb
+                )
+                if found is not None:
+                    return found
+
+        return None
+
+
+class RouteCache(object):
+    """
+    I am a bounded LRU cache of resolved routes.
+
+    Entries are keyed by `(method, controller name, sanitized path)` and
+    store the matched :class:`~mamba.web.routing.Route` and its converted
+    path arguments so hot URLs skip the route lookup entirely. I never
+    store request objects.
+
+    The size of the cache can be configured using the `route_cache_size`
+    option in the application config file, a size of 0 disables it.
+
+    :param size: the max number of entries to store, if None is given
+                 then the application configuration value is used
+    :type size: int
+    """
+
+    default_size = 1024
+
+    def __init__(self, size=None):
+        self._size = size
+        self._cache = OrderedDict()
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = getattr(
+                config.Application(), 'route_cache_size', self.default_size
+            )
+
+        return self._size
+
+    def get(self, key):
+        """Get the cached value for key and mark it as recently used
+        """
+
+        try:
+            value = self._cache.pop(key)
+        except KeyError:
+            return None
+
+        self._cache[key] = value
+        return value
+
+    def set(self, key, value):
+        """Store a value for key evicting the least recently used ones
+        """
+
+        if self.size <= 0:
+            return
+
+        self._cache.pop(key, None)
+        self._cache[key] = value
+        while len(self._cache) > self.size:
+            self._cache.popitem(False)
+
+    def clear(self):
+        """Remove all the cached entries
+        """
+
+        self._cache.clear()
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
 
 
 class Router(object):
@@ -144,6 +520,10 @@ class Router(object):
 
     A route is stores as:
         [methods][route][Controller.__class__.__name__]
+
+    and indexed by URL segment in a :class:`~mamba.web.routing.RouteTrie`
+    that is the one used to lookup routes on dispatch. Resolved routes are
+    cached in a :class:`~mamba.web.routing.RouteCache`
     """
 
     def __init__(self):
@@ -157,15 +537,48 @@ class Router(object):
             'PATCH': defaultdict(dict),
             'HEAD': defaultdict(dict)
         }
+        self.trie = RouteTrie()
+        self.cache = RouteCache()
+        self._max_body_size = None
+        self._websockets = None
 
         self._prepare_response = singledispatch(self._prepare_response)
         self._prepare_response.register(str, self._prepare_response_str)
         self._prepare_response.register(
             response.Response, self._prepare_response_object)
+        self._prepare_response.register(
+            JSONStream, self._prepare_response_stream)
 
         super(Router, self).__init__()
 
-    @unlimited_cache
+    @property
+    def max_body_size(self):
+        """
+        The max size in bytes of request bodies that we parse, it can be
+        configured using the `max_body_size` option in the application
+        config file. A size of 0 means no limit
+        """
+
+        if self._max_body_size is None:
+            self._max_body_size = getattr(
+                config.Application(), 'max_body_size', 10 * 1024 * 1024
+            )
+
+        return self._max_body_size
+
+    @property
+    def websockets(self):
+        """
+        The :class:`~mamba.web.websocket.WebSocketFactory` that tracks the
+        connections upgraded by the `@websocket` routes, its `hub` can be
+        used to broadcast messages to them
+        """
+
+        if self._websockets is None:
+            self._websockets = websocket.WebSocketFactory(Factory())
+
+        return self._websockets
+
     def dispatch(self, controller, request):
         """
         Dispatch a route and return back the appropiate response.
@@ -177,12 +590,20 @@ class Router(object):
         """
 
         try:
-            route = RouteDispatcher(self, controller, request).lookup()
+            dispatcher = RouteDispatcher(self, controller, request)
+            route = dispatcher.lookup()
 
-            if type(route) is Route:
+            if type(route) is RouteMatch and isinstance(
+                    route.route, WebSocketRoute):
+                result = self._upgrade(route, controller, request)
+            elif type(route) is RouteMatch:
                 # at this point we can get a Deferred or an inmediate result
                 # depending on the user code
-                result = defer.maybeDeferred(route, controller, request)
+                result = dispatcher.parse_body(route)
+                result.addCallbacks(
+                    lambda match: match(controller, request),
+                    self._process_body_error
+                )
                 result.addCallback(self._process, request)
                 result.addErrback(self._process_error, request)
             elif route == 'NotImplemented':
@@ -283,6 +704,8 @@ class Router(object):
                 bold('Registering route:') + ' {route}'.format(route=route))
 
         self.routes[route.method][route.url][controller_name] = route
+        self.trie.insert(controller_name, route)
+        self.cache.clear()
 
     # decorator
     def route(self, url, method='GET'):
@@ -300,6 +723,93 @@ class Router(object):
 
         return decorator
 
+    def websocket(self, url):
+        """
+        Register WebSocket routes for controllers, the decorated method
+        returns the protocol that talks over the upgraded connection::
+
+            @websocket('/chat')
+            def chat(self, request, **kwargs):
+                return ChatProtocol()
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return func
+
+            setattr(wrapper, 'route', WebSocketRoute(url, func))
+
+            return wrapper
+
+        return decorator
+
+    def _upgrade(self, match, controller, request):
+        """
+        Check the upgrade request, call the route and take over the
+        connection with the returned protocol
+        """
+
+        error = self._upgrade_error(request)
+        if error is not None:
+            return defer.succeed(error)
+
+        result = defer.maybeDeferred(match, controller, request)
+        result.addCallback(self._take_over, request)
+        result.addErrback(self._process_error, request)
+        return result
+
+    def _upgrade_error(self, request):
+        """
+        Return back the error response for requests that we can't upgrade
+        to a HyBi-07+ WebSocket or None
+        """
+
+        headers = request.requestHeaders
+        upgrade = ','.join(headers.getRawHeaders('upgrade', [])).lower()
+        connection = ','.join(headers.getRawHeaders('connection', []))
+        version = headers.getRawHeaders('sec-websocket-version', [''])[0]
+
+        if 'websocket' not in upgrade or (
+                'upgrade' not in connection.lower()) or (
+                version not in websocket.VERSIONS):
+            return response.UpgradeRequired(
+                'This resource is only available over WebSocket', {
+                    'content-type': 'text/plain',
+                    'upgrade': 'websocket',
+                    'sec-websocket-version': ', '.join(
+                        reversed(websocket.VERSIONS))
+                }
+            )
+
+        if not headers.hasHeader('sec-websocket-key'):
+            return response.BadRequest(
+                'Missing Sec-WebSocket-Key header',
+                {'content-type': 'text/plain'}
+            )
+
+        return None
+
+    def _take_over(self, protocol, request):
+        """Upgrade the connection of the request for the given protocol
+        """
+
+        if not IProtocol.providedBy(protocol):
+            log.err('WebSocket route returned {!r} instead of a protocol'
+                    .format(protocol))
+            return response.InternalServerError(
+                'ERROR 500: Internal server error: the WebSocket route '
+                'didn\'t return a protocol'
+            )
+
+        channel = getattr(request, 'channel', None)
+        if getattr(channel, 'transport', None) is None or (
+                websocket.upgrade(request, protocol, self.websockets) is None):
+            return response.NotImplemented(
+                request.uri, 'This connection can\'t be upgraded'
+            )
+
+        return response.SwitchingProtocols()
+
     def _process(self, result, request):
         """
         Prepare and process the result.
@@ -313,6 +823,17 @@ class Router(object):
         except Exception as error:
             return self._process_error(result, request, error)
 
+    def _process_body_error(self, failure):
+        """
+        Send back a 413 response if the request body is too large
+        """
+
+        failure.trap(RequestBodyTooLarge)
+
+        return response.RequestEntityTooLarge(
+            str(failure.value), {'content-type': 'text/plain'}
+        )
+
     def _process_error(self, result, request, error=''):
         """
         Process and sendback an error response
@@ -349,6 +870,18 @@ class Router(object):
 
         return result
 
+    def _prepare_response_stream(self, result, request):
+        """Streams the result as JSON array or NDJSON if the client asks
+        """
+
+        accept = request.requestHeaders.getRawHeaders('accept', [])
+        result.ndjson = any('application/x-ndjson' in a for a in accept)
+        content_type = (
+            'application/x-ndjson' if result.ndjson else 'application/json'
+        )
+
+        return response.Ok(result, {'content-type': content_type})
+
     def _prepare_response_object(self, result, request):
         """Renders the result.subject into JSON if needed
         """
@@ -364,6 +897,9 @@ class RouteDispatcher(object):
     Look for a route, compile/process if neccesary and return it
     """
 
+    chunk_size = 64 * 1024
+    thread_threshold = 256 * 1024
+
     def __init__(self, router, controller, request):
         self.router = router
         self.request = request
@@ -375,69 +911,154 @@ class RouteDispatcher(object):
 
     def lookup(self):
         """
-        I traverse the URLs at router picking up the ones that match the
-        controller name and then process it to validate which ones match
-        by path/arguments to a particular Route
-
-        If nothing match just returns None
+        I look for the route in the router cache and if it is not there I
+        walk the router :class:`~mamba.web.routing.RouteTrie` segment by
+        segment looking for a route that match the controller name, the
+        HTTP method and the path/arguments of the request.
+
+        If a route match I return a :class:`~mamba.web.routing.RouteMatch`
+        for this request, if the path match but the HTTP method doesn't I
+        return the 'NotImplemented' marker, if nothing match just returns
+        None
         """
 
         # postpath '/' is not allowed when using mamba routing
         if len(self.request.postpath) and self.request.postpath[0] == '':
             return None
 
-        for controllers in self.router.routes[self.method].values():
-            if self.controller in controllers:
-                route = controllers.get(self.controller).validate(self)
-
-                if route:
-                    self._parse_request_args(route)
-                    return route
+        key = (self.method, self.controller, self.url)
+        cached = self.router.cache.get(key)
+        if cached is None:
+            cached = self.router.trie.lookup(
+                self.controller, self.method, self.url
+            )
+            if isinstance(cached[0], Route):
+                self.router.cache.set(key, cached)
 
-        for url in self.router.routes.values():
-            controllers = url.values()
-            if len(controllers):
-                for i in xrange(len(controllers)):
-                    if self.controller in controllers[i]:
-                        r = controllers[i].get(self.controller).validate(self)
-                        if r:
-                            return 'NotImplemented'
+        route, path_args = cached
+        if isinstance(route, Route):
+            return RouteMatch(route, path_args, self._parse_query_args(route))
 
-        return None
+        return route
 
-    def _parse_request_args(self, route):
+    def parse_body(self, match):
         """
-        Parses JSON data and request form if present
+        Parses the JSON data or the form in the request body if the matched
+        route can make use of it.
+
+        The body is only read if the route callback accepts keyword
+        arguments. It is read in chunks and if it is bigger than the router
+        `max_body_size` it fails with
+        :class:`~mamba.web.routing.RequestBodyTooLarge`. Bodies bigger than
+        `thread_threshold` are decoded in a worker thread so they don't
+        block the reactor.
+
+        :param match: the route match for the request
+        :type match: :class:`~mamba.web.routing.RouteMatch`
+        :returns: a :class:`twisted.internet.defer.Deferred` that fires with
+                  a :class:`~mamba.web.routing.RouteMatch` that contains
+                  the body arguments
         """
 
-        data = self.request.content.read()
-        data_json = {}
+        body_type = self._body_type(match)
+        if body_type is None:
+            return defer.succeed(match)
 
-        if self.request.method in ['POST', 'PUT']:
-            ct = self.request.requestHeaders.getRawHeaders('content-type')
-            if 'application/json' in ct:
-                try:
-                    data_json = json.loads(data)
-                except ValueError:
-                    data_json = {}
+        try:
+            data = self._read_body()
+        except RequestBodyTooLarge:
+            return defer.fail()
+
+        if len(data) > self.thread_threshold:
+            result = threads.deferToThread(self._decode_body, body_type, data)
+        else:
+            result = defer.succeed(self._decode_body(body_type, data))
 
-        request_args = self.request.args
-        request_headers = self.request.requestHeaders.getRawHeaders(
-            'content-type'
+        return result.addCallback(
+            lambda args: RouteMatch(match.route, match.path_args, args)
         )
 
+    def _parse_query_args(self, route):
+        """
+        Return back the query arguments if the route can make use of them
+        """
+
+        if not route.accepts_kwargs:
+            return {}
+
+        args = getattr(self.request, 'args', None) or {}
+        return {key: value[0] for key, value in args.iteritems()}
+
+    def _body_type(self, match):
+        """
+        Return back the type of the body that we have to parse for the
+        given match ('json' or 'form') or None if we don't need to read it
+        """
+
+        if not match.route.accepts_kwargs:
+            return None
+
+        if self.request.method not in ('POST', 'PUT'):
+            return None
+
+        content_types = [
+            value.split(';')[0].strip().lower() for value in
+            self.request.requestHeaders.getRawHeaders('content-type', [])
+        ]
+
         if self.request.method == 'PUT':
-            if 'application/x-www-form-urlencoded' in request_headers:
-                request_args = parse_qs(data, 1)
-
-        if len(request_args) > 0:
-            for key, value in request_args.iteritems():
-                if key not in route.callback_args:
-                    route.callback_args.update({key: value[0]})
-        elif data_json:
-            for key, value in data_json.iteritems():
-                if key not in route.callback_args:
-                    route.callback_args.update({key: value})
+            if 'application/x-www-form-urlencoded' in content_types:
+                return 'form'
+
+        # JSON data is only used when there are no query arguments
+        if 'application/json' in content_types and not match.body_args:
+            return 'json'
+
+        return None
+
+    def _read_body(self):
+        """
+        Read the request body in chunks honoring the max body size
+        """
+
+        limit = self.router.max_body_size
+        error = 'Request body is bigger than {} bytes'.format(limit)
+
+        length = self.request.requestHeaders.getRawHeaders('content-length')
+        if limit and length is not None and length[0].isdigit():
+            if int(length[0]) > limit:
+                raise RequestBodyTooLarge(error)
+
+        chunks = []
+        size = 0
+        while True:
+            chunk = self.request.content.read(self.chunk_size)
+            if not chunk:
+                break
+
+            size += len(chunk)
+            if limit and size > limit:
+                raise RequestBodyTooLarge(error)
+
+            chunks.append(chunk)
+
+        return ''.join(chunks)
+
+    @staticmethod
+    def _decode_body(body_type, data):
+        """
+        Decode the body data into a dict of arguments
+        """
+
+        if body_type == 'form':
+            return {key: value[0] for key, value in parse_qs(data, 1).items()}
+
+        try:
+            data_json = json.loads(data)
+        except ValueError:
+            return {}
+
+        return data_json if isinstance(data_json, dict) else {}
 
     def __repr__(self):
         return 'RouteDispatcher({})'.format(', '.join(
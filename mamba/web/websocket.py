@@ -13,20 +13,47 @@
 
 """
 
+import math
+import time
+import zlib
 from string import digits
+from collections import deque
 from hashlib import sha1, md5
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from zope.interface import implements
 from twisted.python import log
+from twisted.internet.task import cooperate, TaskFinished
 from twisted.web.http import datetimeToString
-from twisted.internet.interfaces import ISSLTransport
+from twisted.internet.interfaces import ISSLTransport, IPushProducer
 from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
 
-DATA, CLOSE, PING, PONG = range(4)                    # frame control
+DATA, CLOSE, PING, PONG, BINARY = range(5)            # frame control
 HYBI00, HYBI07, HYBI10, RFC6455 = range(4)            # supported versions
 HANDSHAKE, NEGOTIATION, CHALLENGE, FRAMES = range(4)  # state machine.
+DROP, DISCONNECT = range(2)                           # slow consumers
+
+VERSIONS = ('7', '8', '13')                          # HyBi-07+ versions
+HANDSHAKE_HEADERS = (
+    'Host', 'Origin', 'Connection', 'Upgrade', 'WebSocket-Protocol',
+    'Sec-WebSocket-Protocol', 'Sec-WebSocket-Key', 'Sec-WebSocket-Version',
+    'Sec-WebSocket-Extensions'
+)
 
 NORMAL_CLOSURE = 0x3e8
+GOING_AWAY = 0x3e9
+POLICY_VIOLATION = 0x3f0
+PROTOCOL_ERROR = 0x3ea
+MESSAGE_TOO_BIG = 0x3f1
+NUMPY_MASK_THRESHOLD = 256  # smaller payloads are faster without numpy
+
+# translate tables to XOR every octet with any given key octet
+_mask_tables = [''.join(chr(i ^ k) for i in range(256)) for k in range(256)]
 
 
 class WebSocketError(Exception):
@@ -64,6 +91,11 @@ class UnknownFrameOpcode(WebSocketError):
     """
 
 
+class MessageTooBig(WebSocketError):
+    """Fired when a message is bigger than the max message size
+    """
+
+
 class HandshakePreamble(object):
     """Common HandShake preamble class for all protocols
     """
@@ -139,12 +171,19 @@ class HyBi07HandshakePreamble(HandshakePreamble):
             '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
         )
 
-        return [
-            'Sec-WebSocket-Accept: {}\r\n\r\n'.format(
+        opening = [
+            'Sec-WebSocket-Accept: {}\r\n'.format(
                 sha1(key).digest().encode('base64').strip()
             )
         ]
 
+        if protocol.deflate is not None:
+            opening.append('Sec-WebSocket-Extensions: {}\r\n'.format(
+                protocol.deflate.response)
+            )
+
+        return opening + ['\r\n']
+
 
 class InvalidProtocolVersionPreamble(HandshakePreamble):
     """Send invalid protocol version response
@@ -266,7 +305,7 @@ class HyBi07Frame(object):
     opcodes = {
         0x0: DATA,
         0x1: DATA,
-        0x2: DATA,
+        0x2: BINARY,
         0x8: CLOSE,
         0x9: PING,
         0xa: PONG
@@ -275,7 +314,7 @@ class HyBi07Frame(object):
     def __init__(self, buf):
         self.buf = buf
 
-    def generate(self, opcode=0x1):
+    def generate(self, opcode=0x1, compressed=False):
         """
         Generate a HyBi-07+ frame.
 
@@ -286,6 +325,8 @@ class HyBi07Frame(object):
                            0x1 -> Text
                            0x2 -> Binary
         :type opcode: int
+        :param compressed: set the RSV1 flag of permessage-deflate messages
+        :type compressed: bool
         """
 
         if len(self.buf) > 0xffff:
@@ -296,165 +337,512 @@ class HyBi07Frame(object):
             length = chr(len(self.buf))
 
         return '{header}{length}{buf}'.format(
-            header=chr(0x80 | opcode), length=length, buf=self.buf
+            header=chr(0x80 | (0x40 if compressed else 0) | opcode),
+            length=length, buf=self.buf
         )
 
     def parse(self):
         """Parse HyBi-07+ frame.
+
+        :returns: a tuple with the list of parsed frames and the rest of
+                  the buffer that doesn't contain a complete frame yet
+        """
+
+        parser = HyBi07Parser()
+        frames = parser.feed(self.buf)
+        return frames, parser.pending
+
+    def mask(self, buf, key):
+        """Mask or unmask a buffer of bytes with a masking key
+
+        The masking key is a 32-bit value chosen by the browser client. The
+        key shouldn't affect the length of the `Payload data`. The used
+        algorithm is the following. Octet i of the transformed data is the
+        XOR of octet i of the original data with octet at index i modulo 4
+        of the masking key::
+
+            j = i % 4
+            octet[i] = octet[i] ^ key[j]
+
+        This means that if a third party have access to the key used by our
+        connection we are exposed. For more information about this please,
+        refer to [RFC6455][Page31]
+
+        :param buf: the buffer to mask or unmask
+        :param key: the masking key, it shoudl be exactly four bytes long
+
+        The whole buffer is XORed at once, using numpy if it is available
+        and the buffer is not too small or translating every stride of four
+        octets with a precomputed XOR table if it is not.
+        """
+
+        return _mask(buf, key)
+
+
+class HyBi07Parser(object):
+    """
+    Incremental HyBi-07+ frame parser.
+
+    I keep the received data in a `bytearray` and the offset of the first
+    frame that is not parsed yet so the data is never copied to parse it.
+    The header of every frame is parsed just once, if the payload of the
+    frame is not complete yet I remember the header until it arrives in
+    the next calls to :meth:`feed`. The consumed data is removed from the
+    buffer when it is more than the half of it so the buffer doesn't grow
+    without limit and the cost of removing it is amortized.
+
+    Fragmented messages are reassembled as is specified in
+    [RFC6455][Section 5.4] and messages compressed with the
+    permessage-deflate extension are decompressed if it was negotiated.
+
+    :param max_message_size: the max size of the messages (after they are
+                             decompressed), 0 means unlimited
+    :type max_message_size: int
+    :param deflate: the negotiated permessage-deflate extension if any
+    :type deflate: :class:`~mamba.web.websocket.PerMessageDeflate`
+    """
+
+    def __init__(self, max_message_size=0, deflate=None):
+        self.buf = bytearray()
+        self.offset = 0
+        self.header = None
+        self.max_message_size = max_message_size
+        self.deflate = deflate
+
+        # the fragmented message that is being reassembled
+        self.message = None
+        self.message_opcode = None
+        self.message_compressed = False
+        self.message_size = 0
+
+    @property
+    def pending(self):
+        """The data that has not been parsed yet
+        """
+
+        return str(self.buf[self.offset:])
+
+    def feed(self, data):
         """
+        Add the given data to the buffer and parse all the complete frames
 
-        start = 0
+        :param data: the received data
+        :type data: str
+        :returns: a list of (opcode, payload) tuples, data messages use the
+                  DATA opcode for text and BINARY for binary messages
+        """
+
+        self.buf.extend(data)
         frames = []
 
-        while  True:
-            # is there are not at least two bytes in the buffer, bail
-            if len(self.buf) - start < 2:
+        while True:
+            if self.header is None:
+                self.header = self._parse_header()
+                if self.header is None:
+                    break
+
+                self._check_message(self.header)
+
+            fin, raw_opcode, compressed, mask_key, size, length = self.header
+            end = self.offset + size + length
+            if len(self.buf) < end:
                 break
 
-            # grab the header, this first byte of data contains FIN, RSV1-3
-            # and the opcode
-            header = ord(self.buf[start])
-            fin = (header & 0x80) != 0
-            if header & 0x70:
-                # at least one of the reserved flags is set.
-                # TODO: look at extensions to chekc if something is negotiated
-                #       as is specified by [RFC6455][Page 28]
-                # Someday, perhaps...
-                raise ReservedFlagsInFrame(
-                    'Reserved flag in HyBi-07 frame {}'.format(
-                        '{:#x} ({:#b})'.format(header, header)
+            payload = memoryview(self.buf)[self.offset + size:end].tobytes()
+            self.offset = end
+            self.header = None
+
+            if mask_key is not None:
+                payload = _mask(payload, mask_key)
+
+            opcode = HyBi07Frame.opcodes[raw_opcode]
+            if opcode in (DATA, BINARY):
+                message = self._reassemble(
+                    fin, opcode, compressed, payload)
+                if message is not None:
+                    frames.append(message)
+                continue
+
+            if opcode == CLOSE:
+                if len(payload) >= 2:
+                    # unpack the opcode and return usable data
+                    payload = unpack('>H', payload[:2])[0], payload[2:]
+                else:
+                    payload = NORMAL_CLOSURE, 'No reason given'
+
+            frames.append((opcode, payload))
+
+        self._compact()
+        return frames
+
+    def _check_message(self, header):
+        """
+        Check that the frame of the given header can be part of the current
+        message before we wait for its payload
+        """
+
+        fin, raw_opcode, compressed, mask_key, size, length = header
+        if raw_opcode & 0x8:
+            # control frames can be injected between fragments
+            return
+
+        if raw_opcode == 0x0 and self.message is None:
+            raise WebSocketError('Continuation frame without a message')
+
+        if raw_opcode != 0x0 and self.message is not None:
+            raise WebSocketError(
+                'New message before the end of the fragmented message'
+            )
+
+        if self.max_message_size and (
+                self.message_size + length > self.max_message_size):
+            raise MessageTooBig(
+                'Message bigger than {} octets'.format(self.max_message_size)
+            )
+
+    def _reassemble(self, fin, opcode, compressed, payload):
+        """
+        Add the payload of a data frame to the current message and return
+        back the (opcode, message) tuple if the message is complete
+        """
+
+        if self.message is None:
+            if fin:
+                # not fragmented, the most common case
+                return opcode, self._decompress(compressed, payload)
+
+            self.message = []
+            self.message_opcode = opcode
+            self.message_compressed = compressed
+            self.message_size = 0
+
+        self.message.append(payload)
+        self.message_size += len(payload)
+        if not fin:
+            return None
+
+        message = ''.join(self.message)
+        opcode, compressed = self.message_opcode, self.message_compressed
+        self.message = None
+        self.message_size = 0
+        return opcode, self._decompress(compressed, message)
+
+    def _decompress(self, compressed, payload):
+        """Decompress the payload of the message if it is compressed
+        """
+
+        if not compressed:
+            return payload
+
+        return self.deflate.decompress(payload, self.max_message_size)
+
+    def _parse_header(self):
+        """
+        Parse the header of the next frame, returns None if the header is
+        not complete yet or a tuple with the FIN flag, the raw opcode, the
+        RSV1 (compressed) flag, the masking key, the size of the header and
+        the length of the payload
+        """
+
+        buf = self.buf
+        start = self.offset
+
+        # is there are not at least two bytes in the buffer, bail
+        if len(buf) - start < 2:
+            return None
+
+        # grab the header, this first byte of data contains FIN, RSV1-3
+        # and the opcode
+        header = buf[start]
+        fin = (header & 0x80) != 0
+        raw_opcode = header & 0xf
+
+        # RSV1 marks compressed messages if permessage-deflate has been
+        # negotiated, it can be only set in the first frame of a message
+        compressed = (header & 0x40) != 0
+        if header & 0x30 or compressed and (
+                self.deflate is None or raw_opcode not in (0x1, 0x2)):
+            raise ReservedFlagsInFrame(
+                'Reserved flag in HyBi-07 frame {}'.format(
+                    '{:#x} ({:#b})'.format(header, header)
+                )
+            )
+
+        # get the opcode
+        if raw_opcode not in HyBi07Frame.opcodes:
+            raise UnknownFrameOpcode(
+                'Unknown opcode {:#b} in HyBi-07 frame'.format(raw_opcode)
+            )
+
+        # get the mask flag and payload length from the next byte and
+        # determine if we have to look for any extra length
+        data = buf[start + 1]
+        masked = (data & 0x80) != 0  # most significant bit (should be 1)
+        length = data & 0x7f
+
+        # check opcodes for given frames
+        if raw_opcode & 0x8:
+            # control frames shouldn't be fragmented
+            if fin is False:
+                raise WebSocketError(
+                    'Fragmented control frame with opcode {:#x}'.format(
+                        raw_opcode
                     )
                 )
 
-            # get the opcode
-            raw_opcode = header & 0xf
-            opcode = self.opcodes.get(raw_opcode)
-            if opcode is None:
-                raise UnknownFrameOpcode(
-                    'Unknown opcode {:#b} in HyBi-07 frame'.format(raw_opcode)
+            # control frames shouldn't have more than 125 octects length
+            if length > 0x7d:
+                raise WebSocketError(
+                    'Control frame with payload longer than 125 octets, '
+                    'opcode {:#b}'.format(raw_opcode)
                 )
 
-            # get the mask flag and payload length from the next byte and
-            # determine if we have to look for any extra length
-            data = ord(self.buf[start + 1])
-            masked = (data & 0x80) != 0  # most significant bit (should be 1)
-            length = data & 0x7f
-
-            # check opcodes for given frames
-            if opcode >= CLOSE:
-                # control frames shouldn't be fragmented
-                if fin is False:
-                    raise WebSocketError(
-                        'Fragmented control frame with opcode {:#x}'.format(
-                            raw_opcode
-                        )
-                    )
+        # the offset we're going to use to walk through the frame
+        offset = 2
+
+        # extra length fields. if the value is 126 then the following 2
+        # bytes interpreted as 16-bit unsigned integer are the payload
+        # length
+        if length == 0x7e:
+            if len(buf) - start < 4:
+                return None
+
+            length = unpack_from('>H', buf, start + 2)[0]
+            offset += 2
+        # if the value is 127 then the following 8 bytes interpreted as
+        # a 64-bit unsigned integer are the payload length
+        elif length == 0x7f:
+            if len(buf) - start < 10:
+                return None
+
+            length = unpack_from('>Q', buf, start + 2)[0]
+            offset += 8
+
+        # browser client is supossed to send all frames masked so this
+        # should be always True
+        mask_key = None
+        if masked:
+            if len(buf) - (start + offset) < 4:
+                return None
+
+            mask_key = str(buf[start + offset:start + offset + 4])
+            offset += 4
+
+        return fin, raw_opcode, compressed, mask_key, offset, length
+
+    def _compact(self):
+        """Remove the parsed data from the buffer when it is worth it
+        """
 
-                # control frames shouldn't have more than 125 octects length
-                if length > 0x7d:
-                    raise WebSocketError(
-                        'Control frame with payload longer than 125 octets, '
-                        'opcode {:#b}'.format(raw_opcode)
-                    )
+        if self.offset == len(self.buf):
+            del self.buf[:]
+            self.offset = 0
+        elif self.offset > len(self.buf) // 2:
+            del self.buf[:self.offset]
+            self.offset = 0
 
-                # opcodes 0xb to 0xf are reserved for further control frames
-                if opcode > PONG:
-                    raise WebSocketError(
-                        'Control frame using reserved opcode {:#x}'.format(
-                            raw_opcode
-                        )
-                    )
-            else:
-                # data frames can only use opcodes 0x0, 0x1 and 0x2
-                if opcode != DATA:
-                    raise WebSocketError(
-                        'Data frame using weird opcode {:#x}'.format(
-                            raw_opcode
-                        )
-                    )
 
-            # the offset we're going to use to walk through the frame
-            offset = 2
+class PerMessageDeflate(object):
+    """
+    I am the permessage-deflate extension defined in [RFC7692], I compress
+    and decompress the messages of a connection.
+
+    By default the compression and decompression contexts are kept between
+    messages (context takeover) so repeated content in consecutive messages
+    (like the keys of JSON objects) is compressed really well. Messages
+    smaller than :attr:`min_size` are not compressed.
+
+    :param server_no_context_takeover: reset the compression context after
+                                       every message
+    :type server_no_context_takeover: bool
+    :param client_no_context_takeover: the client resets its compression
+                                       context after every message
+    :type client_no_context_takeover: bool
+    :param server_max_window_bits: the size of the compression window
+    :type server_max_window_bits: int
+    """
 
-            # extra length fields. if the value is 126 then the following 2
-            # bytes interpreted as 16-bit unsigned integer are the payload
-            # length
-            if length == 0x7e:
-                if len(self.buf) - start < 4:
-                    break
+    name = 'permessage-deflate'
+    compress_level = 6
+    min_size = 64
+
+    def __init__(self, server_no_context_takeover=False,
+                 client_no_context_takeover=False,
+                 server_max_window_bits=None):
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self._compressor = None
+        self._decompressor = zlib.decompressobj(-15)
+
+    @classmethod
+    def negotiate(cls, header):
+        """
+        Get back a new instance for the first permessage-deflate offer in
+        the given Sec-WebSocket-Extensions header that we can accept or
+        None if there is none
 
-                # read the next two bytes (start + 2:start + 4) and unpack
-                length = unpack('>H', self.buf[start + 2:start + 4])[0]
-                offset += 2
-            # if the value is 127 then the following 8 bytes interpreted as
-            # a 64-bit unsigned integer are the payload length that is a
-            # ridiculous big length of data but hey what the fuck I know
-            elif length == 0x7f:
-                if len(self.buf) - start < 10:
-                    break
+        :param header: the Sec-WebSocket-Extensions header value
+        :type header: str
+        """
+
+        if not header:
+            return None
 
-                # read the next eigth bytes (start +2:start +10) and unpack
-                length = unpack('>Q', self.buff[start + 2:start + 10])[0]
-                offset += 8
+        for offer in header.split(','):
+            params = [param.strip() for param in offer.split(';')]
+            if params[0] != cls.name:
+                continue
 
-            # browser client is supossed to send all frames masked so this
-            # should be always True
-            if masked:
-                if len(self.buf) - (start + offset) < 4:
+            options = {}
+            for param in params[1:]:
+                key, ignore, value = param.partition('=')
+                key, value = key.strip(), value.strip().strip('"')
+                if key in options:
                     break
+                options[key] = value
+            else:
+                extension = cls._from_options(options)
+                if extension is not None:
+                    return extension
 
-                # get the mask key
-                mask_key = self.buf[start + offset:start + offset + 4]
-                offset += 4
+        return None
 
-            # get the payload data
-            if len(self.buf) - (start + offset) < length:
-                break
+    @classmethod
+    def _from_options(cls, options):
+        """Build an instance for the given offer options if we accept it
+        """
 
-            payload_data = self.buf[start + offset:start + offset + length]
+        kwargs = {}
+        for key, value in options.iteritems():
+            if key in (
+                    'server_no_context_takeover',
+                    'client_no_context_takeover'):
+                if value:
+                    return None
+                kwargs[key] = True
+            elif key == 'server_max_window_bits':
+                # zlib can't use raw deflate with a window of 8 bits
+                if not value.isdigit() or not 9 <= int(value) <= 15:
+                    return None
+                kwargs[key] = int(value)
+            elif key == 'client_max_window_bits':
+                # we always decompress with the biggest window
+                if value and (not value.isdigit() or
+                              not 8 <= int(value) <= 15):
+                    return None
+            else:
+                return None
 
-            if masked:
-                payload_data = self.mask(payload_data, mask_key)
+        return cls(**kwargs)
 
-            if opcode == CLOSE:
-                if len(payload_data) >= 2:
-                    # unpack the opcode and return usable data
-                    payload_data = (
-                        unpack('>H', payload_data[:2])[0], payload_data[2:])
-                else:
-                    payload_data = NORMAL_CLOSURE, 'No reason given'
+    @property
+    def response(self):
+        """The Sec-WebSocket-Extensions header value to accept the offer
+        """
 
-            frames.append((opcode, payload_data))
-            start += offset + length
+        params = [self.name]
+        if self.server_no_context_takeover:
+            params.append('server_no_context_takeover')
+        if self.client_no_context_takeover:
+            params.append('client_no_context_takeover')
+        if self.server_max_window_bits is not None:
+            params.append(
+                'server_max_window_bits={}'.format(self.server_max_window_bits)
+            )
 
-        return frames, self.buf[start:]
+        return '; '.join(params)
 
-    def mask(self, buf, key):
-        """Mask or unmask a buffer of bytes with a masking key
+    def compress(self, data):
+        """Compress a message
 
-        The masking key is a 32-bit value chosen by the browser client. The
-        key shouldn't affect the length of the `Payload data`. The used
-        algorithm is the following. Octet i of the transformed data is the
-        XOR of octet i of the original data with octet at index i modulo 4
-        of the masking key::
+        :param data: the message to compress
+        :type data: str
+        """
 
-            j = i % 4
-            octet[i] = octet[i] ^ key[j]
+        if self._compressor is None or self.server_no_context_takeover:
+            self._compressor = zlib.compressobj(
+                self.compress_level, zlib.DEFLATED,
+                -(self.server_max_window_bits or 15)
+            )
 
-        This means that if a third party have access to the key used by our
-        connection we are exposed. For more information about this please,
-        refer to [RFC6455][Page31]
+        data = self._compressor.compress(data)
+        data += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        # the empty deflate block at the end of the flush is removed
+        return data[:-4] if data.endswith('\x00\x00\xff\xff') else data
 
-        :param buf: the buffer to mask or unmask
-        :param key: the masking key, it shoudl be exactly four bytes long
+    def decompress(self, data, max_size=0):
+        """Decompress a message
+
+        :param data: the compressed message
+        :type data: str
+        :param max_size: the max size of the decompressed message, 0 means
+                         unlimited
+        :type max_size: int
+        :raises: :class:`~mamba.web.websocket.MessageTooBig`
         """
 
-        key = [ord(i) for i in key]
-        buf = list(buf)
+        if self.client_no_context_takeover:
+            self._decompressor = zlib.decompressobj(-15)
+
+        try:
+            message = self._decompressor.decompress(
+                data + '\x00\x00\xff\xff', max_size + 1 if max_size else 0
+            )
+        except zlib.error as error:
+            raise WebSocketError('Invalid compressed message: {}'.format(
+                error)
+            )
+
+        if max_size and (
+                len(message) > max_size or self._decompressor.unconsumed_tail):
+            raise MessageTooBig(
+                'Message bigger than {} octets'.format(max_size))
+
+        return message
+
+
+def _mask(buf, key):
+    """Mask a buffer with the fastest available implementation
+    """
+
+    if numpy is not None and len(buf) >= NUMPY_MASK_THRESHOLD:
+        return _mask_numpy(buf, key)
 
-        for i in range(len(buf)):
-            buf[i] = chr(ord(buf[i]) ^ key[i % 4])
-        return ''.join(buf)
+    return _mask_strided(buf, key)
+
+
+def _mask_strided(buf, key):
+    """
+    Mask a buffer translating the octets of every one of the four strides
+    (octets i, i + 4, i + 8...) with the table of the key octet i, slicing
+    and translate work at C speed
+    """
+
+    masked = bytearray(len(buf))
+    for i in range(4):
+        masked[i::4] = buf[i::4].translate(_mask_tables[ord(key[i])])
+
+    return str(masked)
+
+
+def _mask_numpy(buf, key):
+    """
+    Mask a buffer XORing it as 32-bit words with the key using numpy, the
+    trailing bytes that don't fill a word are XORed one by one
+    """
+
+    words = len(buf) // 4
+    data = numpy.frombuffer(buf, dtype=numpy.uint32, count=words)
+    head = numpy.bitwise_xor(
+        data, numpy.frombuffer(key, dtype=numpy.uint32)[0]
+    ).tobytes()
+
+    tail = buf[words * 4:]
+    if tail:
+        tail = ''.join(chr(ord(c) ^ ord(k)) for c, k in zip(tail, key))
+
+    return head + tail
 
 
 class WebSocketProtocol(ProtocolWrapper):
@@ -483,9 +871,18 @@ class WebSocketProtocol(ProtocolWrapper):
 
         reactor.listenTCP(6543, websocket.WebSocketFactory(EchoFactory()))
 
-
+    The frames written by the wrapped protocol are queued per connection
+    and flushed with a single `writeSequence` call. I register myself as
+    the streaming producer of the real transport, so when a slow client
+    fills its buffers the transport pauses me and I stop flushing and
+    pause the producer registered by the wrapped protocol (and the
+    :class:`~mamba.web.websocket.Hub` subscriber of the connection if any)
+    until the transport resumes me. Pull producers are driven with a
+    cooperative task that is paused and resumed in the same way.
     """
 
+    implements(IPushProducer)
+
     buf = ''
     codec = None
     location = '/'
@@ -493,13 +890,29 @@ class WebSocketProtocol(ProtocolWrapper):
     origin = ''
     version = None
     state = HANDSHAKE
-    pending_frames = []
     protocols = []
     headers = {}
+    binary = False
+    deflate = None
+    allow_deflate = True
+    max_message_size = 16 * 1024 * 1024
 
     def __init__(self, *args, **kwargs):
         ProtocolWrapper.__init__(self, *args, **kwargs)
         self.buf = ''
+        self.parser = None
+        self.pending_frames = []
+        self.paused = False
+        self.producer = None
+        self.streaming = True
+        self.subscriber = None
+        self._pull = None
+
+        # keepalive, see mamba.web.websocket.Heartbeat
+        self.heartbeat = None
+        self.last_seen = None
+        self.ping_sent = None
+        self.latency = None
 
     @property
     def secure(self):
@@ -525,6 +938,12 @@ class WebSocketProtocol(ProtocolWrapper):
         return ('Sec-WebSocket-Key1' in self.headers
                 and 'Sec-WebSocket-Key2' in self.headers)
 
+    def connectionMade(self):
+        """Become the producer of the real transport
+        """
+
+        self.transport.registerProducer(self, True)
+
     def dataReceived(self, data):
         """Protocol dataReceived
 
@@ -539,7 +958,9 @@ class WebSocketProtocol(ProtocolWrapper):
         for protocol versions HyBi-00/Hixie-76. For more information refer to
         http://tools.ietf.org/html/draft-hixie-thewebsocketprotocol-76#page-5
 
-        If our state is FRAMES then we parse it.
+        If our state is FRAMES then we parse it. Once the handshake of a
+        HyBi-07+ connection is done the data is passed directly to the
+        incremental :class:`~mamba.web.websocket.HyBi07Parser`.
 
         We always kick any pending frames after each call to `dataReceived`.
         This is neccesary because frames might have started being sended early
@@ -548,7 +969,23 @@ class WebSocketProtocol(ProtocolWrapper):
         we need to manually kick pending frames.
         """
 
-        self.buf += data
+        if self.heartbeat is not None:
+            self.heartbeat.seen(self)
+
+        if self.parser is not None:
+            self.handle_frames(data)
+        else:
+            self.buf += data
+            self.handle_states()
+
+        # kick pending frames
+        if len(self.pending_frames) > 0:
+            self.send()
+
+    def handle_states(self):
+        """Run the state machine until the state doesn't change
+        """
+
         oldstate = None
 
         while oldstate != self.state:
@@ -571,10 +1008,6 @@ class WebSocketProtocol(ProtocolWrapper):
             elif self.state == FRAMES:          # FRAMES
                 self.handle_frames()
 
-        # kick pending frames
-        if len(self.pending_frames) > 0:
-            self.send()
-
     def handle_handshake(self):
         """
         Handle initial request. These look very much like HTTP requests but
@@ -612,58 +1045,71 @@ class WebSocketProtocol(ProtocolWrapper):
         if '\r\n\r\n' in self.buf:
             head, ignore, self.buf = self.buf.partition('\r\n\r\n')
             self.parse_headers(head)
+            self.negotiate()
 
-            # validate protocol beign used
-            if 'Upgrade' in self.headers.get('Connection', ''):
-                if self.headers.get('Upgrade').lower() != 'websocket':
-                    raise InvalidProtocol(
-                        'Not handling non-WS request. Connection lose...'
-                    )
+    def negotiate(self):
+        """
+        Negotiate the connection using the already parsed request headers,
+        this is used as well when a HTTP connection is upgraded by
+        :func:`~mamba.web.websocket.upgrade`
+        """
+
+        # validate protocol beign used
+        if 'Upgrade' in self.headers.get('Connection', ''):
+            if self.headers.get('Upgrade').lower() != 'websocket':
+                raise InvalidProtocol(
+                    'Not handling non-WS request. Connection lose...'
+                )
 
-            # Stash host and origin for those browsers that care about it.
-            if "Host" in self.headers:
-                self.host = self.headers["Host"]
-            if "Origin" in self.headers:
-                self.origin = self.headers["Origin"]
-
-            # process sub-protocols
-            protocol = self.headers.get('WebSocket-Protocol')
-            if protocol is None:
-                protocol = self.headers.get('Sec-WebSocket-Protocol')
-
-            # no subprotocols are defined if we don't hit this conditional
-            if protocol is not None:
-                self.protocols = []
-                for item in protocol.split(','):
-                    self.protocols.append(item)
-
-            # start next phase of handshake for HyBi-00
-            if self.is_hybi00:
-                log.msg('Starting HyBi-00/Hixie-76 handshake')
-                self.version = HYBI00
-                self.state = CHALLENGE
-
-            # start next phase of handshake for HyBi-07+
-            version = self.headers.get('Sec-WebSocket-Version')
-            if version is not None:
-                if version not in ('7', '8', '13'):
-                    log.msg('Can\'t support protocol version {}'.format(
-                        version))
-                    raise InvalidProtocolVersion()
-
-                if version == '7':
-                    log.msg('Starting HyBi-07 conversation')
-                    self.version = HYBI07
-                elif version == '8':
-                    log.msg('Starting HyBi-10 conversation')
-                    self.version = HYBI10
-                elif version == '13':
-                    log.msg('Starting RFC 6455 conversation')
-                    self.version = RFC6455
-
-                preamble = HyBi07HandshakePreamble(self)
-                preamble.write_to_transport(self.transport)
-                self.state = FRAMES
+        # Stash host and origin for those browsers that care about it.
+        if "Host" in self.headers:
+            self.host = self.headers["Host"]
+        if "Origin" in self.headers:
+            self.origin = self.headers["Origin"]
+
+        # process sub-protocols
+        protocol = self.headers.get('WebSocket-Protocol')
+        if protocol is None:
+            protocol = self.headers.get('Sec-WebSocket-Protocol')
+
+        # no subprotocols are defined if we don't hit this conditional
+        if protocol is not None:
+            self.protocols = []
+            for item in protocol.split(','):
+                self.protocols.append(item)
+
+        # start next phase of handshake for HyBi-00
+        if self.is_hybi00:
+            log.msg('Starting HyBi-00/Hixie-76 handshake')
+            self.version = HYBI00
+            self.state = CHALLENGE
+
+        # start next phase of handshake for HyBi-07+
+        version = self.headers.get('Sec-WebSocket-Version')
+        if version is not None:
+            if version not in VERSIONS:
+                log.msg('Can\'t support protocol version {}'.format(
+                    version))
+                raise InvalidProtocolVersion()
+
+            if version == '7':
+                log.msg('Starting HyBi-07 conversation')
+                self.version = HYBI07
+            elif version == '8':
+                log.msg('Starting HyBi-10 conversation')
+                self.version = HYBI10
+            elif version == '13':
+                log.msg('Starting RFC 6455 conversation')
+                self.version = RFC6455
+
+            if self.allow_deflate:
+                self.deflate = PerMessageDeflate.negotiate(
+                    self.headers.get('Sec-WebSocket-Extensions')
+                )
+
+            preamble = HyBi07HandshakePreamble(self)
+            preamble.write_to_transport(self.transport)
+            self.state = FRAMES
 
     def handle_challenge(self):
         """Handle challenge. This is exclusive to HyBi-00/Hixie-76
@@ -682,32 +1128,46 @@ class WebSocketProtocol(ProtocolWrapper):
             # we are done here, start sending frames
             self.state = FRAMES
 
-    def handle_frames(self):
+    def handle_frames(self, data=None):
         """
         Use the correct frame parser and send parsed data to the underlying
         protocol
+
+        :param data: new data for the incremental HyBi-07+ parser, if it is
+                     None the data in the buffer is parsed
         """
 
-        if self.version == HYBI00:
-            frame_parser = HyBi00Frame(self.buf)
-        elif self.version in (HYBI07, HYBI10, RFC6455):
-            frame_parser = HyBi07Frame(self.buf)
-        else:
+        if self.version not in (HYBI00, HYBI07, HYBI10, RFC6455):
             raise InvalidProtocolVersion(
                 'Unknown version {!r}'.format(self.version)
             )
 
         try:
-            frames, self.buf = frame_parser.parse()
+            if self.version == HYBI00:
+                frames, self.buf = HyBi00Frame(self.buf).parse()
+            else:
+                if self.parser is None:
+                    self.parser = HyBi07Parser(
+                        self.max_message_size, self.deflate
+                    )
+                    data, self.buf = self.buf, ''
+
+                frames = self.parser.feed(data)
+        except MessageTooBig as error:
+            log.msg(error)
+            self.close(str(error), MESSAGE_TOO_BIG)
+            return
         except WebSocketError as error:
             log.err(error)
-            self.close(error)
+            self.close(str(error), PROTOCOL_ERROR)
             return
 
         for frame in frames:
             opcode, data = frame
-            if opcode == DATA:
-                # pass the frame to the underlying protocol
+            if opcode in (DATA, BINARY):
+                # pass the message to the underlying protocol, it can look
+                # at our binary attribute to know the type of the message
+                self.binary = opcode == BINARY
                 ProtocolWrapper.dataReceived(self, data)
             elif opcode == CLOSE:
                 # the other side want's to close
@@ -723,6 +1183,19 @@ class WebSocketProtocol(ProtocolWrapper):
                 self.transport.write(
                     HyBi07Frame(data).generate(0xa)
                 )
+            elif opcode == PONG:
+                if self.heartbeat is not None:
+                    self.heartbeat.pong(self)
+
+    def ping(self, data=''):
+        """Send a ping control frame, HyBi-00 doesn't support them
+
+        :param data: the application data of the ping frame
+        :type data: str
+        """
+
+        if self.version in (HYBI07, HYBI10, RFC6455):
+            self.transport.write(HyBi07Frame(data).generate(0x9))
 
     def write(self, data):
         """Write to the transport.
@@ -730,8 +1203,8 @@ class WebSocketProtocol(ProtocolWrapper):
         :param data: the buffer data to write
         """
 
-        self.pending_frames.append(data)
-        self._send()
+        self.pending_frames.append((0x1, data))
+        self.send()
 
     def writeSequence(self, data):
         """Write a sequence of data to the transport
@@ -739,29 +1212,168 @@ class WebSocketProtocol(ProtocolWrapper):
         :param data: the sequence to be written
         """
 
-        self.pending_frames.extend(data)
-        self._send()
+        self.pending_frames.extend((0x1, item) for item in data)
+        self.send()
+
+    def write_binary(self, data):
+        """Write a binary message to the transport
+
+        :param data: the binary data to write
+        :type data: str
+        """
+
+        self.pending_frames.append((0x2, data))
+        self.send()
 
     def send(self, binary=False):
-        """Send all pending frames
         """
+        Send all pending frames with a single `writeSequence`, nothing is
+        sent while the handshake is not done or the transport paused us
 
-        if self.state == FRAMES:
-            if self.version == HYBI00:
-                frame_generator = HyBi00Frame
-            elif self.version in (HYBI07, HYBI10, RFC6455):
-                frame_generator = HyBi07Frame
-            else:
+        :param binary: send all the pending frames as binary messages
+        :type binary: bool
+        """
+
+        if self.state == FRAMES and not self.paused and self.pending_frames:
+            if self.version not in (HYBI00, HYBI07, HYBI10, RFC6455):
                 raise InvalidProtocolVersion(
                     'Unknown version {!r}'.format(self.version)
                 )
 
-            for frame in self.pending_frames:
-                self.transport.write(frame_generator(frame).generate())
+            frames, self.pending_frames = self.pending_frames, []
+            self.transport.writeSequence([
+                self.encode_frame(frame, 0x2 if binary else opcode)
+                for opcode, frame in frames
+            ])
 
-            self.pending_frames = []
+    def registerProducer(self, producer, streaming):
+        """
+        Register the producer of the wrapped protocol, it is paused and
+        resumed when the real transport pauses and resumes us
 
-    def close(self, reason=''):
+        :param producer: the producer to register
+        :param streaming: True for push producers, False for pull ones
+        :type streaming: bool
+        """
+
+        if self.producer is not None:
+            raise RuntimeError(
+                'Cannot register producer {!r}, because producer {!r} was '
+                'never unregistered.'.format(producer, self.producer)
+            )
+
+        self.producer = producer
+        self.streaming = streaming
+        if not streaming:
+            self._pull = cooperate(self._pull_producer(producer))
+            if self.paused:
+                self._pull.pause()
+        elif self.paused:
+            producer.pauseProducing()
+
+    def unregisterProducer(self):
+        """Unregister the producer of the wrapped protocol
+        """
+
+        if self._pull is not None:
+            pull, self._pull = self._pull, None
+            try:
+                pull.stop()
+            except TaskFinished:
+                pass
+
+        self.producer = None
+
+    def pauseProducing(self):
+        """
+        The real transport buffers are full, stop sending frames and pause
+        the producers above us
+        """
+
+        if self.paused:
+            return
+
+        self.paused = True
+        if self._pull is not None:
+            self._pull.pause()
+        elif self.producer is not None:
+            self.producer.pauseProducing()
+
+        if self.subscriber is not None:
+            self.subscriber.pauseProducing()
+
+    def resumeProducing(self):
+        """
+        The real transport buffers are drained, flush the pending frames
+        and resume the producers above us
+        """
+
+        if not self.paused:
+            return
+
+        self.paused = False
+        self.send()
+        if self.subscriber is not None:
+            self.subscriber.resumeProducing()
+
+        if self._pull is not None:
+            self._pull.resume()
+        elif self.producer is not None:
+            self.producer.resumeProducing()
+
+    def stopProducing(self):
+        """The connection is going away, stop the producers above us
+        """
+
+        if self.producer is not None:
+            producer = self.producer
+            self.unregisterProducer()
+            producer.stopProducing()
+
+    def loseConnection(self):
+        """
+        Unregister us from the real transport so a paused connection can
+        still be closed once its buffers are written
+        """
+
+        if getattr(self.transport, 'producer', None) is self:
+            self.transport.unregisterProducer()
+
+        ProtocolWrapper.loseConnection(self)
+
+    def _pull_producer(self, producer):
+        """Ask the pull producer for more data whenever we are not paused
+        """
+
+        while True:
+            producer.resumeProducing()
+            yield None
+
+    def encode_frame(self, data, opcode=0x1):
+        """
+        Encode a message into a frame for our protocol version, unicode text
+        is encoded as UTF-8 and the message is compressed if the
+        permessage-deflate extension has been negotiated
+
+        :param data: the message
+        :param opcode: the opcode of the message (0x1 text, 0x2 binary)
+        :type opcode: int
+        """
+
+        if self.version == HYBI00:
+            return HyBi00Frame(data).generate()
+
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+
+        if self.deflate is not None and len(data) >= self.deflate.min_size:
+            return HyBi07Frame(self.deflate.compress(data)).generate(
+                opcode, compressed=True
+            )
+
+        return HyBi07Frame(data).generate(opcode)
+
+    def close(self, reason='', code=None):
         """
         Close the connection.
 
@@ -773,9 +1385,16 @@ class WebSocketProtocol(ProtocolWrapper):
         shouldn't be a problem.
 
         Refer to [RFC6455][Page 35][Page 41] for more details
+
+        :param reason: the reason to close the connection
+        :param code: the status code of the close frame if any
+        :type code: int
         """
 
         if self.version in (HYBI07, HYBI10, RFC6455):
+            if code is not None:
+                reason = '{}{}'.format(pack('>H', code), reason)
+
             self.transport.write(HyBi07Frame(reason).generate(opcode=0x8))
 
         self.loseConnection()
@@ -810,10 +1429,524 @@ class WebSocketProtocol(ProtocolWrapper):
                 self.headers[k] = v
 
 
+class Subscriber(object):
+    """
+    I am a connection subscribed to one or more channels of a
+    :class:`~mamba.web.websocket.Hub`.
+
+    The frames published in my channels are written to the transport of my
+    connection unless the connection has been paused because its transport
+    buffers are full, then they are stored in a bounded queue that is
+    flushed with a single `writeSequence` when it is resumed. If the queue is
+    full the oldest frame is dropped (DROP policy) or the connection is
+    closed (DISCONNECT policy).
+
+    :param hub: the hub that created me
+    :type hub: :class:`~mamba.web.websocket.Hub`
+    :param protocol: the subscribed connection
+    :type protocol: :class:`~mamba.web.websocket.WebSocketProtocol`
+    """
+
+    implements(IPushProducer)
+
+    def __init__(self, hub, protocol):
+        self.hub = hub
+        self.protocol = protocol
+        self.channels = set()
+        self.queue = deque()
+        self.paused = getattr(protocol, 'paused', False)
+        self.dropped = 0
+        protocol.subscriber = self
+
+    def push(self, frame):
+        """
+        Write the frame to the transport or queue it if we are paused or
+        the connection is still doing the handshake
+
+        :returns: False if the connection has been closed by the policy
+        """
+
+        if not self.paused and not self.queue and (
+                self.protocol.state == FRAMES):
+            self.protocol.transport.write(frame)
+            return True
+
+        if len(self.queue) >= self.hub.max_queue:
+            if self.hub.policy == DISCONNECT:
+                self.hub.disconnected += 1
+                self.hub.unsubscribe(self.protocol)
+                self.protocol.close('Too slow', POLICY_VIOLATION)
+                return False
+
+            self.queue.popleft()
+            self.dropped += 1
+            self.hub.dropped += 1
+
+        self.queue.append(frame)
+        return True
+
+    def flush(self):
+        """Write all the queued frames at once
+        """
+
+        if self.queue and self.protocol.state == FRAMES:
+            frames = list(self.queue)
+            self.queue.clear()
+            self.protocol.transport.writeSequence(frames)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flush()
+
+    def stopProducing(self):
+        self.hub.unsubscribe(self.protocol)
+
+
+class Hub(object):
+    """
+    Broadcast hub for WebSocket connections.
+
+    I keep named channels of subscribed connections. When a message is
+    published in a channel I encode it once for every protocol family
+    (HyBi-00 or HyBi-07+) and I write the same bytes to the transports of
+    all the subscribers, see :class:`~mamba.web.websocket.Subscriber` for
+    details about slow consumers.
+
+    Broadcasted messages are never compressed with permessage-deflate as
+    the compressed data would be different for every connection.
+
+    :param max_queue: the max number of frames queued for a slow subscriber
+    :type max_queue: int
+    :param policy: what to do when the queue of a subscriber is full, DROP
+                   the oldest frame or DISCONNECT the subscriber
+    :param clock: callable that returns the current time in seconds
+    """
+
+    def __init__(self, max_queue=1024, policy=DROP, clock=time.time):
+        self.max_queue = max_queue
+        self.policy = policy
+        self.clock = clock
+        self.channels = {}
+        self.subscribers = {}
+
+        # metrics
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.fanout_last = 0.0
+        self.fanout_max = 0.0
+        self.fanout_total = 0.0
+
+    def subscribe(self, protocol, channel):
+        """Subscribe the connection to the given channel
+
+        :param protocol: the connection to subscribe
+        :type protocol: :class:`~mamba.web.websocket.WebSocketProtocol`
+        :param channel: the name of the channel
+        :type channel: str
+        """
+
+        subscriber = self.subscribers.get(protocol)
+        if subscriber is None:
+            subscriber = Subscriber(self, protocol)
+            self.subscribers[protocol] = subscriber
+
+        subscriber.channels.add(channel)
+        self.channels.setdefault(channel, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, protocol, channel=None):
+        """
+        Unsubscribe the connection from the given channel or from all of
+        them if no channel is given
+        """
+
+        subscriber = self.subscribers.get(protocol)
+        if subscriber is None:
+            return
+
+        channels = [channel] if channel is not None else list(
+            subscriber.channels)
+        for name in channels:
+            subscriber.channels.discard(name)
+            members = self.channels.get(name)
+            if members is not None:
+                members.discard(subscriber)
+                if not members:
+                    del self.channels[name]
+
+        if not subscriber.channels:
+            del self.subscribers[protocol]
+            if getattr(protocol, 'subscriber', None) is subscriber:
+                protocol.subscriber = None
+
+    def publish(self, channel, message, binary=False):
+        """
+        Publish a message in the given channel
+
+        :param channel: the name of the channel
+        :type channel: str
+        :param message: the message to publish
+        :param binary: publish the message as binary instead of text
+        :type binary: bool
+        :returns: the number of subscribers that got the message
+        """
+
+        members = self.channels.get(channel)
+        if not members:
+            return 0
+
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+
+        start = self.clock()
+        frames = {}
+        delivered = 0
+        for subscriber in list(members):
+            hybi00 = subscriber.protocol.version == HYBI00
+            frame = frames.get(hybi00)
+            if frame is None:
+                if hybi00:
+                    frame = HyBi00Frame(message).generate()
+                else:
+                    frame = HyBi07Frame(message).generate(
+                        0x2 if binary else 0x1)
+                frames[hybi00] = frame
+
+            if subscriber.push(frame):
+                delivered += 1
+
+        elapsed = self.clock() - start
+        self.published += 1
+        self.delivered += delivered
+        self.fanout_last = elapsed
+        self.fanout_max = max(self.fanout_max, elapsed)
+        self.fanout_total += elapsed
+        return delivered
+
+    def stats(self):
+        """Return back a dict with the hub metrics
+        """
+
+        depths = [len(s.queue) for s in self.subscribers.itervalues()]
+        return {
+            'channels': len(self.channels),
+            'subscribers': len(self.subscribers),
+            'published': self.published,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'disconnected': self.disconnected,
+            'fanout_latency': {
+                'last': self.fanout_last,
+                'max': self.fanout_max,
+                'avg': (
+                    self.fanout_total / self.published
+                    if self.published else 0.0
+                )
+            },
+            'queue_depth': {
+                'total': sum(depths),
+                'max': max(depths) if depths else 0
+            }
+        }
+
+
+class Heartbeat(object):
+    """
+    I am the keepalive scheduler shared by all the connections of a
+    :class:`~mamba.web.websocket.WebSocketFactory`.
+
+    Instead of one delayed call per connection I use a timer wheel, a ring
+    of slots of `resolution` seconds that is advanced by a single delayed
+    call while there are connections. When the slot of a connection is
+    reached I look at it:
+
+        - If it sent data in the last `interval` seconds it is rescheduled
+        - If it is idle a ping is sent and it has `timeout` seconds to
+          answer with a pong
+        - If it didn't answer the ping (or it is an idle HyBi-00 or
+          handshaking connection that can't be pinged) it is closed
+
+    The round trip time of the last pong is stored in the `latency`
+    attribute of the connection, the wrapped protocol can read it from
+    its transport.
+
+    :param interval: seconds without data before we ping a connection, 0
+                     disables the keepalive
+    :type interval: float
+    :param timeout: seconds to wait for a pong before closing a connection
+    :type timeout: float
+    :param resolution: the seconds that every slot of the wheel spans
+    :type resolution: float
+    :param reactor: the reactor (or :class:`twisted.internet.task.Clock`)
+                    used to schedule the wheel, the global one if None
+    """
+
+    def __init__(self, interval=30, timeout=10, resolution=1.0, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.interval = interval
+        self.timeout = timeout
+        self.resolution = resolution
+        self.reactor = reactor
+        self.position = 0
+        self.slots = [
+            set() for _ in range(self._ticks(max(interval, timeout)) + 1)
+        ]
+        self.where = {}
+        self.call = None
+        self.pings = 0
+        self.reaped = 0
+
+    def add(self, protocol):
+        """Start tracking the given connection
+        """
+
+        if not self.interval:
+            return
+
+        protocol.heartbeat = self
+        self.seen(protocol)
+        self.schedule(protocol, self.interval)
+
+    def discard(self, protocol):
+        """Stop tracking the given connection
+        """
+
+        slot = self.where.pop(protocol, None)
+        if slot is not None:
+            self.slots[slot].discard(protocol)
+
+        if not self.where and self.call is not None:
+            if self.call.active():
+                self.call.cancel()
+            self.call = None
+
+    def seen(self, protocol):
+        """The connection sent us data, it is alive
+        """
+
+        protocol.last_seen = self.reactor.seconds()
+
+    def pong(self, protocol):
+        """The connection answered our ping, store the round trip time
+        """
+
+        if protocol.ping_sent is not None:
+            protocol.latency = self.reactor.seconds() - protocol.ping_sent
+            protocol.ping_sent = None
+
+    def schedule(self, protocol, delay):
+        """Move the connection to the slot that expires after delay seconds
+        """
+
+        old = self.where.get(protocol)
+        if old is not None:
+            self.slots[old].discard(protocol)
+
+        slot = (self.position + self._ticks(delay)) % len(self.slots)
+        self.slots[slot].add(protocol)
+        self.where[protocol] = slot
+
+        if self.call is None:
+            self.call = self.reactor.callLater(self.resolution, self.tick)
+
+    def tick(self):
+        """Advance the wheel one slot and check the connections on it
+        """
+
+        self.call = None
+        self.position = (self.position + 1) % len(self.slots)
+        expired, self.slots[self.position] = self.slots[self.position], set()
+        for protocol in expired:
+            del self.where[protocol]
+            self.check(protocol)
+
+        if self.where and self.call is None:
+            self.call = self.reactor.callLater(self.resolution, self.tick)
+
+    def check(self, protocol):
+        """Reschedule, ping or close the given connection
+        """
+
+        now = self.reactor.seconds()
+        if protocol.ping_sent is not None:
+            if now - protocol.ping_sent >= self.timeout:
+                return self.reap(protocol)
+
+            return self.schedule(
+                protocol, self.timeout - (now - protocol.ping_sent))
+
+        idle = now - protocol.last_seen
+        if idle < self.interval:
+            return self.schedule(protocol, self.interval - idle)
+
+        if protocol.state == FRAMES and protocol.version != HYBI00:
+            protocol.ping_sent = now
+            protocol.ping()
+            self.pings += 1
+            return self.schedule(protocol, self.timeout)
+
+        if idle >= self.interval + self.timeout:
+            return self.reap(protocol)
+
+        self.schedule(protocol, self.interval + self.timeout - idle)
+
+    def reap(self, protocol):
+        """Close an unresponsive connection without waiting for its buffers
+        """
+
+        log.msg('Closing unresponsive WebSocket connection {!r}'.format(
+            protocol))
+        self.reaped += 1
+        self.discard(protocol)
+        protocol.close('Ping timeout', GOING_AWAY)
+        abort = getattr(protocol.transport, 'abortConnection', None)
+        if abort is not None:
+            abort()
+
+    def _ticks(self, delay):
+        """Return back the number of slots that span the given delay
+        """
+
+        return max(1, int(math.ceil(delay / float(self.resolution))))
+
+
 class WebSocketFactory(WrappingFactory):
     """
     Factory that wraps another factory to provide WebSockets transports
     for all of its protocols
+
+    The :class:`~mamba.web.websocket.Hub` in my `hub` attribute can be used
+    to broadcast messages to the connections::
+
+        factory.hub.subscribe(protocol, 'dashboard')
+        factory.hub.publish('dashboard', json.dumps(data))
+
+    If a :class:`~mamba.web.websocket.Heartbeat` is given, idle connections
+    are pinged and closed if they don't answer. It is stored in my
+    `heartbeat` attribute::
+
+        factory = WebSocketFactory(wrapped, heartbeat=Heartbeat(30, 10))
+
+    :param wrappedFactory: the wrapped factory
+    :param hub: the broadcast hub to use, a new one is created if None
+    :param heartbeat: the keepalive scheduler to use, if None the idle
+                      connections are never pinged nor closed
     """
 
     protocol = WebSocketProtocol
+
+    def __init__(self, wrappedFactory, hub=None, heartbeat=None):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.hub = Hub() if hub is None else hub
+        self.heartbeat = heartbeat
+
+    def registerProtocol(self, p):
+        """Start the keepalive of the new connections
+        """
+
+        WrappingFactory.registerProtocol(self, p)
+        if self.heartbeat is not None:
+            self.heartbeat.add(p)
+
+    def unregisterProtocol(self, p):
+        """Unsubscribe the closed connections from the hub channels
+        """
+
+        if self.heartbeat is not None:
+            self.heartbeat.discard(p)
+        self.hub.unsubscribe(p)
+        WrappingFactory.unregisterProtocol(self, p)
+
+
+def upgrade(request, wrapped, factory):
+    """
+    Take over the connection of a :class:`twisted.web.server.Request` that
+    asked for a HyBi-07+ WebSocket upgrade and speak WebSocket on it with
+    the given protocol.
+
+    The HTTP channel of the connection is replaced by a
+    :class:`~mamba.web.websocket.WebSocketProtocol` (through the TLS
+    layer if any) that is negotiated with the headers that the channel
+    already parsed, so the same port, TLS setup and routing table serve
+    HTTP requests and WebSockets. The request is never finished.
+
+    :param request: the request that asked for the upgrade
+    :type request: :class:`twisted.web.server.Request`
+    :param wrapped: the protocol that talks over the WebSocket
+    :type wrapped: :class:`twisted.internet.protocol.Protocol`
+    :param factory: the factory that tracks the WebSocket connections
+    :type factory: :class:`~mamba.web.websocket.WebSocketFactory`
+    :returns: the :class:`~mamba.web.websocket.WebSocketProtocol` or None
+              if the connection can't be taken over, if the negotiation
+              fails the connection is closed with a 400 response
+    """
+
+    channel = request.channel
+    transport = channel.transport
+    protocol = factory.protocol(factory, wrapped)
+    protocol.location = request.uri
+    protocol.headers = {}
+    for name in HANDSHAKE_HEADERS:
+        values = request.requestHeaders.getRawHeaders(name)
+        if values:
+            protocol.headers[name] = ', '.join(values)
+
+    if not _replace_protocol(transport, channel, protocol):
+        return None
+
+    # the channel is gone, it doesn't produce or time out anymore
+    transport.unregisterProducer()
+    channel.setTimeout(None)
+
+    protocol.makeConnection(transport)
+    try:
+        protocol.negotiate()
+    except Exception as error:
+        # the channel is gone so there is no request to answer anymore
+        log.err(error)
+        transport.write(
+            'HTTP/1.1 400 Bad Request\r\n'
+            'Connection: close\r\n'
+            'Content-Length: 0\r\n\r\n'
+        )
+        protocol.loseConnection()
+        return protocol
+
+    protocol.send()
+
+    # data sent by the client right after the handshake is still in the
+    # line buffer of the channel or buffered while it handles the request
+    buffered = getattr(channel, '_buffer', '') + ''.join(
+        getattr(channel, '_dataBuffer', []))
+    channel._buffer = ''
+    channel._dataBuffer = []
+    transport.resumeProducing()
+    if buffered:
+        protocol.dataReceived(buffered)
+
+    return protocol
+
+
+def _replace_protocol(transport, channel, protocol):
+    """
+    Replace the HTTP channel by the given protocol as the receiver of the
+    transport data, the channel can be wrapped by the Twisted generic HTTP
+    channel and a TLS layer
+    """
+
+    for holder in (transport, getattr(transport, 'protocol', None)):
+        for name in ('protocol', 'wrappedProtocol'):
+            current = getattr(holder, name, None)
+            if current is not None and channel in (
+                    current, getattr(current, '_channel', None)):
+                setattr(holder, name, protocol)
+                return True
+
+    return False